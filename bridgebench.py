@@ -0,0 +1,419 @@
+'''
+End-to-end benchmark of the ffs_fsforce bridge that runs headless on Linux: no sim, no FSForce, no fsfloader.
+
+The bridge (FlyInsideConnector + ConnectionHandler on their own reactor, logging to ffs_fsforce.log as usual
+but not to the console) runs in a child process. This process plays both of its peers:
+- a scripted FlyInside feeder that speaks the same UDP protocol as Startup_FSForce.chai (RES/DEF/VF), sending
+  every variable at a fixed rate like the script does once per graphics frame
+- N SimConnect clients, each replaying either a synthetic FSForce-like session or the client side of a
+  session recorded by proxy.py
+
+For each combination of client count and datum count it measures:
+- the CPU and wall time of each bridge tick and of each run of its request scheduler, which is what sends the
+  requested data (both measured inside the bridge), and the bridge's overall CPU use
+- the latency from a VF: datagram being sent to the SSimObjectData or SEvent carrying that value arriving at a
+  client. The marker variables (altitude for data, elevator for events) get a new value on every feed, so
+  each output can be matched to the datagram it came from.
+- the rate of messages and bytes the bridge sends to its clients
+
+Examples:
+    python bridgebench.py                                          # 1,2,4,8 clients x 10,25,50 datums
+    python bridgebench.py --clients 1,16 --datums 50 --tick 0.02 --duration 10
+    python bridgebench.py --capture proxy-20240101-120000.scap.gz --conn 0 --clients 1,4
+    python bridgebench.py --json results.json
+    python bridgebench.py --datums 100 --no-numpy                  # without the bridge's NumPy data definitions
+'''
+
+from simconnect.utils import *
+import sys, os, socket, time, json, logging, argparse, multiprocessing
+from simconnect import connection, message as M, reactor, capture, objdata, units, defs as SC
+import ffs_fsforce as FF
+
+# Keep logging to ffs_fsforce.log as the bridge normally does, but not to the console, which would mostly measure
+# the terminal (and bury the results)
+for h in list(logging.getLogger().handlers):
+    if type(h) is logging.StreamHandler:
+        logging.getLogger().removeHandler(h)
+
+ALT_VAR = 'Aircraft.Position.Altitude.True' # marker for data latency, read by the 'plane altitude' datum
+ELEVATOR_VAR = 'Aircraft.Surfaces.Elevator.Percent' # marker for event latency, drives the axis_elevator_set SEvent
+ELEVATOR_EVENT = 'axis_elevator_set'
+
+# Everything Startup_FSForce.chai sends, i.e. the FFS side of FSX_FFS_MAP plus what ConnectionHandler.Tick reads
+FEED_VARS = sorted({v[0] for v in FF.FSX_FFS_MAP.values() if isinstance(v[0], str)} |
+                   {'Aircraft.Input.Pitch', 'Aircraft.Input.Roll', ELEVATOR_VAR, 'Aircraft.Wheel.Left.Input.BrakeStrength',
+                    'Aircraft.Wheel.Right.Input.BrakeStrength', 'SimState.Paused'})
+
+def AltitudeValue(feedNum):
+    return 1000.0 + feedNum % 10000
+
+def ElevatorValue(feedNum):
+    return float(feedNum % 201 - 100)
+
+def ElevatorEventData(feedNum):
+    '''the SEvent data the bridge sends for ElevatorValue(feedNum) (mirrors ConnectionHandler.Tick)'''
+    return int(max(min(ElevatorValue(feedNum) * -163.84, 16384), -16384))
+
+def FeedValues(feedNum):
+    '''returns a list of (varName, value) to send for the given feed'''
+    ret = []
+    for i, name in enumerate(FEED_VARS):
+        if name == ALT_VAR:
+            v = AltitudeValue(feedNum)
+        elif name == ELEVATOR_VAR:
+            v = ElevatorValue(feedNum)
+        elif name == 'SimState.Paused':
+            v = 0.0
+        elif name == 'Aircraft.Status.OnGround':
+            v = 1.0
+        else:
+            v = ((feedNum * 7 + i * 13) % 100) / 10.0 # keeps changing, so CHANGED requests have work to do
+        ret.append((name, v))
+    return ret
+
+# ----------------------------------------------------------------------------------------------
+# The bridge (runs in a child process)
+# ----------------------------------------------------------------------------------------------
+
+def BridgeMain(pipe, feederPort, tickInterval, useNumPy=True, frameRate=60.0):
+    '''runs the bridge with its ticks timed, until told to stop over pipe. Sends back (simConnectPort, udpPort) once
+    it's listening, and a dict of stats whenever it gets a 'stats' command.'''
+    FF.GV.useNumPy = FF.GV.useNumPy and useNumPy
+    tickStats = [] # (cpuSeconds, wallSeconds) for each tick
+    frameStats = [] # (cpuSeconds, wallSeconds) for each RequestScheduler run
+    class TimedConnector(FF.FlyInsideConnector):
+        def Tick(self):
+            cpu = time.thread_time()
+            wall = time.perf_counter()
+            FF.FlyInsideConnector.Tick(self)
+            tickStats.append((time.thread_time() - cpu, time.perf_counter() - wall))
+
+    r = reactor.Reactor()
+    fic = TimedConnector(0, feederPort, r, tickInterval, frameRate)
+    runDue = fic.scheduler.RunDue
+    def TimedRunDue():
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        runDue()
+        frameStats.append((time.thread_time() - cpu, time.perf_counter() - wall))
+    fic.scheduler.RunDue = TimedRunDue
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(100)
+    def OnAccept(sock, addr):
+        FF.ConnectionHandler.Create(FF.ConnectionHandler.nextID, sock, fic)
+    r.AddListener(listener, OnAccept)
+
+    mark = [time.process_time(), time.monotonic()]
+    def OnCommand():
+        cmd = pipe.recv()
+        if cmd == 'stats':
+            cpu, now = time.process_time(), time.monotonic()
+            pipe.send(dict(ticks=list(tickStats), frames=list(frameStats), cpu=cpu - mark[0], elapsed=now - mark[1]))
+            tickStats.clear()
+            frameStats.clear()
+            mark[:] = [cpu, now]
+        elif cmd == 'stop':
+            r.Stop()
+    r.AddReader(pipe, OnCommand)
+
+    pipe.send((listener.getsockname()[1], fic.recvSock.getsockname()[1]))
+    r.Run()
+    fic.Close()
+    listener.close()
+
+# ----------------------------------------------------------------------------------------------
+# The bridge's peers
+# ----------------------------------------------------------------------------------------------
+
+class Feeder:
+    '''stands in for Startup_FSForce.chai: sends the variable mapping whenever the bridge asks for a reset, and
+    then the value of every variable at a fixed rate'''
+    def __init__(self, r, rate):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.bridgeAddr = None # where the bridge listens for us, once we know it
+        self.needReset = False
+        self.varIDs = {name: str(i) for i, name in enumerate(FEED_VARS)}
+        self.numFeeds = 0
+        self.listeners = [] # called as func(feedNum, sentAt) after each feed
+        self.reactor = r
+        r.AddReader(self.sock, self.OnReadable)
+        self.timer = r.CallEvery(1.0 / rate, self.Feed)
+
+    def OnReadable(self):
+        while 1:
+            try:
+                msg, addr = self.sock.recvfrom(4096)
+            except BlockingIOError:
+                break
+            if msg == b'RES:1':
+                self.needReset = True
+
+    def Send(self, text):
+        self.sock.sendto(text.encode('utf8'), self.bridgeAddr)
+
+    def Feed(self):
+        if self.bridgeAddr is None:
+            return
+        if self.needReset:
+            self.needReset = False
+            self.Send('RES:1')
+            for name, varID in self.varIDs.items():
+                self.Send('DEF:%s=%s' % (name, varID))
+        feedNum = self.numFeeds
+        self.numFeeds += 1
+        sentAt = time.monotonic()
+        for name, value in FeedValues(feedNum):
+            self.Send('VF:%s=%r' % (self.varIDs[name], value))
+        for func in self.listeners:
+            func(feedNum, sentAt)
+
+    def Close(self):
+        self.timer.Cancel()
+        self.reactor.Remove(self.sock)
+        self.sock.close()
+
+class Session:
+    '''the client side of a SimConnect session: a list of (secondsFromStart, frame)'''
+    def __init__(self, name, frames):
+        self.name = name
+        self.frames = frames
+        defs = objdata.DataDefinitions()
+        for ts, frame in frames:
+            defs.Track(M.ClientMessageFromBuffer(frame)[0])
+        self.numDatums = sum(len(datums) for datums in defs.defs.values())
+
+def SyntheticSession(numDatums, flags, period):
+    '''returns a Session that sets things up the way FSForce does: one data definition of numDatums FLOAT64 datums
+    (the first is always the altitude marker), requested on the user object, plus the elevator axis event'''
+    names = [name for name, (ffsName, units, default) in sorted(FF.FSX_FFS_MAP.items()) if not isinstance(default, str) and name != 'plane altitude']
+    msgs = [
+        M.COpen(appName='bridgebench', _ignore=0, _ignore2=0, simID='D3P', version=[4,3], build=[0,0]),
+        M.CSubscribeToSystemEvent(clientEventID=1, eventName='Pause'),
+        M.CAddToDataDefinition(dataDefinitionID=1, datumName='PLANE ALTITUDE', unitsName='feet', dataType=SC.DATATYPE.FLOAT64, epsilon=0.0, datumID=0),
+    ]
+    for i in range(1, numDatums):
+        name = names[(i - 1) % len(names)]
+        units = FF.FSX_FFS_MAP[name][1] or 'number'
+        msgs.append(M.CAddToDataDefinition(dataDefinitionID=1, datumName=name.upper(), unitsName=units, dataType=SC.DATATYPE.FLOAT64, epsilon=0.0, datumID=i))
+    msgs += [
+        M.CRequestDataOnSimObject(requestID=1, definitionID=1, objectID=SC.OBJECT_ID_USER, period=period, flags=flags, origin=0, interval=0, limit=0),
+        M.CMapClientEventToSimEvent(eventID=10, eventName=ELEVATOR_EVENT),
+        M.CAddClientEventToNotificationGroup(groupID=1, eventID=10, maskable=0),
+        M.CSetNotificationGroupPriority(groupID=1, priority=1),
+    ]
+    frames = []
+    for i, msg in enumerate(msgs):
+        msg._protocol = 29
+        msg._counter = i + 1
+        frames.append((0.0, bytes(M.MessageToBytes(msg))))
+    return Session('synthetic', frames)
+
+def CaptureSession(filename, connID=None):
+    '''returns a Session with the client frames of one connection (the first one, if connID is None) in a capture'''
+    with capture.IndexedCapture(filename) as cap:
+        if connID is None:
+            connID = cap.ConnectionIDs()[0]
+        frames = [(ts, bytes(cap.data[offset:offset+length])) for i, ts, conn, direction, code, offset, length in cap.Iter(connID=connID) if direction == 'c']
+    if not frames:
+        raise ValueError('no client messages for connection %r in %s' % (connID, filename))
+    start = frames[0][0]
+    return Session('%s:%d' % (os.path.basename(filename), connID), [(ts - start, frame) for ts, frame in frames])
+
+class BenchClient:
+    '''a SimConnect client that replays a Session to the bridge and times what comes back'''
+    def __init__(self, r, port, session, speed):
+        sock = socket.create_connection(('127.0.0.1', port))
+        self.conn = connection.ServerConnection(sock, rawFrames=True)
+        self.reactor = r
+        self.defs = objdata.DataDefinitions()
+        self.elevatorEventIDs = set()
+        for ts, frame in session.frames:
+            msg = M.ClientMessageFromBuffer(frame)[0]
+            self.defs.Track(msg)
+            if isinstance(msg, M.CMapClientEventToSimEvent) and msg.eventName.lower() == ELEVATOR_EVENT:
+                self.elevatorEventIDs.add(msg.eventID)
+        self.markerDatums = set()
+        for datums in self.defs.defs.values():
+            for datum in datums:
+                entry = FF.FSX_FFS_MAP.get(datum.name.lower())
+                if entry is not None and entry[0] == ALT_VAR and self.Expected(datum, AltitudeValue(0)) is not None:
+                    self.markerDatums.add(datum)
+        self.pending = {} # expected value -> when the feed that should produce it was sent
+        self.ResetStats()
+        r.AddConnection(self.conn, self.OnFrame, self.OnClosed)
+        for ts, frame in session.frames:
+            if ts <= 0 or speed is None:
+                self.conn.SendBytes(frame)
+            else:
+                r.CallLater(ts / speed, self.conn.SendBytes, frame)
+        self.conn.Flush()
+
+    def ResetStats(self):
+        self.numMsgs = 0
+        self.numBytes = 0
+        self.dataLatencies = []
+        self.eventLatencies = []
+
+    def Expected(self, datum, altitude):
+        '''returns the value the bridge should send for datum when the altitude is the given value, or None if it
+        can't be worked out'''
+        ffsName, ffsUnits, default = FF.FSX_FFS_MAP[datum.name.lower()]
+        if datum.struct is None:
+            return None
+        try:
+            v = units.Converter(ffsUnits, datum.units)(altitude)
+            return datum.Unpack(FF.ValueToBytes(v, datum.dataType), 0)
+        except (units.UnitsError, M.struct.error, NotImplementedError, TypeError):
+            return None
+
+    def Expect(self, key, sentAt):
+        self.pending.pop(key, None)
+        self.pending[key] = sentAt
+        if len(self.pending) > 4096:
+            del self.pending[next(iter(self.pending))] # (drop the oldest)
+
+    def OnFeed(self, feedNum, sentAt):
+        for datum in self.markerDatums:
+            self.Expect(('d', self.Expected(datum, AltitudeValue(feedNum))), sentAt)
+        if self.elevatorEventIDs:
+            self.Expect(('e', ElevatorEventData(feedNum)), sentAt)
+
+    def OnFrame(self, item):
+        now = time.monotonic()
+        code, frame = item
+        self.numMsgs += 1
+        self.numBytes += len(frame)
+        if code == M.SSimObjectData.code and self.markerDatums:
+            msg = M.ServerMessageFromBuffer(frame)[0]
+            for datum, value in self.defs.Decode(msg):
+                if datum in self.markerDatums:
+                    sentAt = self.pending.pop(('d', value), None)
+                    if sentAt is not None:
+                        self.dataLatencies.append(now - sentAt)
+        elif code == M.SEvent.code and self.elevatorEventIDs:
+            msg = M.ServerMessageFromBuffer(frame)[0]
+            if msg.eventID in self.elevatorEventIDs:
+                sentAt = self.pending.pop(('e', msg.data), None)
+                if sentAt is not None:
+                    self.eventLatencies.append(now - sentAt)
+
+    def OnClosed(self, conn):
+        log('Bridge closed a client connection')
+        self.Close()
+
+    def Close(self):
+        if self.conn.sock.fileno() >= 0:
+            self.reactor.Remove(self.conn)
+            self.conn.sock.close()
+
+# ----------------------------------------------------------------------------------------------
+# Running
+# ----------------------------------------------------------------------------------------------
+
+def RunFor(r, seconds):
+    r.CallLater(seconds, r.Stop)
+    r.Run()
+
+def RunConfig(numClients, session, tickInterval=0.25, feedRate=60.0, warmup=2.0, duration=5.0, speed=1.0, useNumPy=True, frameRate=60.0):
+    '''runs the bridge with numClients clients each replaying session, returning a dict of results'''
+    r = reactor.Reactor()
+    feeder = Feeder(r, feedRate)
+    ctx = multiprocessing.get_context('spawn')
+    pipe, childPipe = ctx.Pipe()
+    proc = ctx.Process(target=BridgeMain, args=(childPipe, feeder.port, tickInterval, useNumPy, frameRate), daemon=True)
+    proc.start()
+    try:
+        scPort, udpPort = pipe.recv()
+        feeder.bridgeAddr = ('127.0.0.1', udpPort)
+        clients = [BenchClient(r, scPort, session, speed) for i in range(numClients)]
+        feeder.listeners.extend(c.OnFeed for c in clients)
+
+        RunFor(r, warmup)
+        pipe.send('stats')
+        pipe.recv() # (throw away the warmup stats)
+        for c in clients:
+            c.ResetStats()
+        start = time.monotonic()
+        RunFor(r, duration)
+        elapsed = time.monotonic() - start
+        pipe.send('stats')
+        bridge = pipe.recv()
+        pipe.send('stop')
+        proc.join(5)
+    finally:
+        if proc.is_alive():
+            proc.terminate()
+    for c in clients:
+        c.Close()
+    feeder.Close()
+    r.Close()
+
+    ticks = bridge['ticks']
+    tickCPU = [cpu * 1000 for cpu, wall in ticks]
+    tickWall = [wall * 1000 for cpu, wall in ticks]
+    frameCPU = [cpu * 1000 for cpu, wall in bridge['frames']]
+    dataLat = [x * 1000 for c in clients for x in c.dataLatencies]
+    eventLat = [x * 1000 for c in clients for x in c.eventLatencies]
+    return dict(
+        session=session.name, clients=numClients, datums=session.numDatums, tickInterval=tickInterval, feedRate=feedRate,
+        frameRate=frameRate, seconds=elapsed, ticks=len(ticks), frames=len(frameCPU),
+        tickCpuMsMean=sum(tickCPU) / max(1, len(tickCPU)), tickCpuMsP95=Percentile(tickCPU, 95), tickCpuMsMax=max(tickCPU, default=0),
+        tickWallMsMean=sum(tickWall) / max(1, len(tickWall)), tickWallMsP95=Percentile(tickWall, 95),
+        frameCpuMsMean=sum(frameCPU) / max(1, len(frameCPU)), frameCpuMsP95=Percentile(frameCPU, 95),
+        bridgeCpuPct=bridge['cpu'] / bridge['elapsed'] * 100,
+        msgsPerSec=sum(c.numMsgs for c in clients) / elapsed, bytesPerSec=sum(c.numBytes for c in clients) / elapsed,
+        dataLatencies=len(dataLat), dataLatencyMsP50=Percentile(dataLat, 50), dataLatencyMsP95=Percentile(dataLat, 95), dataLatencyMsMax=max(dataLat, default=0),
+        eventLatencies=len(eventLat), eventLatencyMsP50=Percentile(eventLat, 50), eventLatencyMsP95=Percentile(eventLat, 95), eventLatencyMsMax=max(eventLat, default=0),
+    )
+
+HEADER = '%7s %6s %6s %9s %9s %6s %9s %9s %7s %9s %9s %9s %9s %9s %9s' % ('clients', 'datums', 'ticks', 'tickCPU', 'p95', 'frames',
+                                                 'frameCPU', 'p95', 'CPU%', 'msgs/s', 'KB/s', 'data p50', 'p95', 'event p50', 'p95')
+def FormatResult(res):
+    return '%7d %6d %6d %7.3fms %7.3fms %6d %7.3fms %7.3fms %6.1f%% %9.0f %9.1f %7.2fms %7.2fms %7.2fms %7.2fms' % (res['clients'],
+        res['datums'], res['ticks'], res['tickCpuMsMean'], res['tickCpuMsP95'], res['frames'], res['frameCpuMsMean'], res['frameCpuMsP95'],
+        res['bridgeCpuPct'], res['msgsPerSec'], res['bytesPerSec'] / 1024,
+        res['dataLatencyMsP50'], res['dataLatencyMsP95'], res['eventLatencyMsP50'], res['eventLatencyMsP95'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the ffs_fsforce bridge end to end')
+    parser.add_argument('--clients', default='1,2,4,8', help='comma separated client counts to try')
+    parser.add_argument('--datums', default='10,25,50', help='comma separated datum counts to try (synthetic sessions)')
+    parser.add_argument('--capture', help='replay the client side of a session from this capture instead')
+    parser.add_argument('--conn', type=int, help='connection ID within the capture (default: the first one)')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed for captured client messages')
+    parser.add_argument('--flags', default='tagged', help='data request flags for synthetic sessions, e.g. tagged,changed')
+    parser.add_argument('--period', default='SIM_FRAME', help='data request period for synthetic sessions')
+    parser.add_argument('--tick', type=float, default=0.25, help='bridge tick interval in seconds')
+    parser.add_argument('--feed-rate', type=float, default=60.0, help='feeder updates per second')
+    parser.add_argument('--frame-rate', type=float, default=60.0, help='sim frames per second the bridge schedules requests at')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds to run before measuring')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to measure for')
+    parser.add_argument('--no-numpy', action='store_true', help="don't let the bridge use NumPy for data definitions")
+    parser.add_argument('--json', help='file to save the results to as JSON')
+    args = parser.parse_args()
+
+    clientCounts = [int(x) for x in args.clients.split(',')]
+    if args.capture:
+        sessions = [CaptureSession(args.capture, args.conn)]
+    else:
+        flags = SC.ParseDataRequestFlags(args.flags)
+        period = getattr(SC.PERIOD, args.period.upper())
+        sessions = [SyntheticSession(int(n), flags, period) for n in args.datums.split(',')]
+
+    results = []
+    print(HEADER)
+    for session in sessions:
+        for numClients in clientCounts:
+            res = RunConfig(numClients, session, args.tick, args.feed_rate, args.warmup, args.duration, args.speed,
+                            not args.no_numpy, args.frame_rate)
+            results.append(res)
+            print(FormatResult(res))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=1)
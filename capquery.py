@@ -0,0 +1,142 @@
+'''
+Queries a capture file saved by proxy.py (or by ffs_fsforce.py --capture), printing just the messages that
+match the given filters, as text, CSV, or JSON lines. Works in a single streaming pass over the capture's
+index, and only decodes the frames that can possibly match, so it's fast even on long sessions.
+
+SSimObjectData[ByType] payloads (tagged or not) are decoded into named values using the data definitions
+the client set up earlier in the same connection. Messages of types we can't decode are listed as UnknownFrame,
+with their raw bytes.
+
+Examples:
+    capquery.py taxi.scap.gz --class SSimObjectData --datum "PLANE ALTITUDE" --start 60 --end 120
+    capquery.py taxi.scap.gz --conn 1 --dir c --format csv > conn1.csv
+    capquery.py taxi.scap.gz --request 3 --format json
+'''
+
+from simconnect.utils import *
+import sys, csv, json, argparse
+from simconnect import capture, message, objdata
+from replay import DecodeFrame
+
+# Client messages that DataDefinitions needs to see, regardless of the filters
+TRACKED_KEYS = {(k.fromAgent, k.code) for k in (message.CAddToDataDefinition, message.CRequestDataOnSimObject, message.CRequestDataOnSimObjectType)}
+OBJDATA_KEYS = {(k.fromAgent, k.code) for k in (message.SSimObjectData, message.SSimObjectDataByType)}
+
+def Query(cap, conns=None, direction=None, classNames=None, requestIDs=None, datumNames=None, start=None, end=None):
+    '''yields (timestamp, connID, direction, msg, values) for each message in an IndexedCapture that matches all of
+    the given filters (None means don't filter on that). timestamp is seconds since the start of the capture.
+    values is a list of (objdata.Datum, value) for SSimObjectData[ByType] messages, and None for everything else.
+    If datumNames is given, only SSimObjectData[ByType] messages that have one of those datums match, and values
+    only has those datums. Frames of types there's no message class for come back as replay.UnknownFrame objects
+    (with the raw bytes) rather than stopping the query.'''
+    if classNames is not None:
+        keys = set()
+        for name in classNames:
+            klass = getattr(message, name)
+            keys.add((klass.fromAgent, klass.code))
+    elif datumNames is not None:
+        keys = OBJDATA_KEYS
+    else:
+        keys = None
+    if datumNames is not None:
+        datumNames = {n.lower() for n in datumNames}
+    defsByConn = {} # connID -> objdata.DataDefinitions
+    data = cap.data
+
+    # Data definitions can be set up long before the window we're interested in, so we have to start at the
+    # beginning, but before the start time we only decode the messages that DataDefinitions needs
+    for i, ts, connID, recDir, code, offset, length in cap.Iter():
+        if end is not None and ts > end:
+            break
+        if conns is not None and connID not in conns:
+            continue
+        key = (recDir, code)
+        tracked = key in TRACKED_KEYS
+        wanted = (start is None or ts >= start) and (direction is None or recDir == direction) and (keys is None or key in keys)
+        if not wanted and not tracked:
+            continue
+
+        msg = DecodeFrame(data, offset, recDir)
+        defs = defsByConn.get(connID)
+        if defs is None:
+            defs = defsByConn[connID] = objdata.DataDefinitions()
+        if tracked:
+            defs.Track(msg)
+        if not wanted:
+            continue
+        if requestIDs is not None and getattr(msg, 'requestID', None) not in requestIDs:
+            continue
+
+        values = None
+        if key in OBJDATA_KEYS:
+            values = defs.Decode(msg)
+            if datumNames is not None:
+                values = [(d, v) for d, v in values if d.name.lower() in datumNames]
+                if not values:
+                    continue
+        yield ts, connID, recDir, msg, values
+
+def Fields(msg):
+    '''returns a dict of a message's (or struct's) public members, converted to JSON-friendly values'''
+    ret = {}
+    for name, sv in msg.members:
+        if name[0] != '_':
+            ret[name] = _Plain(getattr(msg, name))
+    return ret
+
+def _Plain(v):
+    if hasattr(v, 'members'):
+        return Fields(v)
+    if isinstance(v, (list, tuple)):
+        return [_Plain(x) for x in v]
+    if isinstance(v, (bytes, bytearray)):
+        return v.hex()
+    return v
+
+def WriteText(rows, out):
+    for ts, connID, direction, msg, values in rows:
+        out.write('[%10.3f,%d,%s] %r\n' % (ts, connID, direction, msg))
+        if values:
+            out.write(''.join('        %d: %r :%s\n' % (d.datumID, v, d.name) for d, v in values))
+
+def WriteCSV(rows, out):
+    '''one row per datum value for SSimObjectData[ByType] messages, and one row per message for everything else
+    (with its fields as JSON in the value column)'''
+    w = csv.writer(out, lineterminator='\n')
+    w.writerow(['time', 'conn', 'dir', 'class', 'requestID', 'name', 'value'])
+    for ts, connID, direction, msg, values in rows:
+        common = ['%.6f' % ts, connID, direction, msg.__class__.__name__, getattr(msg, 'requestID', '')]
+        if values is None:
+            w.writerow(common + ['', json.dumps(Fields(msg))])
+        else:
+            for d, v in values:
+                w.writerow(common + [d.name, v])
+
+def WriteJSON(rows, out):
+    '''JSON lines: one object per message'''
+    for ts, connID, direction, msg, values in rows:
+        obj = dict(time=round(ts, 6), conn=connID, dir=direction, type=msg.__class__.__name__, fields=Fields(msg))
+        if values is not None:
+            obj['values'] = {d.name: _Plain(v) for d, v in values}
+        out.write(json.dumps(obj) + '\n')
+
+WRITERS = dict(text=WriteText, csv=WriteCSV, json=WriteJSON)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Queries a SimConnect capture file')
+    parser.add_argument('filename')
+    parser.add_argument('--conn', type=int, action='append', help='connection ID (can be repeated)')
+    parser.add_argument('--dir', choices=['c', 's'], help='only messages from the client (c) or server (s)')
+    parser.add_argument('--class', dest='classNames', action='append', help='message class name, e.g. SSimObjectData (can be repeated)')
+    parser.add_argument('--request', type=int, action='append', help='request ID (can be repeated)')
+    parser.add_argument('--datum', action='append', help='datum name, e.g. "PLANE ALTITUDE" (can be repeated)')
+    parser.add_argument('--start', type=float, help='seconds into the capture to start at')
+    parser.add_argument('--end', type=float, help='seconds into the capture to stop at')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='text')
+    args = parser.parse_args()
+
+    with capture.IndexedCapture(args.filename) as cap:
+        rows = Query(cap, conns=set(args.conn) if args.conn else None, direction=args.dir, classNames=args.classNames,
+                     requestIDs=set(args.request) if args.request else None, datumNames=args.datum,
+                     start=args.start, end=args.end)
+        WRITERS[args.format](rows, sys.stdout)
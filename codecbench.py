@@ -0,0 +1,296 @@
+'''
+Benchmarks the message codecs in simconnect.message (standard library only), so that codec changes can be
+judged against real numbers.
+
+For every message class in classMap this times decoding a whole frame (ClientMessageFromBuffer or
+ServerMessageFromBuffer), encoding one (MessageToBytes), and the class's own FromBytes/ToBytes on the body.
+It also covers some realistic payloads: a tagged SSimObjectData carrying 50 datums (including decoding its
+values with objdata), and an SJoystickDeviceInfo with a full array of devices.
+
+Each result has the time per op, ops per second, and three memory numbers per op measured with tracemalloc: the
+peak number of bytes in use while the op runs (temporaries included), how many of those bytes are still held by
+what it returns, and how many memory blocks (i.e. allocations) that takes. tracemalloc only sees blocks that are
+still alive, so allocations that are freed again before the op returns show up in the peak bytes, not in the
+block count.
+
+Timings are noisy from one run to the next, so when comparing against a baseline, any op that looks slower is
+timed again --rounds more times and judged on the median of all its timings.
+
+Usage:
+    python codecbench.py                           print a table of results
+    python codecbench.py --json out.json           ... and save them as JSON (use - for stdout)
+    python codecbench.py --baseline out.json       compare against results saved earlier; exits with 1 if
+                                                   any op got slower by more than --threshold percent
+                                                   (checked with the median of --rounds extra timings)
+    python codecbench.py --filter SSimObjectData   only run cases whose name contains the given text
+    python codecbench.py --generic                 compare the generated codecs with the generic BaseStruct ones
+'''
+
+import sys, timeit, json, time, platform, tracemalloc, statistics, argparse
+from simconnect import message, objdata, defs as SC
+
+def SampleValue(sv):
+    '''returns a plausible value for the given StructValue'''
+    sc = sv.structClass
+    if sc is None:
+        if sv.format.endswith('s'):
+            return 'sample'
+        if sv.format in 'fd':
+            return 1.5
+        if sv.format in 'bhilq':
+            return -1
+        return 1
+    if isinstance(sc, message.Remaining):
+        return bytearray(b'\x01' * 16)
+    if isinstance(sc, message.Array):
+        count = sc.count if sc.count is not None else 2
+        return [SampleValue(sc.structValue) for i in range(count)]
+    return SampleStruct(sc)
+
+def SampleStruct(klass):
+    '''creates an instance of the given struct class with every member filled in'''
+    obj = klass()
+    for name, sv in klass.members:
+        setattr(obj, name, SampleValue(sv))
+    for name, countField in klass.countFields:
+        setattr(obj, countField, len(getattr(obj, name)))
+    return obj
+
+def SampleMessage(klass):
+    msg = SampleStruct(klass)
+    msg._protocol = 29
+    msg._counter = 1
+    return msg
+
+def TimeIt(func, number):
+    '''returns the average number of microseconds per call of func'''
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+def _TraceCalls(func, number):
+    '''returns the total (peak, kept) bytes over number calls of func - see Allocations'''
+    totalPeak = totalKept = 0
+    for i in range(number):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+        totalPeak += peak - before
+        totalKept += current - before
+        del result
+    return totalPeak, totalKept
+
+def _KeptBlocks(func, number):
+    '''returns the number of memory blocks held by the results of number calls of func'''
+    results = [None] * number # (allocated up front so it doesn't show up in the numbers)
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        results[i] = func()
+    after = tracemalloc.take_snapshot()
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    return sum(s.count_diff for s in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'filename'))
+
+def Allocations(func, number):
+    '''returns (peakBytes, keptBytes, keptBlocks) per call of func: the most memory it had allocated at once while
+    running, how much of that was still held by its result when it returned, and in how many blocks'''
+    func() # warm up any caches
+    tracemalloc.start()
+    try:
+        _TraceCalls(lambda: None, number) # (so that the measuring loop's own allocations are already in place)
+        basePeak, baseKept = _TraceCalls(lambda: None, number)
+        peak, kept = _TraceCalls(func, number)
+        blocks = _KeptBlocks(func, number)
+    finally:
+        tracemalloc.stop()
+    return max(0, peak - basePeak) / number, max(0, kept - baseKept) / number, blocks / number
+
+# ----------------------------------------------------------------------------------------------
+# Benchmark cases
+# ----------------------------------------------------------------------------------------------
+
+FromBuffer = {'c': message.ClientMessageFromBuffer, 's': message.ServerMessageFromBuffer}
+
+def MessageOps(msg):
+    '''returns a list of (opName, func) for the standard codec ops on a message'''
+    klass = msg.__class__
+    frame = bytes(message.MessageToBytes(msg))
+    body = bytes(msg.ToBytes())
+    fromBuffer = FromBuffer[klass.fromAgent]
+    return [
+        ('decode', lambda: fromBuffer(frame)),
+        ('encode', lambda: message.MessageToBytes(msg)),
+        ('FromBytes', lambda: klass.FromBytes(body)),
+        ('ToBytes', msg.ToBytes),
+    ]
+
+def ClassCases():
+    '''yields (caseName, [(opName, func)]) for every message class'''
+    for key, klass in sorted(message.classMap.items()):
+        yield '%s (%s:0x%02x)' % (klass.__name__, key[0], key[1]), MessageOps(SampleMessage(klass))
+
+NUM_DATUMS = 50
+NUM_JOYSTICKS = 16
+
+def TaggedObjectDataCase():
+    '''an SSimObjectData with NUM_DATUMS tagged FLOAT64 values, like a big spoofed-variables request, plus
+    decoding those values with objdata'''
+    defs = objdata.DataDefinitions()
+    for i in range(NUM_DATUMS):
+        defs.Track(message.CAddToDataDefinition(dataDefinitionID=1, datumName='SAMPLE VAR:%d' % i, unitsName='number',
+                                                dataType=SC.DATATYPE.FLOAT64, epsilon=0.0, datumID=i))
+    defs.Track(message.CRequestDataOnSimObject(requestID=1, definitionID=1, objectID=0, period=SC.PERIOD.SIM_FRAME,
+                                               flags=SC.DATA_REQUEST_FLAG.TAGGED, origin=0, interval=0, limit=0))
+    data = bytearray()
+    for i in range(NUM_DATUMS):
+        data += message.struct.pack('<Ld', i, i * 1.25)
+    msg = message.SSimObjectData(requestID=1, objectID=0, definitionID=1, flags=SC.DATA_REQUEST_FLAG.TAGGED,
+                                 entryNumber=1, outOf=1, defineCount=NUM_DATUMS, data=data)
+    msg._protocol = 29
+    ops = MessageOps(msg)
+    ops.append(('objdata.Decode', lambda: defs.Decode(msg)))
+    return 'SSimObjectData tagged x%d' % NUM_DATUMS, ops
+
+def JoystickDeviceInfoCase():
+    '''an SJoystickDeviceInfo listing NUM_JOYSTICKS devices'''
+    joysticks = [message.JoystickDeviceInfo(name='Joystick device %d' % i, number=i) for i in range(NUM_JOYSTICKS)]
+    msg = message.SJoystickDeviceInfo(requestID=1, count=NUM_JOYSTICKS, joysticks=joysticks)
+    msg._protocol = 29
+    return 'SJoystickDeviceInfo x%d' % NUM_JOYSTICKS, MessageOps(msg)
+
+def AllCases():
+    yield from ClassCases()
+    yield TaggedObjectDataCase()
+    yield JoystickDeviceInfoCase()
+
+# ----------------------------------------------------------------------------------------------
+# Running and comparing
+# ----------------------------------------------------------------------------------------------
+
+def Run(number, filter=None, allocNumber=1000, out=sys.stdout):
+    '''runs every benchmark case (whose name contains filter, if given), printing a line per op to out (if not
+    None). Returns a dict of 'caseName/opName' -> dict of results.'''
+    results = {}
+    if out is not None:
+        out.write('%-48s %-15s %10s %12s %9s %9s %7s\n' % ('case', 'op', 'us/op', 'ops/s', 'peak B', 'kept B', 'blocks'))
+    for caseName, ops in AllCases():
+        if filter is not None and filter.lower() not in caseName.lower():
+            continue
+        for opName, func in ops:
+            us = TimeIt(func, number)
+            peak, kept, blocks = Allocations(func, allocNumber)
+            results['%s/%s' % (caseName, opName)] = dict(usPerOp=us, opsPerSec=1e6 / us, peakBytes=peak, keptBytes=kept,
+                                                          keptBlocks=blocks)
+            if out is not None:
+                out.write('%-48s %-15s %10.3f %12.0f %9.1f %9.1f %7.1f\n' % (caseName, opName, us, 1e6 / us, peak, kept, blocks))
+    return results
+
+def Recheck(keys, results, number, rounds):
+    '''times each of the given ops rounds more times, replacing its timing in results with the median of all of
+    them. Each round times every op once, so that a stretch of machine noise doesn't land on all of one op's
+    timings.'''
+    keys = set(keys)
+    funcs = {}
+    for caseName, ops in AllCases():
+        for opName, func in ops:
+            key = '%s/%s' % (caseName, opName)
+            if key in keys:
+                funcs[key] = func
+    timings = {key:[results[key]['usPerOp']] for key in funcs}
+    for i in range(rounds):
+        for key, func in funcs.items():
+            timings[key].append(TimeIt(func, number))
+    for key, us in timings.items():
+        us = statistics.median(us)
+        results[key].update(usPerOp=us, opsPerSec=1e6 / us, timings=rounds + 1)
+
+def Meta(number):
+    return dict(python=platform.python_version(), implementation=platform.python_implementation(),
+                machine=platform.machine(), platform=platform.platform(), number=number, time=time.time())
+
+def Slower(baseline, results, threshold):
+    '''returns the list of keys whose ops/s dropped by more than threshold percent from baseline to results'''
+    return [key for key, r in results.items() if key in baseline and
+            (r['opsPerSec'] / baseline[key]['opsPerSec'] - 1) * 100 < -threshold]
+
+def Compare(baseline, results, threshold, out=sys.stdout):
+    '''prints how results compare to baseline (both dicts as returned by Run), returning the list of keys whose
+    ops/s dropped by more than threshold percent'''
+    slower = Slower(baseline, results, threshold)
+    out.write('%-64s %12s %12s %8s %9s\n' % ('case/op', 'base ops/s', 'ops/s', 'change', 'peak B'))
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b is None:
+            out.write('%-64s %12s %12.0f %8s %9.1f\n' % (key, '-', r['opsPerSec'], 'new', r['peakBytes']))
+            continue
+        change = (r['opsPerSec'] / b['opsPerSec'] - 1) * 100
+        flag = ' SLOWER' if key in slower else ''
+        basePeak = b.get('peakBytes') # (missing from baselines saved before peak bytes were measured)
+        if basePeak is None:
+            peak = '?'
+        elif abs(r['peakBytes'] - basePeak) < 0.5:
+            peak = '='
+        else:
+            peak = '%+.1f' % (r['peakBytes'] - basePeak)
+        out.write('%-64s %12.0f %12.0f %+7.1f%% %9s%s\n' % (key, b['opsPerSec'], r['opsPerSec'], change, peak, flag))
+    missing = [k for k in baseline if k not in results]
+    if missing:
+        out.write('%d case(s) in the baseline were not run\n' % len(missing))
+    out.write('%d op(s) slower by more than %.1f%%\n' % (len(slower), threshold))
+    return slower
+
+def BenchGeneric(klass, number):
+    '''Returns (genericDecodeUS, generatedDecodeUS, genericEncodeUS, generatedEncodeUS)'''
+    msg = SampleMessage(klass)
+    body = bytes(msg.ToBytes())
+    ret = []
+    for generated in (False, True):
+        message.UseGeneratedCodecs(generated)
+        try:
+            decUS = TimeIt(lambda: klass.FromBytes(body), number)
+            encUS = TimeIt(msg.ToBytes, number)
+        finally:
+            message.UseGeneratedCodecs(True)
+        ret.append((decUS, encUS))
+    (genericDec, genericEnc), (genDec, genEnc) = ret
+    return genericDec, genDec, genericEnc, genEnc
+
+def PrintGeneric(number):
+    print('%-44s %9s %9s %7s   %9s %9s %7s' % ('class', 'dec(us)', 'gen(us)', 'speedup', 'enc(us)', 'gen(us)', 'speedup'))
+    for key, klass in sorted(message.classMap.items()):
+        genericDec, genDec, genericEnc, genEnc = BenchGeneric(klass, number)
+        print('%-44s %9.2f %9.2f %6.1fx   %9.2f %9.2f %6.1fx' % ('%s (%s:0x%02x)' % (klass.__name__, key[0], key[1]),
+              genericDec, genDec, genericDec / genDec, genericEnc, genEnc, genericEnc / genEnc))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the simconnect.message codecs')
+    parser.add_argument('number', type=int, nargs='?', default=20000, help='iterations per timing run')
+    parser.add_argument('--json', help='file to save the results to as JSON (- for stdout)')
+    parser.add_argument('--baseline', help='JSON results from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent drop in ops/s that counts as slower')
+    parser.add_argument('--rounds', type=int, default=5, help='extra timings for ops that look slower than the baseline')
+    parser.add_argument('--filter', help='only run cases whose name contains this')
+    parser.add_argument('--generic', action='store_true', help='compare the generated codecs with the generic ones')
+    args = parser.parse_args()
+
+    if args.generic:
+        PrintGeneric(args.number)
+        sys.exit(0)
+
+    quiet = args.json == '-' or args.baseline is not None
+    results = Run(args.number, args.filter, out=None if quiet else sys.stdout)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        Recheck(Slower(baseline, results, args.threshold), results, args.number, args.rounds)
+    if args.json:
+        doc = dict(meta=Meta(args.number), results=results)
+        if args.json == '-':
+            json.dump(doc, sys.stdout, indent=1)
+            sys.stdout.write('\n')
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(doc, f, indent=1)
+    if baseline is not None:
+        out = sys.stderr if args.json == '-' else sys.stdout
+        if Compare(baseline, results, args.threshold, out):
+            sys.exit(1)
@@ -16,7 +16,7 @@ ConnectionHandler
 - filters/translates events
 - forwards simevents if client wants them
 - translates input events to client mapped events if needed
-- has a list of pending info on sim obj requests that it processes in tick. if not recurring, remove after sending
+- has a list of pending info on sim obj requests, which the RequestScheduler sends when due. if not recurring, remove after sending
 
 NEXT
 - add ConnHandler.activeDataRequests
@@ -27,9 +27,12 @@ InitLogging('ffs_fsforce.log')
 log, logTB = Logger()
 log('heeey')
 
-import sys, socket, time, threading, json, struct
-from simconnect import connection, message, defs as SC
-import fsfloader
+import sys, socket, time, json, struct, math, heapq, itertools
+from simconnect import connection, message, reactor, capture, units, defs as SC
+try:
+    import numpy as np # optional, see NumericValues
+except ImportError:
+    np = None
 
 class Bag(dict):
     def __setattr__(self, k, v): self[k] = v
@@ -53,11 +56,18 @@ class Bag(dict):
 
 class GV:
     keepRunning = True
+    useNumPy = np is not None # use NumericValues for data definitions that are all numbers
 
 class FlyInsideConnector:
-    '''connects to and communicates with the FlyInside Flight Sim'''
-    def __init__(self, recvPort, sendPort):
+    '''connects to and communicates with the FlyInside Flight Sim. The UDP socket to the sim, all of the SimConnect
+    client connections, the periodic ticks and the RequestScheduler are all handled on a single reactor, so message
+    handling, ticks and sending requested data never run concurrently. frameRate is how many sim frames per second
+    to assume when sending data requested per frame.'''
+    def __init__(self, recvPort, sendPort, reactor, tickInterval=0.25, frameRate=60.0):
+        self.reactor = reactor # the reactor that everything is handled on
+        self.scheduler = RequestScheduler(reactor, frameRate) # sends data for the clients' ObjectDataRequests
         self.scConnections = {} # handler ID -> ConnectionHandler (to SimConnect)
+        self.capWriter = None # capture.CaptureWriter for recording SimConnect traffic, if any
         self.recvPort = recvPort
         self.sendPort = sendPort
         self.lastPaused = None
@@ -65,79 +75,123 @@ class FlyInsideConnector:
         self.lastSimRunning = False
 
         self.varToValues = {} # sim variable name to most recent value from sim
-        self.outgoingMessages = []
-        t = threading.Thread(target=self._MessagePump)
-        t.daemon = 1
-        t.start()
-
-    def _MessagePump(self):
-        '''sends and receives network messages to/from the flight sim'''
-        recvSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        recvSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        recvSock.bind(('', self.recvPort))
-        recvSock.settimeout(0.5)
-
-        sendSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        destAddr = ('127.0.0.1', self.sendPort)
-
-        idToVarNames = {} # string ID to sim variable name
+        self.idToVarNames = {} # string ID to sim variable name
+        self.dirtyVars = set() # names of variables whose values have changed since the last PushChanges
+        self.pendingVars = set() # names of variables the sim has defined but not yet sent a value for
+        self.varReaders = {} # sim variable name (or None for "any") -> set of (ConnectionHandler, data definition ID) that read it
+
+        self.recvSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recvSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.recvSock.bind(('', self.recvPort))
+        self.recvSock.setblocking(False)
+        self.sendSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.destAddr = ('127.0.0.1', self.sendPort)
+        reactor.AddReader(self.recvSock, self.OnSimReadable)
 
         # on start, send a reset command so the sim will send us its var mapping and the initial state of everything
-        needReset = True
+        self.needReset = True
         self.SimSend('RES:1')
-        lastTick = 0.0
-        try:
-            while GV.keepRunning:
-                try:
-                    # Process incoming messages
-                    msg, fromAddr = recvSock.recvfrom(4096)
-                    msg = msg.decode('utf8')
-                    if needReset:
-                        if msg == 'RES:1':
-                            needReset = False
-                        else:
-                            log('IGNORING:', msg)
-                    else:
-                        parts = msg.split(':')
-                        if len(parts) != 2:
-                            log('Malformed message:', parts)
-                        else:
-                            cmd, payload = parts
-                            if cmd == 'DEF':
-                                # Sim is defining a short ID for a variable name
-                                varName, varID = payload.split('=')
-                                idToVarNames[varID] = varName
-                            elif cmd == 'VF':
-                                # Sim is giving us an updated value for a float variable
-                                varID, value = payload.split('=')
-                                varName = idToVarNames[varID]
-                                self.varToValues[varName] = float(value)
-                            elif cmd == 'VS':
-                                # Sim is giving us an updated value for a string variable
-                                varID, value = payload.split('=')
-                                varName = idToVarNames[varID]
-                                self.varToValues[varName] = value
-                            else:
-                                log('Unhandled message:', cmd, payload)
-                except socket.timeout:
-                    pass
-
-                # Process outgoing messages
-                while self.outgoingMessages:
-                    msg = self.outgoingMessages.pop(0)
-                    sendSock.sendto(msg.encode('utf8'), destAddr)
-
-                # Tick our connections
-                now = time.time()
-                if now - lastTick > 0.25:
-                    self.Tick()
-                    lastTick = time.time()
-        finally:
-            recvSock.close()
+        self.tickTimer = reactor.CallEvery(tickInterval, self.Tick)
+
+    def Close(self):
+        self.tickTimer.Cancel()
+        self.scheduler.Close()
+        self.reactor.Remove(self.recvSock)
+        self.recvSock.close()
+        self.sendSock.close()
+        if self.capWriter is not None:
+            self.capWriter.Close()
+
+    def OnSimReadable(self):
+        '''called by the reactor when there are messages from the flight sim waiting to be read'''
+        while 1:
+            try:
+                msg, fromAddr = self.recvSock.recvfrom(4096)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue # (Windows reports ICMP port unreachable errors from an earlier sendto this way)
+            try:
+                self.HandleSimMessage(msg.decode('utf8'))
+            except:
+                logTB() # (but keep going, so the rest of the batch and PushChanges still happen)
+        self.PushChanges()
+
+    def HandleSimMessage(self, msg):
+        '''processes a single message from the flight sim'''
+        if self.needReset:
+            if msg == 'RES:1':
+                self.needReset = False
+            else:
+                log('IGNORING:', msg)
+            return
+
+        parts = msg.split(':')
+        if len(parts) != 2:
+            log('Malformed message:', parts)
+            return
+
+        cmd, payload = parts
+        if cmd == 'DEF':
+            # Sim is defining a short ID for a variable name
+            varName, varID = payload.split('=')
+            self.idToVarNames[varID] = varName
+            if varName not in self.varToValues:
+                self.pendingVars.add(varName)
+        elif cmd in ('VF', 'VS'):
+            # Sim is giving us an updated value for a float or string variable
+            varID, value = payload.split('=')
+            varName = self.idToVarNames.get(varID)
+            if varName is None:
+                log('Value for undefined variable ID:', msg) # (its DEF was lost or hasn't arrived yet)
+                return
+            self.SetVar(varName, float(value) if cmd == 'VF' else value)
+        else:
+            log('Unhandled message:', cmd, payload)
+
+    def SetVar(self, varName, value):
+        '''records the latest value of a sim variable, marking it as dirty if it changed'''
+        if self.varToValues.get(varName) != value:
+            self.varToValues[varName] = value
+            self.dirtyVars.add(varName)
+            self.pendingVars.discard(varName)
+
+    def AddReader(self, varNames, conn, definitionID):
+        '''records that the given data definition of the given ConnectionHandler reads the given sim variables (or,
+        if varNames is None, could read any of them)'''
+        for varName in (varNames if varNames is not None else [None]):
+            self.varReaders.setdefault(varName, set()).add((conn, definitionID))
+
+    def RemoveReaders(self, conn):
+        '''forgets everything the given ConnectionHandler reads'''
+        for varName, readers in list(self.varReaders.items()):
+            readers.difference_update([r for r in readers if r[0] is conn])
+            if not readers:
+                del self.varReaders[varName]
+
+    def PushChanges(self):
+        '''lets each connection know which of its data definitions read variables that have changed since the last
+        call, so it can send out any data requested only when it changes right away instead of on the next tick'''
+        if not self.dirtyVars:
+            return
+        touched = {} # ConnectionHandler -> set of definition IDs
+        for varName in self.dirtyVars:
+            for conn, definitionID in self.varReaders.get(varName, ()):
+                touched.setdefault(conn, set()).add(definitionID)
+        for conn, definitionID in self.varReaders.get(None, ()):
+            touched.setdefault(conn, set()).add(definitionID)
+        self.dirtyVars.clear()
+        for conn, definitionIDs in touched.items():
+            try:
+                conn.OnInputsChanged(definitionIDs, self.varToValues)
+            except:
+                logTB()
+                log('Failed to push changes to', conn.handlerID, '- dropping the connection')
+                conn.Close()
 
     def SimSend(self, msg):
         '''use this to send a message to the flight sim'''
-        self.outgoingMessages.append(msg)
+        self.sendSock.sendto(msg.encode('utf8'), self.destAddr)
 
     def IsPaused(self):
         '''returns True if sim is paused'''
@@ -171,7 +225,7 @@ class FlyInsideConnector:
             except:
                 logTB()
                 log('Failed to tick', handlerID, '- dropping the connection')
-                del self.scConnections[handlerID]
+                conn.Close()
 
         nowPaused = self.IsPaused()
         if nowPaused != self.lastPaused:
@@ -194,7 +248,7 @@ class FlyInsideConnector:
             except:
                 logTB()
                 log('Failed to deliver sim event', eventName, 'to', handlerID, '- dropping the connection')
-                del self.scConnections[handlerID]
+                conn.Close()
 
 class PriorityGroup:
     '''a group of events at a certain priority (used for notification groups and input event mapping)'''
@@ -263,6 +317,36 @@ def ValueToBytes(v, dataType):
     # DATATYPE_WSTRING260,     # 260 character wide string
     # DATATYPE_WSTRINGV) =range(28) # variable-length wide string
 
+# SC.DATATYPE -> struct format for the data types we can put in an SSimObjectData frame (the same ones that
+# ValueToBytes supports)
+DT = SC.DATATYPE
+VALUE_FORMATS = {
+    DT.INT32: 'i', DT.INT64: 'q', DT.FLOAT32: 'f', DT.FLOAT64: 'd',
+    DT.STRING8: '8s', DT.STRING32: '32s', DT.STRING64: '64s', DT.STRING128: '128s', DT.STRING256: '256s', DT.STRING260: '260s',
+}
+STRING_TYPES = {DT.STRING8, DT.STRING32, DT.STRING64, DT.STRING128, DT.STRING256, DT.STRING260}
+NUMPY_TYPES = {DT.INT32: '<i4', DT.INT64: '<i8', DT.FLOAT32: '<f4', DT.FLOAT64: '<f8'} # the numeric ones, for NumericValues
+NUMPY_MIN_DATUMS = 32 # smaller definitions are faster without NumPy (its per-call overhead outweighs what it saves)
+INT_RANGES = {DT.INT32: (-2**31, 2**31 - 1), DT.INT64: (-2**63, 2**63 - 1024)} # (the latter is the biggest double that fits)
+FLOAT32_OVERFLOW = (2 - 2**-24) * 2**127 # doubles at least this big round to infinity as floats
+del DT
+
+def _ToFloat(value):
+    '''float(value), or None if it isn't a number (e.g. a string the sim sent for a numeric variable)'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def Reads(*varNames):
+    '''decorator for the spoofing functions in FSX_FFS_MAP that declares which FFS variables they read, so that
+    requests for their values get re-evaluated when those change. Undeclared ones are assumed to read anything.'''
+    def Decorate(func):
+        func.inputs = varNames
+        return func
+    return Decorate
+
+@Reads('Aircraft.Status.OnGround', 'Aircraft.Position.GroundSpeed.Value')
 def SpoofCenterWheelRPM(varValues, units):
     rpm = 0
     if varValues['Aircraft.Status.OnGround']:
@@ -273,6 +357,7 @@ def SpoofCenterWheelRPM(varValues, units):
         rpm = revsPerSec * 60.0
     return rpm
 
+@Reads()
 def SpoofAirplaneName(varValues, units):
     return 'Alabeo Extra 300s Halcones'
 
@@ -343,28 +428,9 @@ OLD_MAP = {
     '':'SimState.Paused',
 }
 
-def ConvertValue(ffsName, ffsVal, ffsUnits, fsxUnits):
-    '''Given a value from FlyInside and in the given units, convert it to the given FSX units'''
-    # TODO: rewrite this to be less lame - maybe look up a converter func once on startup?
-    ffsUnits = (ffsUnits or '').strip().lower()
-    fsxUnits = (fsxUnits or '').strip().lower()
-    if ffsUnits == fsxUnits:
-        return ffsVal
-    if ffsUnits == 'meters per second' and fsxUnits == 'knots':
-        return ffsVal * 1.94384
-    if (ffsUnits == 'radians' and fsxUnits == 'degrees') or (ffsUnits == 'radians per second' and fsxUnits == 'degrees per second'):
-        return ffsVal * 57.2958
-    if ffsUnits == 'meters' and fsxUnits == 'feet':
-        return ffsVal * 3.28084
-    if ffsUnits == 'meters per second' and fsxUnits == 'feet per minute':
-        return ffsVal * 196.8504
-    if ffsUnits == 'percent' and fsxUnits == 'bool':
-        return ffsVal > 0 # should this be != 0 instead? right now just using it for gear lever down, mapping 100.0 --> true
-
-    log('CONVERT:', ffsName, repr((ffsVal, ffsUnits, fsxUnits)))
-
 class DataDefinitionEntry:
-    '''one item of info a in a data definition'''
+    '''one item of info a in a data definition. Raises units.UnitsError if the requested units can't be
+    converted to from the units FFS uses for the variable, or NotImplementedError for data types we can't send.'''
     def __init__(self, msg):
         self.fsxName = msg.datumName.lower()
         self.ffsName, self.ffsUnits, self.defaultValue = FSX_FFS_MAP[self.fsxName]
@@ -373,6 +439,23 @@ class DataDefinitionEntry:
         self.epsilon = msg.epsilon
         self.datumID = msg.datumID
         self.prevValue = None # for detecting when data has changed
+        self.convert = units.Identity # converts values from FFS units to self.units
+        self.inputs = () # names of the FFS variables the value comes from (None if it could be any of them)
+        if isinstance(self.ffsName, str):
+            self.convert = units.Converter(self.ffsUnits, self.units)
+            self.inputs = (self.ffsName,)
+        elif callable(self.ffsName):
+            self.inputs = getattr(self.ffsName, 'inputs', None)
+        fmt = VALUE_FORMATS.get(self.type)
+        if fmt is None:
+            raise NotImplementedError('No support yet for data type %r' % self.type)
+        self.valueStruct = struct.Struct('<' + fmt) # for the untagged format
+        self.taggedStruct = struct.Struct('<L' + fmt) # for the tagged format, i.e. prefixed with the datumID
+        self.isString = self.type in STRING_TYPES
+        self.intRange = INT_RANGES.get(self.type) # (min, max) for integer datums, else None
+        self.isFloat32 = fmt == 'f'
+        if not self.isString:
+            self.defaultValue = self.ToDatum(self.defaultValue, 0)
 
     def ExtractValue(self, varValues):
         '''Extracts the current value from the given set of values, returning None if the value is not
@@ -380,11 +463,47 @@ class DataDefinitionEntry:
         if callable(self.ffsName):
             # A total (and hopefully temporary) hack: if ffsName is actually a function, it's a way for us
             # to fabricate values that FFS doesn't yet provide
-            return self.ffsName(varValues, self.units)
-        if not self.ffsName in varValues:
+            try:
+                value = self.ffsName(varValues, self.units)
+            except (TypeError, ValueError):
+                return self.defaultValue # (e.g. it got a string where it expected a number)
+        elif not self.ffsName in varValues:
             return self.defaultValue
-        ffsVal = varValues[self.ffsName]
-        return ConvertValue(self.ffsName, ffsVal, self.ffsUnits, self.units)
+        elif self.isString:
+            return self.convert(varValues[self.ffsName])
+        else:
+            value = _ToFloat(varValues[self.ffsName])
+            if value is None:
+                return self.defaultValue
+            value = self.convert(value)
+        return value if self.isString else self.ToDatum(value)
+
+    def ToDatum(self, value, default=None):
+        '''applies the rule for what gets sent for a numeric datum (NumericValues.Extract applies the same one to whole
+        arrays): anything that isn't a number becomes the default, and for integer datums, so do NaN and infinities,
+        while other values get rounded to the nearest integer (ties to even) and clamped to the datum's range. Floats
+        too big for a 32-bit float datum become infinite. Bools are left as they are. default overrides
+        self.defaultValue.'''
+        if type(value) is bool:
+            return value
+        value = _ToFloat(value)
+        if value is None or (self.intRange is not None and not math.isfinite(value)):
+            return self.defaultValue if default is None else default
+        if self.intRange is None:
+            if self.isFloat32 and abs(value) >= FLOAT32_OVERFLOW:
+                return math.copysign(math.inf, value) # (as NumPy casts it, where struct would refuse)
+            return value
+        lo, hi = self.intRange
+        return min(max(round(value), lo), hi)
+
+    def HasInputs(self, varValues, pendingVars):
+        '''returns True if the sim has sent everything the value comes from, given the current set of values and the
+        names of the variables the sim has defined but not yet sent'''
+        if self.inputs is None:
+            return not pendingVars
+        if callable(self.ffsName):
+            return all(name in varValues for name in self.inputs) # (spoofing functions index varValues directly)
+        return self.ffsName not in pendingVars # (variables the sim doesn't have at all just use the default)
 
     def HasChanged(self, extractedValue):
         '''Using a value from ExtractValue, returns True if the value has changed (taking into account
@@ -402,98 +521,456 @@ class DataDefinitionEntry:
             changed = extractedValue != self.prevValue
         return changed
 
-    def GenValue(self, taggedFormat, force, varValues):
-        '''Returns a binary blob for a SSimObjectData message. If taggedFormat is True, returns the value
-        in tagged format (i.e. prefixed with the datumID). Updates self.prevValue before returning.'''
-        cur = self.ExtractValue(varValues)
-        if not force and not self.HasChanged(cur):
+class NumericValues:
+    '''NumPy-backed values for a data definition whose datums are all numbers. The current values, previous values
+    and epsilons live in arrays, so extracting, change detection and packing (see ObjectDataFrame.WriteArray) each
+    take a few vectorized operations rather than a pass over the entries. Like DataDefinitionEntry.prevValue, the
+    previous values belong to the definition, so they're shared by every request that uses it.'''
+    @staticmethod
+    def ForEntries(entries):
+        '''returns a NumericValues for the given list of DataDefinitionEntry objects, or None if NumPy isn't available
+        or the definition can't use one or is too small to benefit (so the entries should be used directly)'''
+        if not GV.useNumPy or len(entries) < NUMPY_MIN_DATUMS or not all(dde.type in NUMPY_TYPES for dde in entries):
             return None
+        return NumericValues(entries)
+
+    def __init__(self, entries):
+        n = self.numEntries = len(entries)
+        self.entries = entries
+        self.cur = np.zeros(n) # most recently extracted values
+        self.prev = np.zeros(n) # last values accepted (sent), where known is True
+        self.known = np.zeros(n, bool)
+        self.allKnown = False
+        self.epsilons = np.array([dde.epsilon for dde in entries], float)
+        names = [] # FFS variables read directly...
+        varIdx = [] # ...the entries they're for...
+        scaling = [] # ...and the (scale, shift) for converting them
+        self.others = [] # indices of entries that need ExtractValue (spoofed or non-linear conversions)
+        for i, dde in enumerate(entries):
+            if dde.prevValue is not None:
+                self.prev[i] = dde.prevValue
+                self.known[i] = True
+            if dde.ffsName is None:
+                self.cur[i] = dde.defaultValue # (never changes)
+                continue
+            sc = units.Scaling(dde.ffsUnits, dde.units) if isinstance(dde.ffsName, str) else None
+            if sc is None:
+                self.others.append(i)
+                if dde.convert is not units.Identity:
+                    self.epsilons[i] = 0 # (bools are compared exactly)
+            else:
+                names.append(dde.ffsName)
+                varIdx.append(i)
+                scaling.append(sc)
+        self.names = names
+        self.nans = [math.nan] * len(names) # (what missing variables read as)
+        self.varIdx = np.array(varIdx, int)
+        if varIdx == list(range(n)):
+            self.varIdx = slice(None) # (cheaper to assign to)
+        self.scales, self.shifts = np.array(scaling, float).reshape(-1, 2).T
+        self.shifted = self.shifts != 0 # (adding a zero shift would turn -0.0 into 0.0)
+        if not self.shifted.any():
+            self.shifted = None
+        self.ids = np.array([dde.datumID for dde in entries], np.uint32)
+        self.typeCodes = [NUMPY_TYPES[dde.type] for dde in entries]
+        intIdx = [i for i, dde in enumerate(entries) if dde.intRange is not None] # (see DataDefinitionEntry.ToDatum)
+        self.intIdx = np.array(intIdx, int) if intIdx else None
+        if intIdx:
+            self.intMins, self.intMaxes = np.array([entries[i].intRange for i in intIdx], float).T
+            self.intDefaults = np.array([entries[i].defaultValue for i in intIdx], float)
+        f32Idx = [i for i, dde in enumerate(entries) if dde.isFloat32]
+        self.f32Idx = np.array(f32Idx, int) if f32Idx else None
+
+    def IsFor(self, entries):
+        return entries is self.entries and len(entries) == self.numEntries
+
+    def Extract(self, varValues):
+        '''extracts the current values (converted as needed) from the given set of values into self.cur, and
+        returns it'''
+        cur = self.cur
+        entries = self.entries
+        n = self.numEntries
+        if self.names:
+            try:
+                raw = np.fromiter(map(varValues.get, self.names, self.nans), float, len(self.names))
+            except (TypeError, ValueError):
+                # Something that isn't a number, which reads as missing so that ExtractValue sends the default
+                raw = np.array([_ToFloat(v) for v in map(varValues.get, self.names, self.nans)], float) # (None -> NaN)
+            values = raw * self.scales
+            if self.shifted is not None:
+                np.add(values, self.shifts, out=values, where=self.shifted)
+            cur[self.varIdx] = values
+            missing = np.isnan(raw)
+            if missing.any():
+                for i in np.arange(n)[self.varIdx][missing].tolist():
+                    cur[i] = entries[i].ExtractValue(varValues) # (the default, unless the value really is NaN)
+        for i in self.others:
+            cur[i] = entries[i].ExtractValue(varValues)
+        if self.intIdx is not None:
+            # Same rule as DataDefinitionEntry.ToDatum, so that casting to the integer types in WriteArray is exact
+            ints = cur[self.intIdx]
+            bad = ~np.isfinite(ints)
+            ints = np.clip(np.rint(ints), self.intMins, self.intMaxes)
+            if bad.any():
+                ints[bad] = self.intDefaults[bad]
+            cur[self.intIdx] = ints
+        if self.f32Idx is not None:
+            floats = cur[self.f32Idx]
+            big = np.abs(floats) >= FLOAT32_OVERFLOW
+            if big.any():
+                cur[self.f32Idx[big]] = np.copysign(np.inf, floats[big])
+        return cur
+
+    def Changed(self):
+        '''returns a mask of which of the current values differ from the previous ones by more than their epsilon'''
+        with np.errstate(invalid='ignore'): # (inf - inf is NaN, which isn't a change, just as in HasChanged)
+            changed = np.abs(self.cur - self.prev) > self.epsilons
+        if not self.allKnown:
+            changed |= ~self.known
+        return changed
 
-        self.prevValue = cur
-        ret = bytearray()
-        if taggedFormat:
-            # Tagged format is datumID (as a 4B value) + data
-            ret.extend(struct.pack('<L', self.datumID))
-        ret.extend(ValueToBytes(cur, self.type))
-        return ret
+    def Accept(self, which=None):
+        '''makes the current values (or just those at the indices in which) the previous ones'''
+        if which is None:
+            self.prev[:] = self.cur
+            self.known[:] = True
+        else:
+            self.prev[which] = self.cur[which]
+            if not self.allKnown:
+                self.known[which] = True
+        if not self.allKnown:
+            self.allKnown = self.known.all()
+
+    def StoreBack(self):
+        '''copies the previous values back to the entries' prevValue, e.g. when the definition has changed'''
+        for i in np.flatnonzero(self.known).tolist():
+            self.entries[i].prevValue = self.prev[i].item()
+
+OBJDATA_HEADER = struct.Struct('<LLL7L') # server message header + the fixed SSimObjectData fields
+OBJDATA_SIZE_OFFSET = 0
+OBJDATA_COUNT_OFFSET = OBJDATA_HEADER.size - 4 # defineCount is the last fixed field
+UINT32 = struct.Struct('<L')
+_UNSET = object() # marks a slot in an ObjectDataFrame that hasn't been written yet
+
+class ObjectDataFrame:
+    '''A preallocated SSimObjectData frame for an ObjectDataRequest, with the header and fixed fields already laid
+    out. When every datum is sent, each one lives at a fixed offset and is re-packed only when its value changes.
+    When only some are sent (tagged format, only when changed) they're packed one after another instead.'''
+    def __init__(self, req, entries, protocol):
+        self.entries = entries # the list of DataDefinitionEntry objects this was laid out for...
+        self.numEntries = len(entries) # ...and how many there were at the time
+        self.protocol = protocol
+        self.tagged = req.taggedFormat
+        self.structs = [dde.taggedStruct if self.tagged else dde.valueStruct for dde in entries]
+        self.offsets = [] # fixed offset of each datum when they're all sent
+        pos = OBJDATA_HEADER.size
+        for st in self.structs:
+            self.offsets.append(pos)
+            pos += st.size
+        self.fullSize = pos
+        self.buf = bytearray(self.fullSize)
+        self.view = memoryview(self.buf)
+        self.written = [_UNSET] * len(entries) # value currently packed at each fixed offset
+        OBJDATA_HEADER.pack_into(self.buf, 0, self.fullSize, protocol, message.SSimObjectData.code, req.requestID, req.objectID,
+                                 req.definitionID, req.flags, 1, 1, len(entries))
+        self.size = self.fullSize # size (and layout) the buffer currently has
+        self.groups = None # for WriteArray/WriteSomeArray, see _LayOutGroups
+
+    def IsFor(self, entries, protocol):
+        '''returns True if this frame's layout is still right for the given entries and protocol'''
+        return entries is self.entries and len(entries) == self.numEntries and protocol == self.protocol
+
+    def WriteAll(self, values):
+        '''updates the frame to hold a value for every datum, returning a view of the frame'''
+        buf = self.buf
+        written = self.written
+        if self.size != self.fullSize:
+            UINT32.pack_into(buf, OBJDATA_SIZE_OFFSET, self.fullSize)
+            UINT32.pack_into(buf, OBJDATA_COUNT_OFFSET, self.numEntries)
+            self.size = self.fullSize
+        for i, v in enumerate(values):
+            if v and v == written[i] and type(v) is type(written[i]):
+                continue # already there (zeros always get re-packed since 0.0 == -0.0)
+            written[i] = v
+            dde = self.entries[i]
+            if dde.isString:
+                v = v.encode('utf-8')
+            if self.tagged:
+                self.structs[i].pack_into(buf, self.offsets[i], dde.datumID, v)
+            else:
+                self.structs[i].pack_into(buf, self.offsets[i], v)
+        return self.view
+
+    def WriteSome(self, indexedValues):
+        '''updates the (tagged) frame to hold just the given (index, value) pairs, returning a view of the frame'''
+        buf = self.buf
+        pos = OBJDATA_HEADER.size
+        for i, v in indexedValues:
+            dde = self.entries[i]
+            if dde.isString:
+                v = v.encode('utf-8')
+            st = self.structs[i]
+            st.pack_into(buf, pos, dde.datumID, v)
+            pos += st.size
+        UINT32.pack_into(buf, OBJDATA_SIZE_OFFSET, pos)
+        UINT32.pack_into(buf, OBJDATA_COUNT_OFFSET, len(indexedValues))
+        self.size = pos
+        self.written = [_UNSET] * self.numEntries # (the fixed slots got overwritten)
+        return self.view[:pos]
+
+    # The NumPy versions of WriteAll and WriteSome, for use with NumericValues. A frame is only ever written with one
+    # set of methods or the other, since both are tied to the (unchanging) types of the entries it was laid out for.
+    def _LayOutGroups(self, nv):
+        '''groups the datums by type, since each group can be packed in one go as an array of (datumID, value)
+        records (or just values, if untagged), and then copied into place'''
+        self.u8 = np.frombuffer(self.buf, np.uint8)
+        self.groups = []
+        self.recSizes = np.zeros(self.numEntries, int) # size of each datum's record
+        self.groupOf = np.zeros(self.numEntries, int) # which group each datum is in
+        offsets = np.array(self.offsets, int)
+        for typeCode in sorted(set(nv.typeCodes)):
+            idx = np.array([i for i, t in enumerate(nv.typeCodes) if t == typeCode], int)
+            recDtype = np.dtype([('id', '<u4'), ('v', typeCode)] if self.tagged else [('v', typeCode)])
+            recs = np.zeros(len(idx), recDtype) # what's at the datums' fixed offsets
+            if self.tagged:
+                recs['id'] = nv.ids[idx]
+            byteSpan = np.arange(recDtype.itemsize)
+            scatter = (offsets[idx][:, None] + byteSpan).ravel() # where the bytes of recs go in the frame
+            if (np.diff(scatter) == 1).all():
+                scatter = slice(int(scatter[0]), int(scatter[-1]) + 1) # (all of a kind, all in a row)
+            self.recSizes[idx] = recDtype.itemsize
+            self.groupOf[idx] = len(self.groups)
+            self.groups.append((idx, recs, scatter, recDtype, byteSpan))
+
+    def WriteArray(self, nv):
+        '''like WriteAll, but for the current values in the given NumericValues'''
+        if self.groups is None:
+            self._LayOutGroups(nv)
+        if self.size != self.fullSize:
+            UINT32.pack_into(self.buf, OBJDATA_SIZE_OFFSET, self.fullSize)
+            UINT32.pack_into(self.buf, OBJDATA_COUNT_OFFSET, self.numEntries)
+            self.size = self.fullSize
+        cur = nv.cur
+        u8 = self.u8
+        for idx, recs, scatter, recDtype, byteSpan in self.groups:
+            recs['v'] = cur[idx]
+            u8[scatter] = recs.view(np.uint8)
+        return self.view
+
+    def WriteSomeArray(self, nv, which):
+        '''like WriteSome, but for the current values at the given (ascending) indices in the given NumericValues'''
+        if self.groups is None:
+            self._LayOutGroups(nv)
+        cur = nv.cur
+        u8 = self.u8
+        if len(self.groups) == 1:
+            idx, recs, scatter, recDtype, byteSpan = self.groups[0]
+            pos = OBJDATA_HEADER.size + len(which) * recDtype.itemsize
+            recs = np.empty(len(which), recDtype)
+            recs['id'] = nv.ids[which]
+            recs['v'] = cur[which]
+            u8[OBJDATA_HEADER.size:pos] = recs.view(np.uint8)
+        else:
+            recSizes = self.recSizes[which]
+            ends = np.cumsum(recSizes) + OBJDATA_HEADER.size
+            pos = int(ends[-1])
+            groupOf = self.groupOf[which]
+            starts = ends - recSizes
+            for g, (idx, recs, scatter, recDtype, byteSpan) in enumerate(self.groups):
+                mask = groupOf == g
+                sel = which[mask]
+                if not len(sel):
+                    continue
+                recs = np.empty(len(sel), recDtype)
+                recs['id'] = nv.ids[sel]
+                recs['v'] = cur[sel]
+                u8[(starts[mask][:, None] + byteSpan).ravel()] = recs.view(np.uint8)
+        UINT32.pack_into(self.buf, OBJDATA_SIZE_OFFSET, pos)
+        UINT32.pack_into(self.buf, OBJDATA_COUNT_OFFSET, len(which))
+        self.size = pos
+        return self.view[:pos]
 
 class ObjectDataRequest:
     def __init__(self, msg):
-        # warn on not implemented stuff that is probably ok
-        if msg.limit != 0: log('WARNING: ignoring limit in', msg)
         self.requestID = msg.requestID
         self.objectID = msg.objectID
         self.definitionID = msg.definitionID
         self.period = msg.period
-        self.interval = msg.interval
+        self.origin = msg.origin # periods to wait before the first send
+        self.interval = msg.interval # periods to skip between sends
+        self.sendsLeft = msg.limit or None # how many more times to send data (None for no limit)
         self.flags = msg.flags
-        self.sendCountdown = msg.origin # wait this many more times before sending it again
         self.taggedFormat = not not (msg.flags & SC.DATA_REQUEST_FLAG.TAGGED) # return values in tagged format?
         self.onlyWhenChanged = not not (msg.flags & SC.DATA_REQUEST_FLAG.CHANGED) # send always or only if it changed?
         self.lastSent = None # timestamp of when we last fulfilled the request
-
-    def CountdownInterval(self):
-        '''called to give the data request a chance to count down according to its send interval. Returns False if
-        it needs to wait longer before its next time to send.'''
-        if self.sendCountdown > 0:
-            self.sendCountdown -= 1
-            return False
-        self.sendCountdown = self.interval
-        return True
-
-    def Due(self):
-        '''Returns True if it's time to send data for this request again'''
-        if self.period == SC.PERIOD.NEVER:
-            return False # does this ever happen?
-        if self.lastSent is None:
-            return True
-        if self.period == SC.PERIOD.SECOND:
-            return time.time() - self.lastSent >= 1.0
-        return True
-
-    def GenMessage(self, varValues, dataDefEntries):
-        '''Creates a message to send to the client with the requested data. Returns (msg, finished), where
-        finished is True if this data request is done and can be erased from the list of active data requests.
-        varValues is a mapping of the most recent sim variable values and dataDefEntries is a list of DataDefinitionEntry
-        objects. Returns None if '''
+        self.frame = None # ObjectDataFrame we build our messages in
+        self.dueFrame = None # sim frame the RequestScheduler will run this on next, or None if it's not scheduled
+        self.stale = True # (if onlyWhenChanged) False if nothing the definition reads has changed since we last looked
+        # send changes as soon as the sim reports them rather than on the next frame? (see ConnectionHandler.OnInputsChanged)
+        self.pushChanges = self.onlyWhenChanged and self.period in (SC.PERIOD.SIM_FRAME, SC.PERIOD.VISUAL_FRAME) and self.interval == 0
+
+    def GenFrame(self, varValues, dataDefEntries, protocol, numeric=None):
+        '''Fills in this request's SSimObjectData frame with the requested data. Returns (frame, finished), where frame
+        is a memoryview of the bytes to send (or None if there's nothing to send) and finished is True if this data
+        request is done (e.g. has been sent its limit of times) and can be erased from the list of active data
+        requests. varValues is a mapping of the most recent sim variable values and dataDefEntries is a list of
+        DataDefinitionEntry objects. numeric is the definition's NumericValues, if it has one. The frame is only
+        valid until the next call.'''
         self.lastSent = time.time()
-        finished = (self.period in (SC.PERIOD.NEVER, SC.PERIOD.ONCE)) # TODO: add support for limit
-        entries = []
-
-        # There is some complexity around what we return. We've already checked self.Due() by now, so rules around
-        # when to apply stuff have already been applied for the most part, but if self.onlyWhenChanged is set, then
+        frame = self.BuildFrame(varValues, dataDefEntries, protocol, numeric)
+        if frame is not None and self.sendsLeft is not None:
+            self.sendsLeft -= 1
+        finished = self.period in (SC.PERIOD.NEVER, SC.PERIOD.ONCE) or self.sendsLeft == 0
+        return frame, finished
+
+    def BuildFrame(self, varValues, dataDefEntries, protocol, numeric):
+        '''used by GenFrame to fill in the frame, returning it or None if there's nothing to send'''
+        if self.onlyWhenChanged:
+            if not self.stale:
+                return None # (none of the inputs have changed, so none of the values can have)
+            self.stale = False
+        frame = self.frame
+        if frame is None or not frame.IsFor(dataDefEntries, protocol):
+            frame = self.frame = ObjectDataFrame(self, dataDefEntries, protocol)
+        if numeric is not None:
+            return self.GenNumericFrame(varValues, numeric, frame)
+
+        # There is some complexity around what we return. The scheduler has already decided that it's time, so rules
+        # around when to apply stuff have already been applied for the most part, but if self.onlyWhenChanged is set, then
         # we send only the values that have changed. Except that if the data isn't being sent back in tagged format, then
         # if self.onlyWhenChanged is set and at least one entry has changed, then we send them all back.
-        if self.onlyWhenChanged and not self.taggedFormat:
+        values = [dde.ExtractValue(varValues) for dde in dataDefEntries]
+        if not self.onlyWhenChanged:
+            for dde, cur in zip(dataDefEntries, values):
+                dde.prevValue = cur
+            return frame.WriteAll(values)
+
+        if not self.taggedFormat:
             # The special case: we're not using tagged format, so it's all or nothing, so we send them all back if
-            # at least one entry changed, otherwise we send back nothing. So first check to see if any changed.
-            anyChanged = False
-            for dde in dataDefEntries:
-                cur = dde.ExtractValue(varValues)
+            # at least one entry changed, otherwise we send back nothing.
+            for dde, cur in zip(dataDefEntries, values):
                 if dde.HasChanged(cur):
-                    anyChanged = True
                     break
-
-            # If any changed, make them all generate new values
-            if anyChanged:
-                for dde in dataDefEntries:
-                    entry = dde.GenValue(False, True, varValues)
-                    if entry is not None:
-                        entries.append(entry)
-        else:
-            for dde in dataDefEntries:
-                entry = dde.GenValue(self.taggedFormat, not self.onlyWhenChanged, varValues)
-                if entry is not None:
-                    entries.append(entry)
-
-        if not entries:
-            return None, finished
-
-        msg = message.SSimObjectData(requestID=self.requestID, objectID=self.objectID, definitionID=self.definitionID,
-                                     entryNumber=1, outOf=1, flags=self.flags)
-        msg.data = b''.join(entries)
-        msg.defineCount = len(entries)
-        return msg, finished
+            else:
+                return None
+            for dde, cur in zip(dataDefEntries, values):
+                dde.prevValue = cur
+            return frame.WriteAll(values)
+
+        changed = []
+        for i, (dde, cur) in enumerate(zip(dataDefEntries, values)):
+            if dde.HasChanged(cur):
+                dde.prevValue = cur
+                changed.append((i, cur))
+        if not changed:
+            return None
+        if len(changed) == len(values):
+            return frame.WriteAll(values)
+        return frame.WriteSome(changed)
+
+    def GenNumericFrame(self, varValues, nv, frame):
+        '''BuildFrame for a definition with NumericValues: the same rules, applied to whole arrays at a time. Returns
+        the frame to send or None.'''
+        nv.Extract(varValues)
+        if not self.onlyWhenChanged:
+            nv.Accept()
+            return frame.WriteArray(nv)
+        changed = nv.Changed()
+        if not self.taggedFormat:
+            if not changed.any():
+                return None
+            nv.Accept()
+            return frame.WriteArray(nv)
+        which = np.flatnonzero(changed)
+        if not len(which):
+            return None
+        nv.Accept(which)
+        if len(which) == nv.numEntries:
+            return frame.WriteArray(nv)
+        return frame.WriteSomeArray(nv, which)
+
+class RequestScheduler:
+    '''Runs ObjectDataRequests when they're due. FFS doesn't tell us when it runs a sim frame, so time is divided into
+    frames at a fixed frameRate, and each request is due on a frame number that follows from its period, origin and
+    interval (a SECOND is frameRate frames). Scheduled requests are kept in a heap keyed by the frame they're due on,
+    with a single reactor timer armed for the earliest one, so each frame costs only as much as the requests that
+    are due on it, and requests that are due on the same frame go out together.'''
+    def __init__(self, reactor, frameRate):
+        self.reactor = reactor
+        self.frameRate = frameRate # sim frames per second
+        self.epoch = time.monotonic() # when frame 0 was
+        self.heap = [] # (frame, seq, ConnectionHandler, ObjectDataRequest), plus leftovers that RunDue skips
+        self.seq = itertools.count() # tie breaker so requests due on the same frame run in the order they were scheduled
+        self.timer = None # reactor timer for the earliest frame in the heap...
+        self.timerFrame = None # ...and that frame
+
+    def Close(self):
+        if self.timer is not None:
+            self.timer.Cancel()
+
+    def CurrentFrame(self):
+        return int((time.monotonic() - self.epoch) * self.frameRate + 1e-6) # (so a timer that fires right on time isn't a frame behind)
+
+    def PeriodFrames(self, period):
+        '''returns the length of the given SC.PERIOD in frames'''
+        if period == SC.PERIOD.SECOND:
+            return max(1, int(round(self.frameRate)))
+        return 1 # (VISUAL_FRAME is the same as SIM_FRAME for us, and ONCE doesn't repeat)
+
+    def Start(self, conn, dr):
+        '''schedules the first run of a new request, origin periods from now'''
+        self.Schedule(conn, dr, self.CurrentFrame() + dr.origin * self.PeriodFrames(dr.period))
+
+    def Schedule(self, conn, dr, frame):
+        '''schedules the given request of the given ConnectionHandler to run on the given frame'''
+        dr.dueFrame = frame
+        heapq.heappush(self.heap, (frame, next(self.seq), conn, dr))
+        if self.timerFrame is None or frame < self.timerFrame:
+            self.ArmTimer()
+
+    def Unschedule(self, dr):
+        dr.dueFrame = None # (RunDue skips its entry in the heap)
+
+    def ArmTimer(self):
+        if self.timer is not None:
+            self.timer.Cancel()
+        self.timer = self.timerFrame = None
+        if self.heap:
+            self.timerFrame = frame = self.heap[0][0]
+            self.timer = self.reactor.CallLater(max(0, self.epoch + frame / self.frameRate - time.monotonic()), self.RunDue)
+
+    def RunDue(self):
+        '''called by the reactor timer to run every request that's due and schedule each one's next run'''
+        self.timer = self.timerFrame = None
+        now = self.CurrentFrame()
+        heap = self.heap
+        conns = set() # connections we sent something to
+        while heap and heap[0][0] <= now:
+            frame, seq, conn, dr = heapq.heappop(heap)
+            if dr.dueFrame != frame:
+                continue # unscheduled since
+            dr.dueFrame = None
+            try:
+                if not conn.RunRequest(dr):
+                    continue # finished
+            except:
+                logTB()
+                log('Failed to run data request', dr.requestID, 'for', conn.handlerID, '- dropping the connection')
+                conn.Close()
+                conns.discard(conn)
+                continue
+            conns.add(conn)
+            if dr.pushChanges and dr.lastSent is not None:
+                continue # (from now on it runs when its inputs change, see ConnectionHandler.OnInputsChanged)
+            step = (dr.interval + 1) * self.PeriodFrames(dr.period)
+            frame += step
+            if frame <= now:
+                frame += ((now - frame) // step + 1) * step # (skip the runs we're too late for rather than bunching them up)
+            dr.dueFrame = frame
+            heapq.heappush(heap, (frame, next(self.seq), conn, dr))
+        for conn in conns:
+            conn.client.Flush()
+        self.ArmTimer()
 
 # names of official FSX events that either (a) we support or (b) have no intention of supporting anytime soon
 # (this list exists to help call out when a SimConnect client uses an event we haven't implemented support for)
@@ -517,9 +994,9 @@ class ConnectionHandler:
     def Create(connNum, sock, fic):
         c = ConnectionHandler(connNum, sock, fic)
         fic.scConnections[connNum] = c
-        t = threading.Thread(target=c.Handle)
-        t.daemon = True
-        t.start()
+        if fic.capWriter is not None:
+            c.client.SetCapture(fic.capWriter, connNum)
+        fic.reactor.AddConnection(c.client, c.Dispatch, c.OnClosed)
         return c
 
     def __init__(self, connNum, sock, fic):
@@ -529,68 +1006,57 @@ class ConnectionHandler:
         self.fic = fic
         self.protocol = -1
         self.dataDefs = {} # def ID --> [ items ]
+        self.numericDefs = {} # def ID --> NumericValues for its items, or None if it can't have one
+        self.readyDefs = set() # IDs of data defs whose inputs have all arrived from the sim (see InputsReady)
         self.simEventIDToName = {} # client event ID --> sim event name
         self.simEventNameToID = {} # sim event name -> client event ID
         self.notificationGroups = {} # client notification group ID -> PriorityGroup instance
         self.inputGroups = {} # client mapped input event group ID -> PrioritGroup instance
         self.activeDataRequests = [] # pending (and possibly repeating) requests from the sim for data
 
-    def Handle(self):
-        try:
-            while GV.keepRunning:
-                didWork = False
-
-                # Grab and dispatch messages from FSForce
-                msg = self.client.Recv()
-                if msg is not None:
-                    didWork = True
-                    handlerName = 'On' + msg.__class__.__name__
-                    handler = getattr(self, handlerName, None)
-                    if handler is None:
-                        log('ERROR: no handler for', handlerName)
-                        log('[%s]' % self.handlerID, msg)
-                        continue
-                    self.protocol = msg._protocol # really needed only once
-                    log('[%d]' % self.handlerID, msg)
-                    handler(msg)
-
-                # don't spin
-                if not didWork:
-                    time.sleep(0.05)
-        except connection.Closed as e:
-            log('Connection closed', e)
-
-    def Send(self, msg):
-        '''used by other methods to send a message to the client, setting the _protocol
-        member of the message first'''
-        msg._protocol = self.protocol
-        log('[%d]' % self.handlerID, msg)
-        self.client.Send(msg)
-
-    def Tick(self, varValues):
-        '''called periodically to see if we need to send any new messages to the client. varValues is a dict
-        of simVarName -> most recent value'''
-        keep = []
-        toDelete = []
+    def OnClosed(self, conn):
+        log('Connection closed', self.handlerID)
+        self.Close()
 
-        # Fire off any events for requested data
+    def Close(self):
+        '''drops the connection to the client'''
+        self.fic.RemoveReaders(self)
         for dr in self.activeDataRequests:
-            if not dr.CountdownInterval():
-                continue
-            if not dr.Due():
-                continue
+            self.fic.scheduler.Unschedule(dr)
+        self.fic.reactor.Remove(self.client)
+        self.client.sock.close()
+        self.fic.scConnections.pop(self.handlerID, None)
+
+    def Dispatch(self, msg):
+        '''routes a message from FSForce to the appropriate On<MessageClass> handler'''
+        handlerName = 'On' + msg.__class__.__name__
+        handler = getattr(self, handlerName, None)
+        if handler is None:
+            log('ERROR: no handler for', handlerName)
+            log('[%s]' % self.handlerID, msg)
+            return
+        self.protocol = msg._protocol # really needed only once
+        log('[%d]' % self.handlerID, msg)
+        handler(msg)
 
-            dataDefEntries = self.dataDefs.get(dr.definitionID)
-            if not dataDefEntries:
-                log('ERROR: no data def entries for dataDefinitionID', dr.id)
-                continue
+    def Send(self, msg, flush=False):
+        '''used by other methods to send a message to the client, setting the _protocol
+        member of the message first. If flush is True, the message is sent right away instead
+        of once the reactor sees that the socket is writable.'''
+        msg._protocol = self.protocol
+        log('[%d]' % self.handlerID, msg)
+        self.client.Send(msg, flush)
 
-            msg, finished = dr.GenMessage(varValues, dataDefEntries)
-            if finished:
-                toDelete.append(dr)
-            if msg is not None:
-                self.Send(msg)
+    def SendFrame(self, frame):
+        '''sends an already encoded message (e.g. from ObjectDataRequest.GenFrame) to the client. Not logged, since
+        these go out on every tick.'''
+        if self.client.capWriter is not None:
+            frame = bytes(frame) # (the capture writer holds on to it, but the caller will reuse the buffer)
+        self.client.SendBytes(frame)
 
+    def Tick(self, varValues):
+        '''called periodically to see if we need to send any new events to the client (requested data is sent by the
+        RequestScheduler instead). varValues is a dict of simVarName -> most recent value'''
         # Generate any mapped sim events - TODO: the method of mapping seems... hacky
         G = varValues.get
         self.GenSimEvent('axis_ailerons_set', G('Aircraft.Surfaces.Aileron.Left.Percent'), -163.84, 0, -16384, 16384) # -100 left / 100 right --> 16384 left / -16384 right
@@ -602,9 +1068,72 @@ class ConnectionHandler:
         self.GenInputEvent('joystick:0:xaxis', G('Aircraft.Input.Pitch'), 327.68, 0, -32767, 32768) # -100 fwd / 100 back --> -32k=fwd / 32k=back
         self.GenInputEvent('joystick:0:yaxis', G('Aircraft.Input.Roll'), 327.68, 0, -32767, 32768) # -100 left / 100 right --> -32k=left / 32k=right
 
-        # Remove any data requests that are now completely fulfilled
-        for dr in toDelete:
-            self.activeDataRequests.remove(dr)
+        # Push out everything we generated now rather than waiting for the reactor to get around to it
+        self.client.Flush()
+
+    def RunRequest(self, dr):
+        '''called by the RequestScheduler when the given request is due. Returns False if the request is finished
+        (and has been removed) or has already been rescheduled.'''
+        if not self.InputsReady(dr.definitionID):
+            # The sim is still sending its initial state, so try again on the next frame
+            scheduler = self.fic.scheduler
+            scheduler.Schedule(self, dr, scheduler.CurrentFrame() + 1)
+            return False
+        if self.SendData(dr, self.fic.varToValues):
+            self.RemoveRequest(dr)
+            return False
+        return True
+
+    def InputsReady(self, definitionID):
+        '''returns True once every variable the given data definition reads has arrived from the sim. Until then, its
+        values would be a mix of defaults and real values (and spoofing functions would fail on the missing ones).'''
+        if definitionID in self.readyDefs:
+            return True
+        fic = self.fic
+        if not fic.varToValues:
+            return False # startup, nothing has arrived yet
+        for dde in self.dataDefs.get(definitionID, ()):
+            if not dde.HasInputs(fic.varToValues, fic.pendingVars):
+                return False
+        self.readyDefs.add(definitionID)
+        return True
+
+    def RemoveRequest(self, dr):
+        self.activeDataRequests.remove(dr)
+        self.fic.scheduler.Unschedule(dr)
+
+    def SendData(self, dr, varValues):
+        '''sends the client whatever the given ObjectDataRequest calls for right now, returning True if the request
+        is now finished'''
+        dataDefEntries = self.dataDefs.get(dr.definitionID)
+        if not dataDefEntries:
+            log('ERROR: no data def entries for dataDefinitionID', dr.definitionID)
+            return False
+
+        numeric = self.numericDefs.get(dr.definitionID, _UNSET)
+        if numeric is _UNSET:
+            numeric = self.numericDefs[dr.definitionID] = NumericValues.ForEntries(dataDefEntries)
+
+        frame, finished = dr.GenFrame(varValues, dataDefEntries, self.protocol, numeric)
+        if frame is not None:
+            self.SendFrame(frame)
+        return finished
+
+    def OnInputsChanged(self, definitionIDs, varValues):
+        '''called by FlyInsideConnector when variables read by the data definitions with the given IDs have changed.
+        Requests for data only when it changes get re-evaluated, right away if they're for every frame (once they've
+        started and the sim has sent everything the definition reads), else when they're next due.'''
+        sent = False
+        for dr in list(self.activeDataRequests):
+            if not dr.onlyWhenChanged or dr.definitionID not in definitionIDs:
+                continue
+            dr.stale = True # (so if it can't go out yet, it does once the rest of its inputs arrive)
+            if dr.pushChanges and dr.lastSent is not None and self.InputsReady(dr.definitionID):
+                sent = True
+                if self.SendData(dr, varValues):
+                    self.RemoveRequest(dr)
+        if sent:
+            self.client.Flush()
 
     # Aircraft.Wheel.Left.Input.BrakeStrength - 0..100
     # Aircraft.Wheel.Right.Input.BrakeStrength - 0..100
@@ -703,7 +1232,30 @@ class ConnectionHandler:
             log('ERROR: unhandled system state request', msg)
 
     def OnCAddToDataDefinition(self, msg):
-        self.dataDefs.setdefault(msg.dataDefinitionID, []).append(DataDefinitionEntry(msg))
+        # Reject anything we can't handle now rather than sending garbage later
+        try:
+            entry = DataDefinitionEntry(msg)
+        except units.UnitsError as e:
+            log('ERROR: rejecting', msg, '-', e)
+            exception = SC.EXCEPTION.NAME_UNRECOGNIZED if isinstance(e, units.UnknownUnitsError) else SC.EXCEPTION.DEFINITION_ERROR
+            self.Send(message.SException(exception=exception, sendID=msg._counter, index=3)) # (units are the 3rd parameter)
+            return
+        except NotImplementedError as e:
+            log('ERROR: rejecting', msg, '-', e)
+            self.Send(message.SException(exception=SC.EXCEPTION.INVALID_DATA_TYPE, sendID=msg._counter, index=4))
+            return
+        self.dataDefs.setdefault(msg.dataDefinitionID, []).append(entry)
+        self.readyDefs.discard(msg.dataDefinitionID) # (the new entry may read variables that haven't arrived yet)
+        numeric = self.numericDefs.pop(msg.dataDefinitionID, None)
+        if numeric is not None:
+            numeric.StoreBack() # (so the new one, made on the next tick, picks up where this one left off)
+        self.fic.AddReader(entry.inputs, self, msg.dataDefinitionID)
+        scheduler = self.fic.scheduler
+        for dr in self.activeDataRequests:
+            if dr.definitionID == msg.dataDefinitionID:
+                dr.stale = True
+                if dr.dueFrame is None:
+                    scheduler.Schedule(self, dr, scheduler.CurrentFrame()) # (so requests that only run on changes see it)
 
     def OnCMapClientEventToSimEvent(self, msg):
         if msg.eventName:
@@ -770,7 +1322,15 @@ class ConnectionHandler:
         if msg.objectID != SC.OBJECT_ID_USER:
             log('WARNING: not handling', msg)
             return
-        self.activeDataRequests.append(ObjectDataRequest(msg))
+        # A request replaces any earlier one with the same ID, and one with a period of NEVER just stops it
+        for dr in list(self.activeDataRequests):
+            if dr.requestID == msg.requestID:
+                self.RemoveRequest(dr)
+        if msg.period == SC.PERIOD.NEVER:
+            return
+        dr = ObjectDataRequest(msg)
+        self.activeDataRequests.append(dr)
+        self.fic.scheduler.Start(self, dr)
 
     def OnCTransmitClientEvent(self, msg):
         if msg.objectID != SC.OBJECT_ID_USER:
@@ -785,7 +1345,7 @@ class ConnectionHandler:
         if this client subscribes to this event'''
         eventID = self.simEventNameToID.get(eventName)
         if eventID is not None:
-            self.Send(message.SEvent(groupID=groupID, eventID=eventID, data=data, flags=0))
+            self.Send(message.SEvent(groupID=groupID, eventID=eventID, data=data, flags=0), True)
 
 def FSForceListener(port, fic):
     '''creates a dummy simconnect server to handle messages from FSForce, then loads FSForce
@@ -794,35 +1354,35 @@ def FSForceListener(port, fic):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(('', port))
     sock.listen(10)
-    sock.setblocking(0)
     log('FSForceListener listening on port', port)
 
-    # Now that the server sock is ready, we can fire up FSForce
+    def OnAccept(q, addr):
+        log('Accepting connection')
+        ConnectionHandler.Create(ConnectionHandler.nextID, q, fic)
+    fic.reactor.AddListener(sock, OnAccept)
+
+    # Now that the server sock is ready, we can fire up FSForce (imported here since it's Windows-only, and the
+    # rest of this module is also used headless, e.g. by bridgebench.py)
+    import fsfloader
     runner = fsfloader.FSForceRunner(True)
     runner.Start()
 
-    connNum = 0
-    while 1:
-        try:
-            q,v = sock.accept()
-            log('Accepting connection')
-            ConnectionHandler.Create(connNum, q, fic)
-            connNum += 1
-        except BlockingIOError:
-            try:
-                time.sleep(0.25)
-            except KeyboardInterrupt:
-                break
-        except KeyboardInterrupt:
-            break
-        except:
-            logTB()
+    try:
+        fic.reactor.Run()
+    except KeyboardInterrupt:
+        pass
     log('FSForceListener shutting down')
     GV.keepRunning = False
     sock.close()
+    fic.Close()
     runner.Stop()
 
 if __name__ == '__main__':
-    fic = FlyInsideConnector(61000, 62000)
+    r = reactor.Reactor()
+    frameRate = 60.0
+    if '--frame-rate' in sys.argv:
+        frameRate = float(sys.argv[sys.argv.index('--frame-rate') + 1])
+    fic = FlyInsideConnector(61000, 62000, r, frameRate=frameRate)
+    if '--capture' in sys.argv:
+        fic.capWriter = capture.CaptureWriter('ffs_fsforce', 'gzip', rotateSeconds=3600)
     FSForceListener(10000, fic)
-
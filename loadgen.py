@@ -0,0 +1,371 @@
+'''
+SimConnect load generator: runs a fleet of synthetic SimConnect clients from one process (all on one reactor or
+asyncio event loop) against a SimConnect server - normally the ffs_fsforce bridge or the replay server - to see
+how it copes as the number of connections grows.
+
+Each client sets itself up the way p3dlogger.RunClient does (COpen, CAddToDataDefinition, CRequestDataOnSimObject,
+system event subscriptions, and sim/input event mappings), as described by a profile, and then records:
+- how long the server took to answer COpen and to send the first data for each request
+- the round trip time of a CRequestSystemState('Sim') probe sent every --probe-interval seconds
+- the gaps between successive SSimObjectData messages for the same request
+- the rate of messages and bytes it receives
+
+Received frames are only split on their headers (not fully decoded), so the load generator itself stays cheap
+per message. With --asyncio, the clients run as tasks on an asyncio event loop (see simconnect.aioconnection)
+instead of on a reactor.
+
+Profiles come from a JSON file (a list of objects, each with any of the keys in DEFAULT_PROFILE) or from the
+command line. With more than one client count, the fleet is started fresh for each count in turn.
+
+Examples:
+    python loadgen.py --port 10000 --clients 1,4,16,64 --datums 20 --flags tagged,changed
+    python loadgen.py --port 10000 --config fleet.json --duration 30 --json results.json
+    python loadgen.py --port 10000 --clients 256 --asyncio
+'''
+
+from simconnect.utils import *
+import sys, socket, time, json, struct, argparse, asyncio
+from simconnect import connection, reactor, aioconnection, message as M, defs as SC
+
+# (datum name, units) for generated data definitions, from the variables p3dlogger knows about
+DEFAULT_DATUMS = [
+    ('PLANE ALTITUDE', 'feet'), ('PLANE LATITUDE', 'degrees'), ('PLANE LONGITUDE', 'degrees'),
+    ('AIRSPEED INDICATED', 'knots'), ('AIRSPEED TRUE', 'knots'), ('GROUND VELOCITY', 'knots'),
+    ('PLANE BANK DEGREES', 'degrees'), ('INCIDENCE ALPHA', 'degrees'), ('VELOCITY WORLD Y', 'feet per minute'),
+    ('ROTATION VELOCITY BODY X', 'degrees per second'), ('ROTATION VELOCITY BODY Y', 'degrees per second'),
+    ('ROTATION VELOCITY BODY Z', 'degrees per second'), ('ELEVATOR POSITION', 'percent'),
+    ('AILERON LEFT DEFLECTION PCT', 'percent'), ('ELEVATOR TRIM POSITION', 'degrees'), ('SIM ON GROUND', 'bool'),
+    ('PLANE ALT ABOVE GROUND', 'feet'), ('GENERAL ENG PCT MAX RPM:1', 'percent'),
+    ('GENERAL ENG THROTTLE LEVER POSITION:1', 'percent'), ('CENTER WHEEL RPM', 'rpm'), ('AIRCRAFT WIND Y', 'knots'),
+    ('STALL ALPHA', 'degrees'), ('PITOT ICE PCT', 'percent over 100'), ('GEAR HANDLE POSITION', 'bool'),
+]
+
+DEFAULT_PROFILE = dict(
+    count = 1, # number of clients with this profile
+    appName = 'loadgen',
+    # each definition is a list of [datumName, units, dataType, epsilon] (dataType and epsilon are optional)
+    definitions = [[[name, units] for name, units in DEFAULT_DATUMS[:10]]],
+    # each request is for a definition (1-based, in the order above) with a period and flags
+    requests = [dict(definition=1, period='SIM_FRAME', flags='', origin=0, interval=0, limit=0)],
+    systemEvents = ['Sim', 'Pause'],
+    simEvents = ['axis_elevator_set', 'axis_ailerons_set'],
+    inputEvents = [],
+)
+
+PROBE_REQUEST_BASE = 0x10000 # request IDs from here up are CRequestSystemState probes
+EVENT_ID_BASE = 100 # client event IDs for sim/input events start here
+NOTIFICATION_GROUP, INPUT_GROUP = 1, 2
+
+def MakeProfile(d):
+    '''returns a full profile dict from a partial one'''
+    profile = dict(DEFAULT_PROFILE)
+    unknown = set(d) - set(DEFAULT_PROFILE)
+    if unknown:
+        raise ValueError('unknown profile keys: %s' % ', '.join(sorted(unknown)))
+    profile.update(d)
+    profile['requests'] = [dict(DEFAULT_PROFILE['requests'][0], **req) for req in profile['requests']]
+    return profile
+
+class LoadClient:
+    '''one synthetic SimConnect client'''
+    def __init__(self, clientNum, profile):
+        self.clientNum = clientNum
+        self.profile = profile
+        self.counter = 0 # message counter
+        self.closed = False
+        self.openSentAt = None
+        self.openLatency = None # seconds from COpen to SOpen
+        self.requestSentAt = {} # request ID -> when the CRequestDataOnSimObject was sent
+        self.firstDataLatency = {} # request ID -> seconds from the request to its first SSimObjectData
+        self.lastDataAt = {} # request ID -> when its most recent SSimObjectData arrived
+        self.probesSent = {} # probe request ID -> when it was sent
+        self.nextProbe = PROBE_REQUEST_BASE
+        self.server = None
+        self.reactor = None
+        self.probeTimer = None
+        self.ResetStats()
+
+    def Start(self, r, addr, probeInterval):
+        '''connects to the server and runs on the given reactor from then on'''
+        self.reactor = r
+        sock = socket.create_connection(addr)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = connection.ServerConnection(sock, rawFrames=True)
+        r.AddConnection(self.server, self.OnFrame, self.OnClosed)
+        self.SetUp()
+        self.Flush()
+        if probeInterval:
+            self.probeTimer = r.CallEvery(probeInterval, self.Probe)
+
+    def ResetStats(self):
+        self.statsStart = time.monotonic()
+        self.numMsgs = 0
+        self.numBytes = 0
+        self.numData = 0
+        self.numEvents = 0
+        self.numExceptions = 0
+        self.gaps = [] # seconds between successive SSimObjectData for the same request
+        self.probeTimes = [] # probe round trip times in seconds
+
+    def Send(self, msg):
+        msg._protocol = 29
+        msg._counter = self.counter
+        self.counter += 1
+        self.Write(msg)
+
+    def Write(self, msg):
+        self.server.Send(msg)
+
+    def Flush(self):
+        self.server.Flush()
+
+    def SetUp(self):
+        '''sends everything a client sends when it starts up, as described by its profile'''
+        p = self.profile
+        self.openSentAt = time.monotonic()
+        self.Send(M.COpen(appName=p['appName'], _ignore=0, _ignore2=0, simID='D3P', version=[4,3], build=[0,0]))
+        for i, eventName in enumerate(p['systemEvents']):
+            self.Send(M.CSubscribeToSystemEvent(clientEventID=i + 1, eventName=eventName))
+
+        for defID, datums in enumerate(p['definitions'], 1):
+            for datumID, datum in enumerate(datums):
+                name, units = datum[:2]
+                dataType = getattr(SC.DATATYPE, datum[2].upper()) if len(datum) > 2 else SC.DATATYPE.FLOAT64
+                epsilon = datum[3] if len(datum) > 3 else 0.0
+                self.Send(M.CAddToDataDefinition(dataDefinitionID=defID, datumName=name, unitsName=units, dataType=dataType,
+                                                 epsilon=epsilon, datumID=datumID))
+        for requestID, req in enumerate(p['requests'], 1):
+            self.requestSentAt[requestID] = time.monotonic()
+            self.Send(M.CRequestDataOnSimObject(requestID=requestID, definitionID=req['definition'], objectID=SC.OBJECT_ID_USER,
+                                                period=getattr(SC.PERIOD, req['period'].upper()), flags=SC.ParseDataRequestFlags(req['flags']),
+                                                origin=req['origin'], interval=req['interval'], limit=req['limit']))
+
+        eventID = EVENT_ID_BASE
+        for eventName in p['simEvents']:
+            self.Send(M.CMapClientEventToSimEvent(eventID=eventID, eventName=eventName))
+            self.Send(M.CAddClientEventToNotificationGroup(groupID=NOTIFICATION_GROUP, eventID=eventID, maskable=0))
+            eventID += 1
+        if p['simEvents']:
+            self.Send(M.CSetNotificationGroupPriority(groupID=NOTIFICATION_GROUP, priority=1))
+        for definition in p['inputEvents']:
+            self.Send(M.CMapClientEventToSimEvent(eventID=eventID, eventName=''))
+            self.Send(M.CAddClientEventToNotificationGroup(groupID=INPUT_GROUP, eventID=eventID, maskable=0))
+            self.Send(M.CMapInputEventToClientEvent(groupID=INPUT_GROUP, definition=definition, downID=eventID, downValue=0,
+                                                    upID=0xFFFFFFFF, upValue=0, maskable=1))
+            eventID += 1
+        if p['inputEvents']:
+            self.Send(M.CSetInputGroupState(groupID=INPUT_GROUP, state=1))
+            self.Send(M.CSetInputGroupPriority(groupID=INPUT_GROUP, priority=1))
+
+    def Probe(self):
+        '''sends a request whose answer tells us the round trip time'''
+        requestID = self.nextProbe
+        self.nextProbe += 1
+        self.probesSent[requestID] = time.monotonic()
+        self.Send(M.CRequestSystemState(requestID=requestID, stateName='Sim'))
+        self.Flush()
+
+    def OnFrame(self, item):
+        now = time.monotonic()
+        code, frame = item
+        self.numMsgs += 1
+        self.numBytes += len(frame)
+        if code == M.SSimObjectData.code:
+            self.numData += 1
+            requestID = struct.unpack_from('<L', frame, M.serverHeaderSize)[0]
+            prev = self.lastDataAt.get(requestID)
+            if prev is None:
+                sentAt = self.requestSentAt.get(requestID)
+                if sentAt is not None:
+                    self.firstDataLatency[requestID] = now - sentAt
+            else:
+                self.gaps.append(now - prev)
+            self.lastDataAt[requestID] = now
+        elif code == M.SEvent.code:
+            self.numEvents += 1
+        elif code == M.SSystemState.code:
+            requestID = struct.unpack_from('<L', frame, M.serverHeaderSize)[0]
+            sentAt = self.probesSent.pop(requestID, None)
+            if sentAt is not None:
+                self.probeTimes.append(now - sentAt)
+        elif code == M.SOpen.code:
+            if self.openLatency is None:
+                self.openLatency = now - self.openSentAt
+        elif code == M.SException.code:
+            self.numExceptions += 1
+
+    def OnClosed(self, conn):
+        log('Client', self.clientNum, 'was disconnected')
+        self.Close()
+
+    def Close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.probeTimer is not None:
+            self.probeTimer.Cancel()
+        self.reactor.Remove(self.server)
+        self.server.sock.close()
+
+class AsyncLoadClient(LoadClient):
+    '''a LoadClient that runs as a task on an asyncio event loop instead of on a reactor'''
+    async def Connect(self, addr):
+        self.server = await aioconnection.Connect(addr[0], addr[1], rawFrames=True)
+        self.SetUp()
+
+    async def Run(self, probeInterval):
+        '''handles everything the server sends until the connection closes (or the task is cancelled)'''
+        prober = asyncio.get_running_loop().create_task(self.ProbeLoop(probeInterval)) if probeInterval else None
+        try:
+            async for item in self.server:
+                self.OnFrame(item)
+            log('Client', self.clientNum, 'was disconnected')
+            self.closed = True
+        finally:
+            if prober is not None:
+                prober.cancel()
+
+    async def ProbeLoop(self, probeInterval):
+        while 1:
+            await asyncio.sleep(probeInterval)
+            self.Probe()
+
+    def Write(self, msg):
+        self.server.Write(msg)
+
+    def Flush(self):
+        pass # (the transport starts sending as soon as data is written)
+
+    async def Close(self):
+        self.closed = True
+        await self.server.Close()
+
+def ChooseProfiles(profiles, numClients):
+    '''returns the profile to use for each client: numClients in total, cycling through the profiles, or each
+    profile's count if numClients is None'''
+    if numClients is None:
+        return [p for p in profiles for i in range(p['count'])]
+    return [profiles[i % len(profiles)] for i in range(numClients)]
+
+def RunFleet(addr, profiles, numClients=None, duration=10.0, warmup=2.0, probeInterval=0.5):
+    '''connects a fleet of clients (see ChooseProfiles), runs them for warmup + duration seconds, and returns a dict
+    of results covering the last duration seconds'''
+    r = reactor.Reactor()
+    clients = []
+    for i, p in enumerate(ChooseProfiles(profiles, numClients)):
+        c = LoadClient(i, p)
+        c.Start(r, addr, probeInterval)
+        clients.append(c)
+
+    r.CallLater(warmup, r.Stop)
+    r.Run()
+    for c in clients:
+        c.ResetStats()
+    start = time.monotonic()
+    cpuStart = time.process_time()
+    r.CallLater(duration, r.Stop)
+    r.Run()
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpuStart
+
+    disconnected = sum(c.closed for c in clients)
+    for c in clients:
+        c.Close()
+    r.Close()
+    return Summarize(clients, elapsed, cpu, disconnected)
+
+def RunFleetAsync(addr, profiles, numClients=None, duration=10.0, warmup=2.0, probeInterval=0.5):
+    '''like RunFleet, but with the clients all running on one asyncio event loop'''
+    async def Run():
+        clients = [AsyncLoadClient(i, p) for i, p in enumerate(ChooseProfiles(profiles, numClients))]
+        await asyncio.gather(*[c.Connect(addr) for c in clients])
+        tasks = [asyncio.get_running_loop().create_task(c.Run(probeInterval)) for c in clients]
+        await asyncio.sleep(warmup)
+        for c in clients:
+            c.ResetStats()
+        start = time.monotonic()
+        cpuStart = time.process_time()
+        await asyncio.sleep(duration)
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpuStart
+
+        disconnected = sum(c.closed for c in clients)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*[c.Close() for c in clients])
+        return Summarize(clients, elapsed, cpu, disconnected)
+    return asyncio.run(Run())
+
+def Summarize(clients, elapsed, cpu, disconnected):
+    '''returns the results dict for a fleet run'''
+    probes = [x * 1000 for c in clients for x in c.probeTimes]
+    gaps = [x * 1000 for c in clients for x in c.gaps]
+    opens = [c.openLatency * 1000 for c in clients if c.openLatency is not None]
+    firstData = [x * 1000 for c in clients for x in c.firstDataLatency.values()]
+    perClient = [c.numMsgs / elapsed for c in clients]
+    numMsgs = sum(c.numMsgs for c in clients)
+    return dict(
+        clients=len(clients), seconds=elapsed, disconnected=disconnected, loadgenCpuPct=cpu / elapsed * 100,
+        msgsPerSec=numMsgs / elapsed, bytesPerSec=sum(c.numBytes for c in clients) / elapsed,
+        dataPerSec=sum(c.numData for c in clients) / elapsed, eventsPerSec=sum(c.numEvents for c in clients) / elapsed,
+        exceptions=sum(c.numExceptions for c in clients),
+        msgsPerSecPerClientMin=min(perClient, default=0), msgsPerSecPerClientMax=max(perClient, default=0),
+        openMsP50=Percentile(opens, 50), openMsMax=max(opens, default=0), noOpen=len(clients) - len(opens),
+        firstDataMsP50=Percentile(firstData, 50), firstDataMsMax=max(firstData, default=0),
+        probes=len(probes), probeMsP50=Percentile(probes, 50), probeMsP95=Percentile(probes, 95), probeMsMax=max(probes, default=0),
+        gapMsP50=Percentile(gaps, 50), gapMsP95=Percentile(gaps, 95), gapMsMax=max(gaps, default=0),
+    )
+
+HEADER = '%7s %9s %9s %9s %9s %9s %9s %9s %9s %9s %6s' % ('clients', 'msgs/s', 'per conn', 'KB/s', 'open p50', 'probe p50',
+                                                          'p95', 'gap p50', 'p95', 'max', 'drops')
+def FormatResult(res):
+    return '%7d %9.0f %9.1f %9.1f %7.2fms %7.2fms %7.2fms %7.2fms %7.2fms %7.2fms %6d' % (res['clients'], res['msgsPerSec'],
+        res['msgsPerSec'] / max(1, res['clients']), res['bytesPerSec'] / 1024, res['openMsP50'], res['probeMsP50'], res['probeMsP95'],
+        res['gapMsP50'], res['gapMsP95'], res['gapMsMax'], res['disconnected'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a fleet of synthetic SimConnect clients against a server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10000, help='SimConnect server port (10000 for the bridge)')
+    parser.add_argument('--clients', help='comma separated client counts to try (default: the count(s) from the profiles)')
+    parser.add_argument('--config', help='JSON file with a list of client profiles')
+    parser.add_argument('--datums', type=int, help='datums in the generated data definition (ignored with --config)')
+    parser.add_argument('--period', help='data request period, e.g. SIM_FRAME or SECOND (ignored with --config)')
+    parser.add_argument('--flags', help='data request flags, e.g. tagged,changed (ignored with --config)')
+    parser.add_argument('--probe-interval', type=float, default=0.5, help='seconds between round trip probes (0 for none)')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds to run before measuring')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to measure for')
+    parser.add_argument('--json', help='file to save the results to as JSON')
+    parser.add_argument('--asyncio', action='store_true', help='run the clients on an asyncio event loop instead of a reactor')
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config) as f:
+            profiles = [MakeProfile(d) for d in json.load(f)]
+    else:
+        d = {}
+        if args.datums is not None:
+            d['definitions'] = [[list(DEFAULT_DATUMS[i % len(DEFAULT_DATUMS)]) for i in range(args.datums)]]
+        req = {}
+        if args.period is not None:
+            req['period'] = args.period
+        if args.flags is not None:
+            req['flags'] = args.flags
+        if req:
+            d['requests'] = [req]
+        profiles = [MakeProfile(d)]
+
+    counts = [int(x) for x in args.clients.split(',')] if args.clients else [None]
+    results = []
+    print(HEADER)
+    for numClients in counts:
+        run = RunFleetAsync if args.asyncio else RunFleet
+        res = run((args.host, args.port), profiles, numClients, args.duration, args.warmup, args.probe_interval)
+        results.append(res)
+        print(FormatResult(res))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), profiles=profiles, results=results), f, indent=1)
@@ -5,7 +5,7 @@ values in a data stream.
 
 from simconnect.utils import *
 import sys, socket, time, threading, struct
-from simconnect import connection, message as M, defs as SC
+from simconnect import connection, reactor, message as M, defs as SC
 
 class GV:
     keepRunning = True
@@ -171,22 +171,26 @@ def RunClient(simPort):
     # - if event name is empty, it's a private event (so far I've only seen it used for a subsequent call to MapInputEventToClientEvent)
     # - otherwise, it should be a standard FSX event
 
-    while 1:
-        didWork = False
-        msg = GV.server.Recv()
-        if msg is not None:
-            didWork = True
-            handler = globals().get('On' + msg.__class__.__name__)
-            if handler is None:
-                log('ERROR: no handler for', msg)
-            else:
-                msgs = handler(msg)
-                if msgs:
-                    for m in msgs:
-                        Send(m)
-
-        if not didWork:
-            time.sleep(0.1)
+    def OnMessage(msg):
+        handler = globals().get('On' + msg.__class__.__name__)
+        if handler is None:
+            log('ERROR: no handler for', msg)
+        else:
+            msgs = handler(msg)
+            if msgs:
+                for m in msgs:
+                    Send(m)
+
+    def OnClosed(conn):
+        log('Connection closed')
+        r.Stop()
+
+    r = reactor.Reactor()
+    r.AddConnection(GV.server, OnMessage, OnClosed)
+    try:
+        r.Run()
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
     simPort = 12500
@@ -1,100 +1,135 @@
 '''
 SimConnect proxy server
+
+Forwards the data between a SimConnect client and server frame by frame, using just the message
+headers to find the frame boundaries. Only the message types that were asked for get fully decoded
+(for logging), so the proxy stays close to the speed of a raw socket forwarder. When recording, every
+frame is handed as-is to a single background capture writer (see simconnect.capture) shared by all
+connections, so disk I/O never holds up forwarding.
 '''
 
 from simconnect.utils import *
-import sys, socket, time, threading, pickle
-from simconnect import connection
+import sys, socket, time
+from simconnect import connection, message, reactor, capture
 
 class GV:
     keepRunning = True
 
+def DecodeKeys(classNames):
+    '''converts a list of message class names (e.g. ['CAddToDataDefinition', 'SSimObjectData']) to a set of
+    (fromAgent, msgCode) keys as used by message.classMap. None means decode everything.'''
+    if classNames is None:
+        return set(message.classMap.keys())
+    keys = set()
+    for name in classNames:
+        klass = getattr(message, name)
+        keys.add((klass.fromAgent, klass.code))
+    return keys
+
 class ConnectionHandler:
     nextID = 0
     @staticmethod
-    def Create(sock, destIP, destPort, record):
-        c = ConnectionHandler(sock, destIP, destPort, record)
-        t = threading.Thread(target=c.Handle)
-        t.daemon = True
-        t.start()
+    def Create(sock, destIP, destPort, capWriter, reactor, decodeKeys):
+        c = ConnectionHandler(sock, destIP, destPort, capWriter, reactor, decodeKeys)
+        c.Start()
         return c
 
-    def __init__(self, sock, destIP, destPort, record):
+    def __init__(self, sock, destIP, destPort, capWriter, reactor, decodeKeys):
         self.handlerID = ConnectionHandler.nextID
         ConnectionHandler.nextID += 1
-        self.record = record
-        self.client = connection.ClientConnection(sock)
+        self.reactor = reactor
+        self.decodeKeys = decodeKeys # set of (fromAgent, msgCode) for messages to decode and log
+        self.client = connection.ClientConnection(sock, rawFrames=True)
+        if capWriter is not None:
+            self.client.SetCapture(capWriter, self.handlerID) # (sees the frames going both ways)
+        self.server = None
         self.serverIP = destIP
         self.serverPort = destPort
 
-    def Handle(self):
+    def Start(self):
         # connect to the server
-        startTime = time.time()
+        self.startTime = time.time()
         serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         serverSock.connect((self.serverIP, self.serverPort))
         log('connected to server at', self.serverIP, self.serverPort)
-        server = connection.ServerConnection(serverSock)
-        if self.record:
-            outF = open('proxyconn-%d.log' % self.handlerID, 'wb')
-        try:
-            while GV.keepRunning:
-                didWork = False
-                relTime = int((time.time() - startTime) * 1000)
+        self.server = connection.ServerConnection(serverSock, rawFrames=True)
+        self.reactor.AddConnection(self.client, self.OnClientFrame, self.OnClosed)
+        self.reactor.AddConnection(self.server, self.OnServerFrame, self.OnClosed)
 
-                # Grab messages from the client and send to the server
-                toServer = self.client.Recv()
-                if toServer is not None:
-                    didWork = True
-                    log('[%s, %d]' % (self.handlerID, relTime), toServer)
-                    if self.record:
-                        pickle.dump((time.time(), self.handlerID, toServer), outF)
-                    server.Send(toServer)
+    def Inspect(self, fromAgent, code, frame):
+        '''decodes and logs the frame if it's one of the message types we care about'''
+        if (fromAgent, code) not in self.decodeKeys:
+            return
+        if fromAgent == 'c':
+            msg, consumed = message.ClientMessageFromBuffer(frame)
+        else:
+            msg, consumed = message.ServerMessageFromBuffer(frame)
+        relTime = int((time.time() - self.startTime) * 1000)
+        log('[%s, %d]' % (self.handlerID, relTime), msg)
 
-                # And vice versa
-                toClient = server.Recv()
-                if toClient is not None:
-                    didWork = True
-                    log('[%s, %d]' % (self.handlerID, relTime), toClient)
-                    if self.record:
-                        pickle.dump((time.time(), self.handlerID, toClient), outF)
-                    self.client.Send(toClient)
+    def OnClientFrame(self, item):
+        # Forward frames from the client to the server untouched
+        code, frame = item
+        self.server.SendBytes(frame)
+        self.Inspect('c', code, frame)
 
-                # don't spin
-                if not didWork:
-                    time.sleep(0.05)
-        except connection.Closed as e:
-            log('Connection closed', e)
+    def OnServerFrame(self, item):
+        # And vice versa
+        code, frame = item
+        self.client.SendBytes(frame)
+        self.Inspect('s', code, frame)
 
-        if self.record:
-            outF.close()
+    def OnClosed(self, conn):
+        log('Connection closed', conn)
+        self.reactor.Remove(conn)
+        conn.sock.close()
+        # The other side may still have frames queued that the closed side sent before hanging up, so finish sending
+        # those before closing it too (ignoring anything more it sends in the meantime, since there's no one to get it)
+        peer = self.server if conn is self.client else self.client
+        if peer.sock.fileno() < 0:
+            return # (already closed)
+        self.reactor.Remove(peer)
+        peer.Flush()
+        if peer.WantsWrite() and peer.alive:
+            self.reactor.AddConnection(peer, lambda item: None, self.ClosePeer, self.ClosePeer)
+        else:
+            self.ClosePeer(peer)
 
-def Proxy(srcPort, destIP, destPort, record):
+    def ClosePeer(self, conn):
+        '''closes the surviving side once everything queued for it has been sent (or it has closed too)'''
+        self.reactor.Remove(conn)
+        conn.sock.close()
+
+def Proxy(srcPort, destIP, destPort, record, decode=None, compression='gzip', rotateSeconds=3600):
+    '''runs the proxy. decode is a list of message class names to decode (for logging), or None to decode
+    everything. If record is True, all traffic is saved to capture files named proxy-<date>-<time>.scap.gz,
+    starting a new one every rotateSeconds.'''
+    decodeKeys = DecodeKeys(decode)
+    capWriter = None
+    if record:
+        capWriter = capture.CaptureWriter('proxy', compression, rotateSeconds=rotateSeconds)
+    r = reactor.Reactor()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(('', srcPort))
     server.listen(10)
-    server.setblocking(0)
     log('Listening on port', srcPort)
-    while 1:
-        try:
-            q,v = server.accept()
-            log('Accepting connection')
-            ConnectionHandler.Create(q, destIP, destPort, record)
-        except BlockingIOError:
-            try:
-                time.sleep(0.25)
-            except KeyboardInterrupt:
-                break
-        except KeyboardInterrupt:
-            break
-        except:
-            logTB()
+    def OnAccept(q, addr):
+        log('Accepting connection')
+        ConnectionHandler.Create(q, destIP, destPort, capWriter, r, decodeKeys)
+    r.AddListener(server, OnAccept)
+    try:
+        r.Run()
+    except KeyboardInterrupt:
+        pass
     log('Shutting down')
     GV.keepRunning = False
     server.close()
+    if capWriter is not None:
+        capWriter.Close()
 
 if __name__ == '__main__':
     srcPort = 10000
     destPort = 12500
-    Proxy(srcPort, '127.0.0.1', destPort, True)
-
+    decode = sys.argv[1:] or None # optional list of message class names to decode, e.g. CAddToDataDefinition SSimObjectData
+    Proxy(srcPort, '127.0.0.1', destPort, True, decode)
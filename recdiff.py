@@ -0,0 +1,281 @@
+'''
+Compares two capture files (e.g. P3D recorded through proxy.py vs. the ffs_fsforce.py bridge) and reports how
+what each side sent differs: missing or extra messages, messages of a different type, field values that differ
+(for SSimObjectData values, by more than the epsilon the client asked for in CAddToDataDefinition), and
+differences in the time between messages.
+
+Connections are paired up in order, and each direction of each connection is aligned message by message. To
+keep this fast on huge captures, every frame is reduced to a hash of its bytes (minus the header fields that
+are expected to differ), and frames are only decoded when their hashes don't match.
+
+Usage:
+    recdiff.py a.scap b.scap [--limit N] [--window N] [--timing SECONDS]
+'''
+
+from simconnect.utils import *
+import sys, argparse
+from simconnect import capture, message, objdata
+from replay import DecodeFrame
+
+class Stream:
+    '''the messages sent in one direction on one connection in a capture'''
+    def __init__(self, cap, connID, direction):
+        self.cap = cap
+        self.connID = connID
+        self.direction = direction
+        self.times = []
+        self.offsets = []
+        self.codes = []
+        self.keys = [] # hash of each frame's code and body
+
+    def __len__(self):
+        return len(self.keys)
+
+    def Decode(self, i):
+        '''returns the i-th message (an UnknownFrame if it's of a type we can't decode, so that it still gets reported
+        as extra, missing, or different rather than ending the diff)'''
+        return DecodeFrame(self.cap.data, self.offsets[i], self.direction)
+
+def LoadStreams(cap):
+    '''splits a capture into Streams, returning {(connID, direction): Stream} and {connID: objdata.DataDefinitions}'''
+    streams = {}
+    data = cap.data
+    for i, ts, connID, direction, code, offset, length in cap.Iter():
+        s = streams.get((connID, direction))
+        if s is None:
+            s = streams[(connID, direction)] = Stream(cap, connID, direction)
+        s.times.append(ts)
+        s.offsets.append(offset)
+        s.codes.append(code)
+        if direction == 'c':
+            s.keys.append(hash((code, data[offset+16:offset+length]))) # (skips size, protocol, and counter)
+        else:
+            s.keys.append(hash(data[offset+8:offset+length])) # (skips size and protocol)
+
+    # Track data definitions so that SSimObjectData payloads can be compared value by value. (This uses each
+    # connection's final set of definitions, which is fine unless a client redefines things partway through.)
+    defsByConn = {}
+    for (connID, direction), s in streams.items():
+        defs = defsByConn.setdefault(connID, objdata.DataDefinitions())
+        if direction == 'c':
+            for i in range(len(s)):
+                if s.codes[i] == message.CAddToDataDefinition.code:
+                    defs.Track(s.Decode(i))
+    return streams, defsByConn
+
+# Alignment operations
+OP_Same, OP_Changed, OP_OnlyA, OP_OnlyB = range(4)
+
+def _Find(keys, key, start, end):
+    '''returns the index of key in keys[start:end], or -1'''
+    try:
+        return keys.index(key, start, end)
+    except ValueError:
+        return -1
+
+def Align(a, b, window=64):
+    '''aligns two Streams, yielding (op, i, j) where op is one of OP_*, and i and j are indices into a and b (or None)'''
+    ka, kb, ca, cb = a.keys, b.keys, a.codes, b.codes
+    na, nb = len(ka), len(kb)
+    i = j = 0
+    while i < na and j < nb:
+        if ka[i] == kb[j]:
+            yield OP_Same, i, j
+            i += 1
+            j += 1
+            continue
+
+        if ca[i] == cb[j]:
+            # Same type but different contents: usually just different values, unless one side has an extra
+            # message of this type
+            if i+1 < na and ka[i+1] == kb[j]:
+                yield OP_OnlyA, i, None
+                i += 1
+            elif j+1 < nb and ka[i] == kb[j+1]:
+                yield OP_OnlyB, None, j
+                j += 1
+            else:
+                yield OP_Changed, i, j
+                i += 1
+                j += 1
+            continue
+
+        # Different types, so something was added or dropped: resync on the nearest matching frame, or failing
+        # that, the nearest message of the same type
+        skipB = _Find(kb, ka[i], j+1, j+window)
+        skipA = _Find(ka, kb[j], i+1, i+window)
+        if skipA < 0 and skipB < 0:
+            skipB = _Find(cb, ca[i], j+1, j+window)
+            skipA = _Find(ca, cb[j], i+1, i+window)
+        if skipB >= 0 and (skipA < 0 or skipB - j <= skipA - i):
+            for jj in range(j, skipB):
+                yield OP_OnlyB, None, jj
+            j = skipB
+        elif skipA >= 0:
+            for ii in range(i, skipA):
+                yield OP_OnlyA, ii, None
+            i = skipA
+        else:
+            yield OP_Changed, i, j # (a type mismatch, reported as such)
+            i += 1
+            j += 1
+    for ii in range(i, na):
+        yield OP_OnlyA, ii, None
+    for jj in range(j, nb):
+        yield OP_OnlyB, None, jj
+
+def _Close(va, vb, epsilon):
+    if type(va) in (int, float) and type(vb) in (int, float):
+        if type(va) is int and type(vb) is int:
+            return abs(va - vb) <= int(epsilon) # (SimConnect truncates epsilon for integer values)
+        return abs(va - vb) <= epsilon
+    if isinstance(va, tuple) and isinstance(vb, tuple) and len(va) == len(vb):
+        return all(_Close(x, y, epsilon) for x, y in zip(va, vb))
+    return va == vb
+
+_comparedFields = {} # message class -> names of the members that CompareMsgs compares directly
+def _ComparedFields(klass):
+    names = _comparedFields.get(klass)
+    if names is None:
+        objData = klass in (message.SSimObjectData, message.SSimObjectDataByType)
+        names = _comparedFields[klass] = [name for name, sv in klass.members if name[0] != '_' and not (objData and name == 'data')]
+    return names
+
+def CompareMsgs(ma, mb, defsA, defsB):
+    '''returns a list of strings describing how two messages differ (ignoring differences within tolerance)'''
+    if ma.__class__ is not mb.__class__:
+        return ['%s vs %s' % (ma.__class__.__name__, mb.__class__.__name__)]
+    diffs = []
+    names = _ComparedFields(ma.__class__)
+    if [getattr(ma, name) for name in names] != [getattr(mb, name) for name in names]:
+        for name in names:
+            va, vb = getattr(ma, name), getattr(mb, name)
+            if va != vb:
+                diffs.append('%s: %r vs %r' % (name, va, vb))
+    if isinstance(ma, (message.SSimObjectData, message.SSimObjectDataByType)):
+        valsA = {d.datumID: (d, v) for d, v in defsA.Decode(ma)}
+        valsB = {d.datumID: (d, v) for d, v in defsB.Decode(mb)}
+        for datumID in sorted(set(valsA) | set(valsB)):
+            if datumID not in valsB:
+                diffs.append('%s: only in A' % valsA[datumID][0].name)
+            elif datumID not in valsA:
+                diffs.append('%s: only in B' % valsB[datumID][0].name)
+            else:
+                d, va = valsA[datumID]
+                vb = valsB[datumID][1]
+                if not _Close(va, vb, d.epsilon):
+                    diffs.append('%s: %r vs %r (epsilon %g)' % (d.name, va, vb, d.epsilon))
+    return diffs
+
+class StreamDiff:
+    '''the results of comparing one pair of Streams'''
+    def __init__(self, a, b, defsA, defsB, window=64, limit=20, timingTolerance=0.05):
+        self.a = a
+        self.b = b
+        self.limit = limit # max number of differences to keep details on
+        self.timingTolerance = timingTolerance # gaps between messages that differ by more than this (in seconds) get counted
+        self.counts = [0, 0, 0, 0] # number of each OP_*
+        self.numWithinTolerance = 0 # OP_Changed pairs whose differences were all within tolerance
+        self.details = [] # descriptions of the first <limit> differences
+        self.numGaps = 0
+        self.numSlowGaps = 0 # gaps (between consecutive matched messages) that differ by more than timingTolerance
+        self.totalGapDiff = 0.0
+        self.worstGap = (0.0, None, None) # (difference, i, j)
+        self._Run(defsA, defsB, window)
+
+    def _WantDetail(self):
+        return len(self.details) < self.limit
+
+    def _Where(self, i, j):
+        a, b = self.a, self.b
+        ta = '%d@%.3fs' % (i, a.times[i]) if i is not None else '-'
+        tb = '%d@%.3fs' % (j, b.times[j]) if j is not None else '-'
+        return '[%d/%d %s  A %s  B %s]' % (a.connID, b.connID, a.direction, ta, tb)
+
+    def _Run(self, defsA, defsB, window):
+        a, b = self.a, self.b
+        prevI = prevJ = None
+        for op, i, j in Align(a, b, window):
+            self.counts[op] += 1
+            if op == OP_OnlyA:
+                if self._WantDetail():
+                    self.details.append('%s only in A: %r' % (self._Where(i, None), a.Decode(i)))
+                continue
+            if op == OP_OnlyB:
+                if self._WantDetail():
+                    self.details.append('%s only in B: %r' % (self._Where(None, j), b.Decode(j)))
+                continue
+            if op == OP_Changed:
+                ma = a.Decode(i)
+                diffs = CompareMsgs(ma, b.Decode(j), defsA, defsB)
+                if not diffs:
+                    self.numWithinTolerance += 1
+                elif self._WantDetail():
+                    self.details.append('%s %s: %s' % (self._Where(i, j), ma.__class__.__name__, '; '.join(diffs)))
+
+            # Compare how long it took each side to get from the previous matched message to this one
+            if prevI is not None:
+                gapDiff = abs((a.times[i] - a.times[prevI]) - (b.times[j] - b.times[prevJ]))
+                self.numGaps += 1
+                self.totalGapDiff += gapDiff
+                if gapDiff > self.timingTolerance:
+                    self.numSlowGaps += 1
+                if gapDiff > self.worstGap[0]:
+                    self.worstGap = (gapDiff, i, j)
+            prevI, prevJ = i, j
+
+    def Report(self, out):
+        a = self.a
+        same, changed, onlyA, onlyB = self.counts
+        out.write('Connection %d/%d, %s messages: %d vs %d\n' % (a.connID, self.b.connID, 'client' if a.direction == 'c' else 'server', len(a), len(self.b)))
+        out.write('    identical: %d, within tolerance: %d, different: %d, only in A: %d, only in B: %d\n' %
+                  (same, self.numWithinTolerance, changed - self.numWithinTolerance, onlyA, onlyB))
+        if self.numGaps:
+            gapDiff, i, j = self.worstGap
+            out.write('    timing: mean gap difference %.2fms, %d gaps off by more than %gms, worst %.2fms at %s\n' %
+                      (self.totalGapDiff / self.numGaps * 1000, self.numSlowGaps, self.timingTolerance * 1000, gapDiff * 1000,
+                       self._Where(i, j) if i is not None else '-'))
+        for d in self.details:
+            out.write('    ' + d + '\n')
+
+    def IsSame(self):
+        '''returns True if no differences (beyond tolerances) were found'''
+        same, changed, onlyA, onlyB = self.counts
+        return changed == self.numWithinTolerance and onlyA == 0 and onlyB == 0
+
+def Diff(filenameA, filenameB, out=sys.stdout, window=64, limit=20, timingTolerance=0.05):
+    '''compares two captures, writing a report to out. Returns True if they match (within tolerances).'''
+    with capture.IndexedCapture(filenameA) as capA, capture.IndexedCapture(filenameB) as capB:
+        streamsA, defsA = LoadStreams(capA)
+        streamsB, defsB = LoadStreams(capB)
+        connsA = sorted({connID for connID, d in streamsA})
+        connsB = sorted({connID for connID, d in streamsB})
+        if len(connsA) != len(connsB):
+            out.write('Different numbers of connections: %d vs %d\n' % (len(connsA), len(connsB)))
+        allSame = len(connsA) == len(connsB)
+        for connA, connB in zip(connsA, connsB):
+            for direction in ('c', 's'):
+                a = streamsA.get((connA, direction))
+                b = streamsB.get((connB, direction))
+                if a is None and b is None:
+                    continue
+                if a is None:
+                    a = Stream(capA, connA, direction)
+                if b is None:
+                    b = Stream(capB, connB, direction)
+                d = StreamDiff(a, b, defsA[connA] if connA in defsA else objdata.DataDefinitions(),
+                               defsB[connB] if connB in defsB else objdata.DataDefinitions(), window, limit, timingTolerance)
+                d.Report(out)
+                allSame = allSame and d.IsSame()
+        out.write('MATCH\n' if allSame else 'DIFFERENT\n')
+        return allSame
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two SimConnect capture files')
+    parser.add_argument('a')
+    parser.add_argument('b')
+    parser.add_argument('--limit', type=int, default=20, help='max differences to list per connection and direction')
+    parser.add_argument('--window', type=int, default=64, help='how far ahead to look when resyncing after a missing or extra message')
+    parser.add_argument('--timing', type=float, default=0.05, help='gaps between messages that differ by more than this many seconds get counted')
+    args = parser.parse_args()
+    sys.exit(0 if Diff(args.a, args.b, window=args.window, limit=args.limit, timingTolerance=args.timing) else 1)
@@ -1,114 +1,302 @@
 '''
 Replays recordings saved from the proxy server - simulating the server side of the connection
 SimConnect proxy server
+
+Recorded messages can be played back at the recorded pace, some multiple of it, or as fast as the client
+can take them. Either way, a recorded server message isn't sent until the client has sent as many messages
+as it had in the recording, so replies never get ahead of the requests they answer.
+
+Any number of clients can connect at once - each one gets a recorded session (picked round robin, or one
+recorded from the same app going by its COpen message) with its own clock, all on a single reactor.
 '''
 
 from simconnect.utils import *
-import sys, socket, time, threading, pickle
-from simconnect import connection, message
+import sys, os, socket, time, pickle
+from simconnect import connection, message, reactor, capture, objdata, defs as SC
+try:
+    import numpy as np # only needed for exporting
+except ImportError:
+    np = None
 
 class GV:
     keepRunning = True
 
+class SessionCatalog:
+    '''the recorded sessions (connections) in a set of capture files, which get handed out to incoming connections.
+    It is only ever read from, so any number of ConnectionHandlers can play back the same session at once.'''
+    AS_RoundRobin, AS_AppName = range(2) # how to pick a session for a new connection
+
+    def __init__(self, filenames):
+        self.caps = [capture.IndexedCapture(f) for f in filenames]
+        self.sessions = [] # (cap, connID, appName), where appName is from the session's COpen message (or None)
+        for cap in self.caps:
+            for connID, code, offset in cap.Connections():
+                appName = DecodeFrame(cap.data, offset, 'c').appName if code == message.COpen.code and offset is not None else None
+                self.sessions.append((cap, connID, appName))
+        if not self.sessions:
+            self.Close()
+            raise ValueError('no recorded sessions in %s' % ', '.join(filenames))
+        self.nextSession = 0 # for round robin
+        self.nextByApp = {} # appName -> round robin counter for sessions recorded from that app
+        log('Loaded', len(self.sessions), 'sessions from', len(self.caps), 'captures')
+
+    def Next(self, appName=None):
+        '''returns (cap, connID, appName) for the session to play back next. If appName is given and there are sessions
+        recorded from that app, the next of those is chosen, otherwise just the next of all of them.'''
+        if appName is not None:
+            matches = [s for s in self.sessions if s[2] == appName]
+            if matches:
+                i = self.nextByApp.get(appName, 0)
+                self.nextByApp[appName] = i + 1
+                return matches[i % len(matches)]
+        session = self.sessions[self.nextSession % len(self.sessions)]
+        self.nextSession += 1
+        return session
+
+    def Close(self):
+        for cap in self.caps:
+            cap.Close()
+
 class ConnectionHandler:
     nextID = 0
     @staticmethod
-    def Create(sock, serverPort, msgs):
-        c = ConnectionHandler(sock, serverPort, msgs)
-        t = threading.Thread(target=c.Handle)
-        t.daemon = True
-        t.start()
+    def Create(sock, serverPort, catalog, reactor, assignBy=SessionCatalog.AS_AppName, startTS=0, speed=1.0, verbose=True):
+        c = ConnectionHandler(sock, serverPort, catalog, reactor, assignBy, startTS, speed, verbose)
+        c.Start()
         return c
 
-    def __init__(self, sock, serverPort, msgs):
+    def __init__(self, sock, serverPort, catalog, reactor, assignBy=SessionCatalog.AS_AppName, startTS=0, speed=1.0, verbose=True):
         self.handlerID = ConnectionHandler.nextID
         ConnectionHandler.nextID += 1
         self.serverPort = serverPort
-        self.msgs = msgs # list of S and C messages for this connection
+        self.catalog = catalog # SessionCatalog to pick a recorded session from
+        self.assignBy = assignBy # one of SessionCatalog.AS_*
+        self.startTS = startTS # how many seconds into the recording to start playing
+        self.cap = None # capture.IndexedCapture to play back from, once a session has been assigned
+        self.connID = None # which connection in the capture to play back
+        self.records = None # lazily walks the capture's index
+        self.nextRec = None # index record of the next message to play, or None once we run out
+        self.speed = speed # playback speed relative to the recording (e.g. 10 for 10x), or None to play as fast as the client can take it
+        self.verbose = verbose # if True, every message sent or received gets logged
+        self.highWater = 262144 # in max throughput mode, max bytes to have waiting to go out to the client
+        self.reactor = reactor
         self.client = connection.ClientConnection(sock)
+        self.server = None
+        self.timer = None # reactor timer for when the next recorded message is due
+        self.blockedAt = None # time at which playback started waiting on the live client to send a request
+
+        # To keep requests and responses in order, a recorded server message isn't played until the live client has
+        # sent at least as many messages as the recorded client had at that point
+        self.numClientMsgs = 0 # messages received from the live client
+        self.recClientMsgs = 0 # client messages played from the recording so far
 
-    def Handle(self):
+        self.playStart = None # time.monotonic() that recorded times are played relative to
+        self.statsStart = None # time.monotonic() at which playback actually started
+        self.finished = False
+        self.numPlayed = 0 # recorded server messages sent to the client
+        self.bytesPlayed = 0
+
+    def Start(self):
         # connect to the server
         if self.serverPort is not None:
             serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             serverSock.connect(('127.0.0.1', self.serverPort))
             log('connected to server at', self.serverPort)
-            server = connection.ServerConnection(serverSock)
-
-        ourStartTime = time.time()
-        fileStartTime = self.msgs[0][0]
-        timeOffset = ourStartTime - fileStartTime # add timeOffset to a recorded message to get the time at which we should be sending it back
-        timeOffset += 1 # delay them a little since we aren't actually responding to the messages we're getting
-        try:
-            while GV.keepRunning:
-                didWork = False
-
-                # Grab any messages from the server that are waiting
-                if self.serverPort is not None:
-                    inMsg = server.Recv()
-                    if inMsg is not None:
-                        log('[%d]' % self.handlerID, '(from server)', inMsg)
-                        didWork = True
-
-                # Grab any messages from the client that are waiting
-                inMsg = self.client.Recv()
-                if inMsg is not None:
-                    log('[%d]' % self.handlerID, '(from client)', inMsg)
-                    didWork = True
-
-                # Process all queued messages
-                if self.msgs:
-                    # Peek at next msg - if it's a client msg, log it and toss it
-                    msgTS, msgHandlerID, msg = self.msgs[0]
-                    relTime = int((msgTS - fileStartTime) * 1000)
-                    assert msgHandlerID == self.handlerID, (self.handlerID, msgHandlerID)
-                    playTime = msgTS + timeOffset + 0.25 # plus a little to make sure it comes after the corresponding client msg
-                    if time.time() >= playTime:
-                        self.msgs.pop(0)
-                        didWork = True
-                        log('[%d,%d]' % (self.handlerID, relTime), '(from recording)', msg)
-                        if msg.__class__.__name__[0] == 'C':
-                            # send the msg from the recording to the server
-                            if self.serverPort is not None:
-                                server.Send(msg)
-                        else:
-                            assert msg.__class__.__name__[0] == 'S', msg
-                            # send the msg from the recording to the client
-                            self.client.Send(msg)
-
-                # don't spin
-                if not didWork:
-                    time.sleep(0.05)
-        except connection.Closed as e:
-            log('Connection closed', e)
-
-def ListenForConnections(clientPort, serverPort, msgLists):
+            self.server = connection.ServerConnection(serverSock)
+            self.reactor.AddConnection(self.server, self.OnServerMessage, self.OnClosed)
+        self.reactor.AddConnection(self.client, self.OnClientMessage, self.OnClosed, self.OnClientDrained)
+        if self.assignBy == SessionCatalog.AS_RoundRobin:
+            self.Assign(self.catalog.Next())
+        # otherwise we wait for the client's COpen message to see which app it is
+
+    def Assign(self, session):
+        '''starts playing back the given (cap, connID, appName) session from the catalog'''
+        self.cap, self.connID, appName = session
+        log('[%d]' % self.handlerID, 'playing session', self.connID, 'from', self.cap.filename, '(%s)' % appName)
+        self.records = self.cap.Iter(self.cap.Seek(self.startTS), self.connID)
+        self.ReadNext()
+        if self.nextRec is None:
+            log('[%d]' % self.handlerID, 'nothing to play back for connection', self.connID)
+            return
+        self.fileStartTime = self.nextRec[1]
+        self.playStart = self.statsStart = time.monotonic()
+        self.PlayDue()
+
+    def OnServerMessage(self, inMsg):
+        # Grab any messages from the server that are waiting
+        if self.verbose:
+            log('[%d]' % self.handlerID, '(from server)', inMsg)
+
+    def OnClientMessage(self, inMsg):
+        # Grab any messages from the client that are waiting
+        if self.verbose:
+            log('[%d]' % self.handlerID, '(from client)', inMsg)
+        self.numClientMsgs += 1
+        if self.cap is None:
+            appName = inMsg.appName if isinstance(inMsg, message.COpen) else None
+            self.Assign(self.catalog.Next(appName))
+        elif self.blockedAt is not None:
+            self.PlayDue() # this may be the request that the next recorded message is waiting on
+
+    def OnClientDrained(self, conn):
+        if self.speed is None and self.records is not None:
+            self.PlayDue() # room for more
+
+    def ReadNext(self):
+        '''moves on to the index record of the next recorded message for our connection'''
+        self.nextRec = next(self.records, None)
+
+    def PlayTime(self, msgTS):
+        '''returns the time.monotonic() value at which a recorded message should be played back'''
+        return self.playStart + (msgTS - self.fileStartTime) / self.speed
+
+    def PlayDue(self):
+        '''sends any recorded messages that are due'''
+        if self.timer is not None:
+            self.timer.Cancel()
+            self.timer = None
+        now = time.monotonic()
+        while self.nextRec is not None:
+            i, ts, connID, direction, code, offset, length = self.nextRec
+            if direction == 's' and self.recClientMsgs > self.numClientMsgs:
+                if self.blockedAt is None:
+                    self.blockedAt = now
+                return # OnClientMessage will try again
+            if self.blockedAt is not None:
+                # Shift the clock by however long we waited so that what follows keeps its recorded pacing
+                self.playStart += now - self.blockedAt
+                self.blockedAt = None
+            if self.speed is None:
+                if self.client.NumPending() >= self.highWater:
+                    return # OnClientDrained will try again
+            elif now < self.PlayTime(ts):
+                self.timer = self.reactor.CallLater(self.PlayTime(ts) - now, self.PlayDue)
+                return
+            self.ReadNext()
+            self.Play(ts, direction, offset, length)
+        if not self.finished:
+            self.finished = True
+            self.LogStats('finished')
+
+    def Play(self, ts, direction, offset, length):
+        '''sends one recorded frame on to wherever it was headed'''
+        data = self.cap.data
+        if direction == 'c':
+            # send the msg from the recording to the server
+            self.recClientMsgs += 1
+            if self.server is not None:
+                self.server.SendBytes(data[offset:offset+length])
+        else:
+            # send the msg from the recording to the client
+            self.client.SendBytes(data[offset:offset+length])
+            self.numPlayed += 1
+            self.bytesPlayed += length
+        if self.verbose:
+            # Only now that it's on its way, since a frame we can't decode still has to get played
+            relTime = int((ts - self.fileStartTime) * 1000)
+            try:
+                log('[%d,%d]' % (self.handlerID, relTime), '(from recording)', DecodeFrame(data, offset, direction))
+            except:
+                logTB()
+
+    def Stats(self):
+        '''returns (messages played, bytes played, seconds since playback started)'''
+        if self.statsStart is None:
+            return 0, 0, 0.0
+        return self.numPlayed, self.bytesPlayed, time.monotonic() - self.statsStart
+
+    def LogStats(self, reason):
+        numMsgs, numBytes, elapsed = self.Stats()
+        elapsed = max(elapsed, 1e-6)
+        log('[%d]' % self.handlerID, reason, '- played %d msgs, %d bytes in %.3fs (%.0f msgs/s, %.0f bytes/s)' %
+            (numMsgs, numBytes, elapsed, numMsgs / elapsed, numBytes / elapsed))
+
+    def OnClosed(self, conn):
+        log('Connection closed', conn)
+        if self.timer is not None:
+            self.timer.Cancel()
+        for c in (self.client, self.server):
+            if c is not None:
+                self.reactor.Remove(c)
+                c.sock.close()
+        if self.nextRec is not None:
+            self.LogStats('closed early')
+        self.nextRec = None
+
+def ListenForConnections(clientPort, serverPort, filenames, startTS=0, speed=1.0, verbose=True, assignBy=SessionCatalog.AS_AppName):
+    '''plays back the sessions recorded in one or more capture files to any number of incoming connections, each
+    starting startTS seconds into its session and keeping its own clock. speed is the playback rate relative to the
+    recording, or None to play back as fast as possible. assignBy is one of SessionCatalog.AS_*.'''
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    catalog = SessionCatalog(filenames)
+    r = reactor.Reactor()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(('', clientPort))
     server.listen(10)
-    server.setblocking(0)
     log('Listening on port', clientPort)
-    while 1:
-        try:
-            q,v = server.accept()
-            log('Accepting connection')
-            ConnectionHandler.Create(q, serverPort, msgLists.pop(0))
-        except BlockingIOError:
-            try:
-                time.sleep(0.25)
-            except KeyboardInterrupt:
-                break
-        except KeyboardInterrupt:
-            break
-        except:
-            logTB()
+    def OnAccept(q, addr):
+        log('Accepting connection')
+        ConnectionHandler.Create(q, serverPort, catalog, r, assignBy, startTS, speed, verbose)
+    r.AddListener(server, OnAccept)
+    try:
+        r.Run()
+    except KeyboardInterrupt:
+        pass
     log('Shutting down')
     GV.keepRunning = False
     server.close()
+    catalog.Close()
+
+class UnknownFrame:
+    '''stands in for a recorded frame of a type there's no message class for (yet), so that it can still be listed
+    and compared like the others'''
+    members = [('code', None), ('data', None)] # (enough like a message for the tools that list a message's fields)
+    def __init__(self, direction, code, data):
+        self.fromAgent = direction
+        self.code = code
+        self.data = data # the whole frame, header included
+
+    def __eq__(self, other):
+        return isinstance(other, UnknownFrame) and (self.fromAgent, self.code, self.data) == (other.fromAgent, other.code, other.data)
+
+    def __repr__(self):
+        return '<UnknownFrame %s 0x%X, %d bytes>' % (self.fromAgent, self.code, len(self.data))
+
+def DecodeFrame(buffer, offset, direction):
+    '''decodes the recorded frame at the given offset into a message, or an UnknownFrame if it's of a type we
+    can't decode'''
+    if direction == 'c':
+        size, protocol, code, counter = message.clientHeaderStruct.unpack_from(buffer, offset)
+    else:
+        size, protocol, code = message.serverHeaderStruct.unpack_from(buffer, offset)
+    code &= 0x0FFFFFFF # (see message.ClientMessageFromBuffer)
+    if (direction, code) not in message.classMap:
+        return UnknownFrame(direction, code, bytes(buffer[offset:offset+size]))
+    if direction == 'c':
+        return message.ClientMessageFromBuffer(buffer, offset)[0]
+    return message.ServerMessageFromBuffer(buffer, offset)[0]
+
+def StreamMsgs(filename, startTS=0, connID=None):
+    '''lazily decodes the messages in a proxy capture file in timestamp order, starting startTS seconds into the
+    capture and optionally only for one connection. Yields (timestamp, connNum, msg), where timestamp is wall
+    clock time.'''
+    with capture.IndexedCapture(filename) as cap:
+        for i, ts, recConnID, direction, code, offset, length in cap.Iter(cap.Seek(startTS), connID):
+            yield cap.startTime + ts, recConnID, DecodeFrame(cap.data, offset, direction)
 
 def LoadMsgs(filename):
-    '''loads pickled messages from a proxy log. Returns a list of (timestamp, connNum, msg)'''
+    '''loads and decodes all the messages in a proxy capture file. Returns a list of (timestamp, connNum, msg),
+    where timestamp is wall clock time. For big captures, use StreamMsgs instead.'''
+    if not capture.IsCapture(filename):
+        log('WARNING:', filename, 'is not a capture file, loading it as an old pickled proxy log')
+        return LoadPickledMsgs(filename)
+    return list(StreamMsgs(filename))
+
+def LoadPickledMsgs(filename):
+    '''loads pickled messages from an old-style proxy log (only load files you trust!). Returns a list of
+    (timestamp, connNum, msg)'''
     msgs = []
     with open(filename, 'rb') as f:
         while 1:
@@ -118,45 +306,259 @@ def LoadMsgs(filename):
                 break
     return msgs
 
-dataDefNames = {} # (connID, defID, datumID) --> datum name
-
-import struct
-def Hex(s):
-    s = ['%02X' % x for x in s]
-    return ' '.join(s)
-
-def Moar(connID, msg):
-    ret = ''
-    if msg.flags & 2:
-        data = msg.data[:]
-        for i in range(msg.defineCount):
-            datumID = struct.unpack('<L', data[:4])[0]
-            data = data[4:]
-            ret += '\n        %d:' % datumID + ' ' + Hex(data[:4])
-            ret += ' :' + str(dataDefNames.get((connID, msg.definitionID, datumID)))
-            data = data[4:]
-    return ret
-
 def Dump(msgs, filename):
+    '''writes a list (or any iterable) of (timestamp, connNum, msg) to a text file'''
+    defsByConn = {} # connID -> objdata.DataDefinitions
     with open(filename, 'wt') as f:
-        start = msgs[0][0]
+        start = None
         for ts, connID, msg in msgs:
-            if isinstance(msg, message.CAddToDataDefinition):
-                dataDefNames[(connID, msg.dataDefinitionID, msg.datumID)] = msg.datumName
+            if start is None:
+                start = ts
+            defs = defsByConn.get(connID)
+            if defs is None:
+                defs = defsByConn[connID] = objdata.DataDefinitions()
+            defs.Track(msg)
             diffMS = int((ts-start) * 1000)
-            extra = ''
-            if isinstance(msg, message.SSimObjectData):
-                extra = Moar(connID, msg)
-            f.write('[%06d,%d,%s] %r%s\n' % (diffMS, connID, getattr(msg, '_counter', 0),msg, extra))
+            f.write('[%06d,%d,%s] %r\n' % (diffMS, connID, getattr(msg, '_counter', 0), msg))
+            if isinstance(msg, (message.SSimObjectData, message.SSimObjectDataByType)):
+                f.write(''.join('        %d: %r :%s\n' % (d.datumID, v, d.name) for d, v in defs.Decode(msg)))
+
+# ----------------------------------------------------------------------------------------------
+# Exporting SSimObjectData[ByType] values as NumPy arrays
+# ----------------------------------------------------------------------------------------------
+
+# struct format (as used by objdata.Datum) -> NumPy type
+_NUMPY_TYPES = {'i':'<i4', 'q':'<i8', 'f':'<f4', 'd':'<f8', 'ddd':('<f8', 3), 'fff':('<f4', 3)}
+def _NumpyType(datum):
+    fmt = datum.struct.format.lstrip('<')
+    if fmt.endswith('s'):
+        return 'S' + fmt[:-1]
+    return _NUMPY_TYPES[fmt]
+
+OBJDATA_HEADER_SIZE = message.serverHeaderSize + 7*4 # server header + SSimObjectData fields up through defineCount
+
+def _Gather(buf, offsets, size):
+    '''returns an (len(offsets), size) uint8 array of the bytes at each of the given offsets into buf'''
+    return np.lib.stride_tricks.sliding_window_view(buf, size)[offsets.astype(np.intp)] # (copies just the rows we want)
+
+def _Group(columns):
+    '''given a list of equal length integer arrays, returns (groupIDs, firsts), where rows with the same values in every
+    column get the same group ID, and firsts has the index of the first row of each group. (Much faster than
+    np.unique(axis=...), which sorts whole rows.)'''
+    combined = np.zeros(len(columns[0]), np.int64)
+    for col in columns:
+        values, inverse = np.unique(col, return_inverse=True)
+        combined = combined * len(values) + inverse.reshape(-1)
+        combined = np.unique(combined, return_inverse=True)[1].reshape(-1) # renumber so that it can't overflow
+    firsts, groupIDs = np.unique(combined, return_index=True, return_inverse=True)[1:]
+    return groupIDs.reshape(-1), firsts
+
+def _LayoutDtype(datums, datumOffsets, itemSize):
+    '''returns a structured dtype for a payload holding the given datums at the given offsets'''
+    return np.dtype(dict(names=['d%d' % i for i in range(len(datums))], formats=[_NumpyType(d) for d in datums],
+                         offsets=datumOffsets, itemsize=itemSize))
+
+class ObjectDataExporter:
+    '''turns the SSimObjectData[ByType] messages in a capture into one time series per (connection, request,
+    datum). Rather than decoding one message at a time, the data messages are grouped by payload layout and
+    each group is decoded in one go by viewing the raw bytes as a NumPy structured array.'''
+    def __init__(self, cap, conns=None, requestIDs=None, batchSize=100000):
+        if np is None:
+            raise ImportError('Exporting requires NumPy')
+        self.cap = cap
+        self.conns = conns # set of connection IDs to export, or None for all of them
+        self.requestIDs = requestIDs # set of request IDs to export, or None for all of them
+        self.batchSize = batchSize # max messages to decode at a time (bounds memory use)
+        self.buf = np.frombuffer(cap.data, np.uint8)
+        self.index = np.frombuffer(cap.index, capture.indexDtype, count=len(cap), offset=capture.indexHeaderStruct.size)
+        self.series = {} # (connID, requestID, datum name) -> ([timestamp arrays], [value arrays])
+
+    def _DefVersions(self):
+        '''decodes the (relatively few) data definition messages, returning {(connID, defID): ([index position of each
+        change], [list of Datums as of that change])}'''
+        idx = self.index
+        addCode = message.CAddToDataDefinition.code
+        positions = np.nonzero((idx['code'] == addCode) & (idx['dir'] == b'c'))[0]
+        defsByConn = {}
+        versions = {}
+        for pos in positions:
+            rec = idx[pos]
+            connID = int(rec['conn'])
+            if self.conns is not None and connID not in self.conns:
+                continue
+            defs = defsByConn.get(connID)
+            if defs is None:
+                defs = defsByConn[connID] = objdata.DataDefinitions()
+            msg = DecodeFrame(self.cap.data, int(rec['offset']), 'c')
+            defs.Track(msg)
+            changes, snapshots = versions.setdefault((connID, msg.dataDefinitionID), ([], []))
+            changes.append(pos)
+            snapshots.append(list(defs.Datums(msg.dataDefinitionID)))
+        return versions
+
+    def Run(self):
+        '''decodes everything, filling in self.series'''
+        idx = self.index
+        dataCodes = (message.SSimObjectData.code, message.SSimObjectDataByType.code)
+        mask = np.isin(idx['code'], dataCodes) & (idx['dir'] == b's')
+        if self.conns is not None:
+            mask &= np.isin(idx['conn'], list(self.conns))
+        positions = np.nonzero(mask)[0]
+        if not len(positions):
+            return
+
+        # Pull out the fixed fields of every data message: requestID, objectID, definitionID, flags, entryNumber, outOf, defineCount
+        offsets = idx['offset'][positions]
+        fields = _Gather(self.buf, offsets + message.serverHeaderSize, 7*4).view('<u4')
+        requestIDs, defIDs, flags, defineCounts = fields[:, 0], fields[:, 2], fields[:, 3], fields[:, 6]
+        if self.requestIDs is not None:
+            keep = np.isin(requestIDs, list(self.requestIDs))
+            positions, offsets, requestIDs, defIDs, flags, defineCounts = (a[keep] for a in (positions, offsets, requestIDs, defIDs, flags, defineCounts))
+        conns = idx['conn'][positions]
+        payloadSizes = idx['length'][positions].astype(np.int64) - OBJDATA_HEADER_SIZE
+        tagged = (flags & SC.DATA_REQUEST_FLAG.TAGGED) != 0
+
+        # Figure out which version of its data definition each message used
+        versions = self._DefVersions()
+        versionNums = np.full(len(positions), -1, np.int64)
+        for (connID, defID), (changes, snapshots) in versions.items():
+            sel = (conns == connID) & (defIDs == defID)
+            versionNums[sel] = np.searchsorted(np.array(changes), positions[sel], 'right') - 1
+
+        # Decode each group of messages that share a (connection, request, definition version, tagged, size) layout
+        groupIDs, firsts = _Group([conns, requestIDs, defIDs, versionNums, tagged, payloadSizes])
+        for g, first in enumerate(firsts):
+            connID, requestID, defID, version, isTagged, payloadSize = (int(a[first]) for a in (conns, requestIDs, defIDs, versionNums, tagged, payloadSizes))
+            if version < 0 or payloadSize <= 0:
+                continue # data for a definition we never saw, or no data at all
+            datums = versions[(connID, defID)][1][version]
+            sel = np.nonzero(groupIDs == g)[0]
+            for start in range(0, len(sel), self.batchSize):
+                batch = sel[start:start+self.batchSize]
+                if isTagged:
+                    self._DecodeTagged(connID, requestID, datums, positions[batch], offsets[batch], defineCounts[batch], payloadSize)
+                else:
+                    self._DecodeUntagged(connID, requestID, datums, positions[batch], offsets[batch], payloadSize)
+
+    def _Add(self, connID, requestID, datum, positions, values):
+        times, vals = self.series.setdefault((connID, requestID, datum.name), ([], []))
+        times.append(self.index['ts'][positions])
+        vals.append(values)
+
+    def _DecodeUntagged(self, connID, requestID, datums, positions, offsets, payloadSize):
+        # Every message in the group has the values for the definition's datums, in order
+        usable, datumOffsets, offset = [], [], 0
+        for datum in datums:
+            if datum.struct is None or offset + datum.size > payloadSize:
+                break
+            usable.append(datum)
+            datumOffsets.append(offset)
+            offset += datum.size
+        if not usable:
+            return
+        rows = _Gather(self.buf, offsets + OBJDATA_HEADER_SIZE, payloadSize)
+        recs = rows.view(_LayoutDtype(usable, datumOffsets, payloadSize)).reshape(-1)
+        for i, datum in enumerate(usable):
+            self._Add(connID, requestID, datum, positions, recs['d%d' % i].copy())
+
+    def _DecodeTagged(self, connID, requestID, datums, positions, offsets, defineCounts, payloadSize):
+        # Each message can have a different set of datums, so first walk the datum IDs of all of the messages at once
+        # to find each message's layout
+        byID = {d.datumID: d for d in datums if d.struct is not None}
+        knownIDs = np.array(sorted(byID), dtype=np.int64)
+        if not len(knownIDs):
+            return
+        knownSizes = np.array([byID[i].size for i in knownIDs.tolist()], dtype=np.int64)
+        rows = _Gather(self.buf, offsets + OBJDATA_HEADER_SIZE, payloadSize)
+        n = len(rows)
+        maxCount = min(int(defineCounts.max()), payloadSize // 4) # (defineCount is off the wire, but each datum takes 4+ bytes)
+        if maxCount == 0:
+            return # no values in any of the messages
+        ids =np.full((n, maxCount), -1, np.int64) # datum ID of the k-th value of each message, or -1
+        pos = np.zeros(n, np.int64)
+        ok = np.ones(n, bool) # False for messages we can't decode
+        rowNums = np.arange(n)
+        for k in range(maxCount):
+            active = ok & (k < defineCounts) & (pos + 4 <= payloadSize)
+            if not active.any():
+                break
+            p = pos[active]
+            r = rowNums[active]
+            datumIDs = (rows[r, p].astype(np.int64) | rows[r, p+1].astype(np.int64) << 8 |
+                        rows[r, p+2].astype(np.int64) << 16 | rows[r, p+3].astype(np.int64) << 24)
+            where = np.minimum(np.searchsorted(knownIDs, datumIDs), len(knownIDs) - 1)
+            known = knownIDs[where] == datumIDs
+            sizes = knownSizes[where]
+            fits = known & (p + 4 + sizes <= payloadSize)
+            ok[r[~fits]] = False
+            ids[r[fits], k] = datumIDs[fits]
+            pos[r[fits]] = p[fits] + 4 + sizes[fits]
+
+        # Now decode each group of messages with the same sequence of datum IDs
+        okRows = np.nonzero(ok)[0]
+        if not len(okRows):
+            return
+        okIDs = ids[okRows]
+        layoutIDs, firsts = _Group([okIDs[:, k] for k in range(maxCount)])
+        for li, first in enumerate(firsts):
+            layout = okIDs[first]
+            which = okRows[layoutIDs == li]
+            layoutDatums, datumOffsets, offset = [], [], 0
+            for datumID in layout.tolist():
+                if datumID < 0:
+                    break
+                datum = byID[datumID]
+                layoutDatums.append(datum)
+                datumOffsets.append(offset + 4)
+                offset += 4 + datum.size
+            if not layoutDatums:
+                continue
+            recs = np.ascontiguousarray(rows[which]).view(_LayoutDtype(layoutDatums, datumOffsets, payloadSize)).reshape(-1)
+            for i, datum in enumerate(layoutDatums):
+                self._Add(connID, requestID, datum, positions[which], recs['d%d' % i].copy())
+
+    def Arrays(self):
+        '''returns {name: array} with two arrays per series, named c<conn>_r<request>_<datum name> (the values) and
+        the same plus _t (seconds since the start of the capture), sorted by time'''
+        ret = {}
+        for (connID, requestID, name), (times, vals) in sorted(self.series.items()):
+            t = np.concatenate(times)
+            v = np.concatenate(vals)
+            order = np.argsort(t, kind='stable')
+            key = 'c%d_r%d_%s' % (connID, requestID, name.replace(' ', '_').replace(':', '_'))
+            ret[key] = v[order]
+            ret[key + '_t'] = t[order]
+        return ret
+
+def ExportObjectData(filename, outFilename, conns=None, requestIDs=None):
+    '''exports the SSimObjectData[ByType] values in a capture as per-datum time series (see ObjectDataExporter). If
+    outFilename ends in .npz, everything goes into that one file, otherwise outFilename is a directory that gets
+    one .npy file per array. Returns the dict of arrays.'''
+    with capture.IndexedCapture(filename) as cap:
+        exporter = ObjectDataExporter(cap, conns, requestIDs)
+        exporter.Run()
+        arrays = exporter.Arrays()
+        startTime = cap.startTime
+        del exporter # (its arrays reference the mmaps, which can't be closed while they're in use)
+    if outFilename.endswith('.npz'):
+        np.savez(outFilename, _startTime=np.float64(startTime), **arrays)
+    else:
+        os.makedirs(outFilename, exist_ok=True)
+        for name, a in arrays.items():
+            np.save(os.path.join(outFilename, name + '.npy'), a)
+    return arrays
 
 if __name__ == '__main__':
-    if 1:
-        msgs = sorted(LoadMsgs('proxyconn-0.log') + LoadMsgs('proxyconn-1.log') + LoadMsgs('proxyconn-2.log'), key=lambda x:x[:2])
-        Dump(msgs, 'taxiing.log')
+    # replay.py dump|<speed>|max <capture file saved by proxy.py> [<capture file> ...]
+    #  or replay.py export <capture file> <output .npz file or directory>
+    mode = sys.argv[1]
+    filenames = sys.argv[2:]
+    if mode == 'dump':
+        Dump(StreamMsgs(filenames[0]), 'taxiing.log')
+    elif mode == 'export':
+        ExportObjectData(filenames[0], filenames[1])
     else:
-        msgs = []
-        for i in range(3):
-            msgs.append(LoadMsgs('proxyconn-%d.log' % i))
-        #ListenForConnections(10000, 12500, msgs)
-        ListenForConnections(10000, None, msgs) # None means don't send to the server
+        speed = None if mode == 'max' else float(mode)
+        #ListenForConnections(10000, 12500, filenames, speed=speed)
+        ListenForConnections(10000, None, filenames, speed=speed, verbose=speed is not None) # None means don't send to the server
 
@@ -0,0 +1,211 @@
+'''
+asyncio counterpart to connection.Connection - frames the byte stream into messages using the same
+message classes, but lets a single event loop juggle many connections instead of needing a thread
+(or reactor callbacks) per connection.
+
+An AsyncConnection is the asyncio Protocol for its socket, so like Connection.PumpRecv, it splits data
+into messages as soon as it arrives. Reading is paused while too many messages are waiting for the
+owner, and Send/Drain wait while the transport's outgoing buffer is full, so a slow side on either end
+applies backpressure.
+
+Example server:
+    async def OnConnection(conn):
+        async for msg in conn:
+            ...
+            await conn.Send(reply)
+    server = await aioconnection.Serve(OnConnection, '', 10000)
+'''
+
+from . utils import *
+log, logTB = Logger()
+
+import asyncio, collections
+from . import message
+from . connection import Closed
+
+def ClientConnection(**kwargs): return AsyncConnection(AsyncConnection.CT_Client, **kwargs)
+def ServerConnection(**kwargs): return AsyncConnection(AsyncConnection.CT_Server, **kwargs)
+
+async def Connect(host, port, **kwargs):
+    '''connects to a SimConnect server and returns a ServerConnection for it'''
+    transport, conn = await asyncio.get_running_loop().create_connection(lambda: ServerConnection(**kwargs), host, port)
+    return conn
+
+async def Serve(onConnection, host, port, **kwargs):
+    '''starts listening for SimConnect clients. For each one, the coroutine onConnection(clientConnection)
+    is run as its own task. Returns the asyncio Server object.'''
+    async def Handle(conn):
+        try:
+            await onConnection(conn)
+        except Closed:
+            pass
+        except:
+            logTB()
+        finally:
+            await conn.Close()
+    def OnConnected(conn):
+        conn.task = asyncio.get_running_loop().create_task(Handle(conn)) # (held so that it doesn't get collected)
+    return await asyncio.get_running_loop().create_server(lambda: ClientConnection(onConnected=OnConnected, **kwargs), host, port)
+
+class AsyncConnection(asyncio.Protocol):
+    CT_Client, CT_Server = range(2) # type of agent on the other end of this connection
+    def __init__(self, type, compactAt=65536, maxQueued=1000, rawFrames=False, onConnected=None):
+        self.type = type # one of CT_*
+        if type == self.CT_Client:
+            self.FromBufferFunc = message.ClientMessageFromBuffer
+            self.FrameFunc = message.ClientFrameFromBuffer
+        else:
+            self.FromBufferFunc = message.ServerMessageFromBuffer
+            self.FrameFunc = message.ServerFrameFromBuffer
+        self.rawFrames = rawFrames # if True, received data is split into (msgCode, frameBytes) instead of decoded into messages
+        self.compactAt = compactAt # once inPos gets this far, already-converted data is dropped from inBytes
+        self.maxQueued = maxQueued # reading pauses while this many received messages are waiting to be taken
+        self.onConnected = onConnected # if given, onConnected(self) gets called once the connection is made
+        self.transport = None
+        self.inBytes = bytearray() # raw data waiting to be converted into messages
+        self.inPos = 0 # read cursor into inBytes
+        self.inMessages = collections.deque() # full-formed messages waiting to be returned to the caller
+        self.alive = True # False once the connection has closed (or the stream stopped making sense)
+        self.readPaused = False
+        self.arrived = None # future that Recv waits on for more messages
+        self.writable = None # future that Drain waits on while the transport has asked us to stop writing
+        self.lost = None # future that's done once the connection is gone
+
+    # asyncio.Protocol methods
+    def connection_made(self, transport):
+        self.transport = transport
+        self.lost = asyncio.get_running_loop().create_future()
+        if self.onConnected is not None:
+            self.onConnected(self)
+
+    def data_received(self, data):
+        self.inBytes.extend(data)
+        self._Parse()
+        if len(self.inMessages) >= self.maxQueued and not self.readPaused and self.alive:
+            self.readPaused = True
+            self.transport.pause_reading()
+        self._Wake()
+
+    def eof_received(self):
+        return False # (so the transport closes)
+
+    def connection_lost(self, exc):
+        self.alive = False
+        if not self.lost.done():
+            self.lost.set_result(None)
+        if self.writable is not None and not self.writable.done():
+            self.writable.set_result(None)
+        self._Wake()
+
+    def pause_writing(self):
+        self.writable = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if not self.writable.done():
+            self.writable.set_result(None)
+        self.writable = None
+
+    def _Wake(self):
+        if self.arrived is not None and not self.arrived.done():
+            self.arrived.set_result(None)
+
+    def _Parse(self):
+        '''converts as much of inBytes as possible into messages'''
+        buf = self.inBytes
+        pos = self.inPos
+        try:
+            if self.rawFrames:
+                while 1:
+                    code, numConsumed = self.FrameFunc(buf, pos)
+                    if code is None:
+                        break
+                    self.inMessages.append((code, bytes(buf[pos:pos+numConsumed])))
+                    pos += numConsumed
+            else:
+                while 1:
+                    msg, numConsumed = self.FromBufferFunc(buf, pos)
+                    if msg is None:
+                        break
+                    self.inMessages.append(msg)
+                    pos += numConsumed
+        except message.FramingError as e:
+            # There's no way to find the next message, so give up on the connection (keeping what came before)
+            log('ERROR: dropping connection:', e)
+            self.alive = False
+            self.transport.abort()
+            pos = len(buf)
+        if pos == len(buf):
+            buf.clear()
+            pos = 0
+        elif pos >= self.compactAt:
+            del buf[:pos]
+            pos = 0
+        self.inPos = pos
+
+    def _Taken(self):
+        '''lets data flow again once the owner has caught up'''
+        if self.readPaused and len(self.inMessages) < self.maxQueued and self.alive:
+            self.readPaused = False
+            self.transport.resume_reading()
+
+    async def Recv(self):
+        '''returns the next message (or, if rawFrames is set, the next (msgCode, frameBytes) tuple), waiting for
+        one to arrive if needed. Raises Closed once the connection has closed and everything before that has been
+        returned.'''
+        while not self.inMessages:
+            if not self.alive:
+                raise Closed(self)
+            self.arrived = asyncio.get_running_loop().create_future()
+            await self.arrived
+        msg = self.inMessages.popleft()
+        self._Taken()
+        return msg
+
+    def RecvAll(self):
+        '''returns a list of all messages that have arrived so far (without waiting for more). Raises Closed if there
+        are none and the connection has closed.'''
+        if not self.inMessages and not self.alive:
+            raise Closed(self)
+        ret = list(self.inMessages)
+        self.inMessages.clear()
+        self._Taken()
+        return ret
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.Recv()
+        except Closed:
+            raise StopAsyncIteration
+
+    def Write(self, msg):
+        '''enqueues a message to be sent without waiting. Callers that write a lot should periodically await
+        Drain (or use Send) so that a slow reader applies backpressure.'''
+        self.transport.write(message.MessageToBytes(msg))
+
+    def WriteBytes(self, data):
+        '''like Write, but for data that is already encoded (e.g. a frame from another raw connection)'''
+        self.transport.write(data)
+
+    async def Send(self, msg):
+        '''sends a message, waiting if the outgoing buffer is above its high water mark'''
+        self.Write(msg)
+        await self.Drain()
+
+    async def Drain(self):
+        '''waits until the outgoing buffer is below its high water mark. Raises Closed if the connection has
+        closed.'''
+        if not self.alive:
+            raise Closed(self)
+        if self.writable is not None:
+            await self.writable
+            if not self.alive:
+                raise Closed(self)
+
+    async def Close(self):
+        if self.transport is None:
+            return
+        self.transport.close()
+        await self.lost
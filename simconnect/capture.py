@@ -0,0 +1,491 @@
+'''
+Binary capture format for recorded SimConnect sessions. A capture is an append-only file with a small
+header followed by one record per frame:
+
+    header: magic (8s), format version (H), header size (H), SimConnect protocol (L), start time (d)
+    record: timestamp (d), connection ID (L), direction (c), frame length (L), then the raw frame bytes
+
+The start time is the wall clock time (time.time()) of the first frame in the file, and each record's
+timestamp is the number of seconds since then, measured with a monotonic clock. The direction is
+b'c' for frames sent by the client and b's' for frames sent by the server (the same convention as
+message.classMap). The protocol is taken from the first frame written (0 if the capture is empty).
+Frames are stored exactly as they were on the wire, so they get decoded with the normal functions
+in simconnect.message.
+
+Capture files can optionally be stream-compressed, either with zlib (in a gzip container, so that zcat
+works on them) or with lzma. CaptureReader figures out which one was used on its own.
+'''
+
+from . utils import *
+log, logTB = Logger()
+
+import struct, time, os, threading, collections, gzip, lzma, mmap, heapq
+
+MAGIC = b'SCMANCAP'
+VERSION = 1
+headerStruct = struct.Struct('<8sHHLd')
+recordStruct = struct.Struct('<dLcL')
+
+# Supported compression types -> (filename extension, function to open a file for writing)
+COMPRESSORS = {
+    None: ('', lambda filename: open(filename, 'wb')),
+    'gzip': ('.gz', lambda filename: gzip.open(filename, 'wb', compresslevel=6)),
+    'lzma': ('.xz', lambda filename: lzma.open(filename, 'wb', preset=1)),
+}
+
+class CaptureError(Exception): pass
+
+class CaptureFile:
+    '''writes frames to a single capture file, on the caller's thread. Most callers want CaptureWriter instead.'''
+    def __init__(self, filename, compression=None):
+        self.filename = filename
+        self.f = COMPRESSORS[compression][1](filename)
+        self.openedAt = time.monotonic()
+        self.startMonotonic = None # monotonic time that record timestamps are relative to, set by the first frame
+        self.numFrames = 0
+        self.numBytes = 0 # uncompressed bytes written
+
+    def _WriteHeader(self, protocol, ts):
+        self.startMonotonic = ts
+        startTime = ts + (time.time() - time.monotonic()) # wall clock time of the first frame
+        header = headerStruct.pack(MAGIC, VERSION, headerStruct.size, protocol, startTime)
+        self.f.write(header)
+        self.numBytes += len(header)
+
+    def WriteBatch(self, frames):
+        '''writes a list of (ts, connID, direction, frame) with a single write call. Each ts is a time.monotonic()
+        value, and each direction is 'c' or 's'.'''
+        if not frames:
+            return
+        if self.startMonotonic is None:
+            ts, connID, direction, frame = frames[0]
+            self._WriteHeader(struct.unpack_from('<L', frame, 4)[0], ts) # protocol is the 2nd field of every header
+        start = self.startMonotonic
+        pack = recordStruct.pack
+        parts = []
+        for ts, connID, direction, frame in frames:
+            parts.append(pack(ts - start, connID, direction.encode('ascii'), len(frame)))
+            parts.append(frame)
+        data = b''.join(parts)
+        self.f.write(data)
+        self.numFrames += len(frames)
+        self.numBytes += len(data)
+
+    def Write(self, connID, direction, frame, ts=None):
+        '''writes one frame. direction is 'c' or 's'. ts is a time.monotonic() value, defaulting to now.'''
+        if ts is None:
+            ts = time.monotonic()
+        self.WriteBatch([(ts, connID, direction, frame)])
+
+    def Flush(self):
+        self.f.flush()
+
+    def Close(self):
+        if self.startMonotonic is None:
+            self._WriteHeader(0, time.monotonic())
+        self.f.close()
+
+class CaptureWriter:
+    '''records frames to capture files on a background thread, so that the threads handling connections never
+    wait on the disk. Write just appends the frame to a bounded in-memory queue; if the writer thread falls too
+    far behind, new frames are dropped (and counted in numDropped) rather than blocking the caller.
+
+    Files are named <basename>-<date>-<time>.scap (plus .gz or .xz if compressed). If rotateBytes and/or
+    rotateSeconds are given, a new file is started once the current one has that many (uncompressed) bytes
+    or has been open that long. filenames lists every file created so far.'''
+    def __init__(self, basename, compression=None, rotateBytes=None, rotateSeconds=None, maxQueued=100000, batchSize=1000,
+                 writeInterval=0.05):
+        assert compression in COMPRESSORS, compression
+        self.basename = basename
+        self.compression = compression
+        self.rotateBytes = rotateBytes
+        self.rotateSeconds = rotateSeconds
+        self.maxQueued = maxQueued
+        self.batchSize = batchSize # once this many frames are queued, the writer thread is woken up early
+        self.writeInterval = writeInterval # otherwise the writer thread checks for queued frames this often
+        self.queue = collections.deque() # (ts, connID, direction, frame)
+        self.wake = threading.Event()
+        self.keepRunning = True
+        self.file = None # current CaptureFile, opened when the first frame for it arrives
+        self.filenames = []
+        self.numWritten = 0
+        self.numDropped = 0 # frames discarded because the queue was full
+        self.thread = threading.Thread(target=self._Run, name='CaptureWriter', daemon=True)
+        self.thread.start()
+
+    def Write(self, connID, direction, frame, ts=None):
+        '''queues a frame to be written. Safe to call from any thread, and never blocks.'''
+        q = self.queue
+        if len(q) >= self.maxQueued:
+            self.numDropped += 1
+            return
+        if ts is None:
+            ts = time.monotonic()
+        q.append((ts, connID, direction, bytes(frame)))
+        if len(q) == self.batchSize:
+            self.wake.set()
+
+    def Close(self):
+        '''writes out everything still queued, closes the current file, and stops the writer thread'''
+        self.keepRunning = False
+        self.wake.set()
+        self.thread.join()
+        if self.numDropped:
+            log('WARNING: capture dropped', self.numDropped, 'frames')
+
+    def _NextFilename(self):
+        ext = '.scap' + COMPRESSORS[self.compression][0]
+        prefix = self.basename + time.strftime('-%Y%m%d-%H%M%S')
+        filename = prefix + ext
+        i = 1
+        while os.path.exists(filename):
+            filename = '%s-%d%s' % (prefix, i, ext)
+            i += 1
+        return filename
+
+    def _WriteBatch(self, batch):
+        if self.file is None:
+            self.file = CaptureFile(self._NextFilename(), self.compression)
+            self.filenames.append(self.file.filename)
+            log('Capturing to', self.file.filename)
+        self.file.WriteBatch(batch)
+        self.numWritten += len(batch)
+        f = self.file
+        if (self.rotateBytes is not None and f.numBytes >= self.rotateBytes) or \
+           (self.rotateSeconds is not None and time.monotonic() - f.openedAt >= self.rotateSeconds):
+            f.Close()
+            self.file = None
+            if self.numDropped:
+                log('WARNING: capture has dropped', self.numDropped, 'frames so far')
+
+    def _Run(self):
+        q = self.queue
+        idleTime = 0
+        while 1:
+            running = self.keepRunning # (checked before draining so that nothing queued before Close gets lost)
+            if q:
+                idleTime = 0
+                while q:
+                    batch = []
+                    for i in range(min(len(q), self.batchSize)):
+                        batch.append(q.popleft())
+                    try:
+                        self._WriteBatch(batch)
+                    except:
+                        logTB()
+            elif self.file is not None:
+                idleTime += self.writeInterval
+                if idleTime >= 1.0:
+                    self.file.Flush() # things are quiet, so get what we have onto the disk
+                    idleTime = 0
+            if not running:
+                break
+            self.wake.wait(self.writeInterval)
+            self.wake.clear()
+        if self.file is not None:
+            self.file.Close()
+            self.file = None
+
+def ParseHeader(data):
+    '''validates the capture header at the start of data. Returns (headerSize, protocol, startTime).'''
+    if len(data) < headerStruct.size:
+        raise CaptureError('File is too short to be a capture')
+    magic, version, headerSize, protocol, startTime = headerStruct.unpack_from(data)
+    if magic != MAGIC:
+        raise CaptureError('Not a capture file')
+    if version > VERSION:
+        raise CaptureError('Unsupported capture version %d' % version)
+    return headerSize, protocol, startTime
+
+def ReadHeader(f):
+    '''reads and validates a capture header from a file object. Returns (protocol, startTime).'''
+    headerSize, protocol, startTime = ParseHeader(f.read(headerStruct.size))
+    f.read(headerSize - headerStruct.size) # skip any header fields added by later versions
+    return protocol, startTime
+
+def OpenCapture(filename):
+    '''opens a (possibly compressed) capture file for reading, returning a file object'''
+    with open(filename, 'rb') as f:
+        start = f.read(6)
+    if start[:2] == b'\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    if start == b'\xfd7zXZ\x00':
+        return lzma.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def IsCapture(filename):
+    '''returns True if the file looks like a capture file'''
+    try:
+        with OpenCapture(filename) as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (OSError, EOFError, lzma.LZMAError):
+        return False
+
+class CaptureReader:
+    '''reads frames from a capture file. Iterate over it to get (timestamp, connID, direction, frame) tuples,
+    where timestamp is seconds since self.startTime.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = OpenCapture(filename)
+        self.protocol, self.startTime = ReadHeader(self.f)
+
+    def __iter__(self):
+        f = self.f
+        recSize = recordStruct.size
+        unpack = recordStruct.unpack
+        while 1:
+            rec = f.read(recSize)
+            if len(rec) < recSize:
+                break # (a partial record means the capture was cut off while being written)
+            ts, connID, direction, frameLen = unpack(rec)
+            frame = f.read(frameLen)
+            if len(frame) < frameLen:
+                break
+            yield ts, connID, direction.decode('ascii'), frame
+
+    def Close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+# Sidecar index for random access to a capture: a header recording the size of the capture file it was built from
+# (so that a stale index gets rebuilt) and the number of entries and connections, followed by one fixed-size entry
+# per frame, sorted by timestamp:
+#   timestamp (d), offset of the frame in the capture (Q), connection ID (L), message code (L), frame length (L),
+#   direction (c)
+# and then one per connection, sorted by connection ID, so that finding out who is in a capture doesn't take a walk
+# through all of it:
+#   connection ID (L), message code (L) and offset (Q) of the connection's first frame from the client (or 0, 0)
+INDEX_MAGIC = b'SCMANIDX'
+INDEX_VERSION = 2
+indexHeaderStruct = struct.Struct('<8sHxxQQQ')
+indexStruct = struct.Struct('<dQLLLc3x')
+indexConnStruct = struct.Struct('<LLQ')
+indexDtype = [('ts', '<f8'), ('offset', '<u8'), ('conn', '<u4'), ('code', '<u4'), ('length', '<u4'), ('dir', 'S1'), ('_pad', 'V3')] # (the same, for NumPy)
+indexKeyStruct = struct.Struct('<dQ') # the fields index entries are sorted by
+INDEX_RUN_ENTRIES = 100000 # BuildIndex sorts an out of order capture this many entries at a time, then merges the runs
+
+def _CompleteLength(f):
+    '''returns the length of the header and the complete records at the start of the uncompressed capture in the
+    file object f, i.e. where a capture that was cut off should end'''
+    f.seek(0)
+    pos = ParseHeader(f.read(headerStruct.size))[0]
+    end = f.seek(0, os.SEEK_END)
+    while pos + recordStruct.size <= end:
+        f.seek(pos)
+        frameLen = recordStruct.unpack(f.read(recordStruct.size))[3]
+        if pos + recordStruct.size + frameLen > end:
+            break
+        pos += recordStruct.size + frameLen
+    return pos
+
+def Uncompressed(filename):
+    '''returns the name of an uncompressed version of the given capture file - the file itself if it isn't
+    compressed, otherwise a cache file next to it (named <filename>.raw) that it gets decompressed into as needed'''
+    with OpenCapture(filename) as f:
+        if f.__class__ is not gzip.GzipFile and f.__class__ is not lzma.LZMAFile:
+            return filename
+        cacheFilename = filename + '.raw'
+        if os.path.exists(cacheFilename) and os.path.getmtime(cacheFilename) >= os.path.getmtime(filename):
+            return cacheFilename
+        log('Decompressing', filename, 'to', cacheFilename)
+        tmpFilename = cacheFilename + '.tmp'
+        with open(tmpFilename, 'w+b') as out:
+            try:
+                while 1:
+                    chunk = f.read1(1<<20) # (unlike read, doesn't lose what it got if the stream turns out to be cut off)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            except EOFError:
+                # The compressed stream just stops, e.g. because CaptureWriter is still writing it
+                log('WARNING:', filename, 'is incomplete, so only its complete records are available')
+                out.truncate(_CompleteLength(out))
+    os.replace(tmpFilename, cacheFilename)
+    return cacheFilename
+
+def BuildIndex(data, indexFilename):
+    '''scans the capture in data (e.g. an mmap) and writes its index to indexFilename'''
+    headerSize, protocol, startTime = ParseHeader(data)
+    recSize = recordStruct.size
+    unpackRec = recordStruct.unpack_from
+    unpackCode = struct.Struct('<L').unpack_from
+    pack = indexStruct.pack
+    entries = []
+    runs = [] # (file offset, number of entries) of each run of entries written so far, each of them sorted
+    conns = {} # connID -> (code, offset) of its first frame from the client, or (0, 0) if there hasn't been one yet
+    inOrder = True # False once a timestamp is out of order, after which each run gets sorted before it's written
+    lastTS = None
+    end = len(data)
+    offset = headerSize
+    tmpFilename = indexFilename + '.tmp'
+    with open(tmpFilename, 'w+b') as out:
+        out.write(indexHeaderStruct.pack(INDEX_MAGIC, INDEX_VERSION, 0, 0, 0)) # (gets filled in once we're done)
+        while offset + recSize <= end:
+            ts, connID, direction, frameLen = unpackRec(data, offset)
+            frameOffset = offset + recSize
+            if frameOffset + frameLen > end:
+                break # partial record at the end of a capture that was cut off
+            code = unpackCode(data, frameOffset + 8)[0] & 0x0FFFFFFF # code is the 3rd header field in both directions
+            entries.append(pack(ts, frameOffset, connID, code, frameLen, direction))
+            first = conns.get(connID)
+            if first is None or (first[1] == 0 and direction == b'c'):
+                conns[connID] = (code, frameOffset) if direction == b'c' else (0, 0)
+            if lastTS is not None and ts < lastTS:
+                inOrder = False
+            lastTS = ts
+            offset = frameOffset + frameLen
+            if len(entries) >= INDEX_RUN_ENTRIES:
+                _WriteRun(out, entries, runs, inOrder)
+                entries.clear()
+        _WriteRun(out, entries, runs, inOrder)
+        header = indexHeaderStruct.pack(INDEX_MAGIC, INDEX_VERSION, end, sum(count for start, count in runs), len(conns))
+        connTable = b''.join(indexConnStruct.pack(connID, *conns[connID]) for connID in sorted(conns))
+        if inOrder or len(runs) == 1:
+            out.write(connTable)
+            out.seek(0)
+            out.write(header)
+        else:
+            # Frames from different threads can be recorded slightly out of order, so merge the sorted runs by
+            # timestamp into the real index
+            out.flush()
+            mergedFilename = indexFilename + '.merge'
+            with open(mergedFilename, 'wb') as merged:
+                merged.write(header)
+                chunk = []
+                for entry in heapq.merge(*[_ReadRun(out, start, count) for start, count in runs], key=indexKeyStruct.unpack_from):
+                    chunk.append(entry)
+                    if len(chunk) >= 10000:
+                        merged.write(b''.join(chunk))
+                        chunk.clear()
+                merged.write(b''.join(chunk))
+                merged.write(connTable)
+    if inOrder or len(runs) == 1:
+        os.replace(tmpFilename, indexFilename)
+    else:
+        os.replace(mergedFilename, indexFilename)
+        os.remove(tmpFilename)
+
+def _WriteRun(out, entries, runs, inOrder):
+    '''used by BuildIndex to write a run of index entries, sorting them first unless everything so far has been in
+    order (in which case the runs just follow each other)'''
+    if not entries:
+        return
+    if not inOrder:
+        entries.sort(key=indexKeyStruct.unpack_from)
+    runs.append((out.tell(), len(entries)))
+    out.write(b''.join(entries))
+
+def _ReadRun(f, start, count, chunkEntries=4096):
+    '''yields the index entries of the run of count entries that starts at offset start in the file object f, reading
+    a chunk at a time (other runs in the same file may be read in between)'''
+    size = indexStruct.size
+    while count > 0:
+        n = min(count, chunkEntries)
+        f.seek(start)
+        chunk = f.read(n * size)
+        for i in range(0, len(chunk), size):
+            yield chunk[i:i+size]
+        start += n * size
+        count -= n
+
+class IndexedCapture:
+    '''random access to a capture file: memory-maps the capture and its sidecar index (<file>.idx, built the first
+    time it's needed), so that even huge captures can be read with flat memory use. Records are numbered in
+    timestamp order.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.dataFilename = Uncompressed(filename)
+        self.dataFile = open(self.dataFilename, 'rb')
+        self.data = mmap.mmap(self.dataFile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.headerSize, self.protocol, self.startTime = ParseHeader(self.data)
+        self.indexFilename = self.dataFilename + '.idx'
+        if not self._IndexIsCurrent():
+            log('Indexing', self.dataFilename)
+            BuildIndex(self.data, self.indexFilename)
+        self.indexFile = open(self.indexFilename, 'rb')
+        self.index = mmap.mmap(self.indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, dataSize, self.count, self.numConns = indexHeaderStruct.unpack_from(self.index)
+
+    def _IndexIsCurrent(self):
+        try:
+            with open(self.indexFilename, 'rb') as f:
+                magic, version, dataSize, count, numConns = indexHeaderStruct.unpack(f.read(indexHeaderStruct.size))
+        except (OSError, struct.error):
+            return False
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return False
+        return dataSize == len(self.data) # (if not, it was still being written when we indexed it)
+
+    def __len__(self):
+        return self.count
+
+    def Entry(self, i):
+        '''returns the index entry for record i: (timestamp, offset, connID, code, length, direction)'''
+        ts, offset, connID, code, length, direction = indexStruct.unpack_from(self.index, indexHeaderStruct.size + i * indexStruct.size)
+        return ts, offset, connID, code, length, direction.decode('ascii')
+
+    def TimeOf(self, i):
+        '''returns the timestamp of record i'''
+        return struct.unpack_from('<d', self.index, indexHeaderStruct.size + i * indexStruct.size)[0]
+
+    def Seek(self, ts):
+        '''returns the number of the first record whose timestamp is >= ts (or len(self) if there isn't one)'''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.TimeOf(mid) < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def Frame(self, i):
+        '''returns the raw bytes of record i'''
+        ts, offset, connID, code, length, direction = self.Entry(i)
+        return self.data[offset:offset+length]
+
+    def Iter(self, start=0, connID=None):
+        '''yields (i, timestamp, connID, direction, code, offset, length) for each record starting at record number
+        start, optionally only the records for the given connection. The frame itself can be decoded straight out
+        of self.data at offset.'''
+        index = self.index
+        unpack = indexStruct.unpack_from
+        pos = indexHeaderStruct.size + start * indexStruct.size
+        size = indexStruct.size
+        for i in range(start, self.count):
+            ts, offset, recConnID, code, length, direction = unpack(index, pos)
+            pos += size
+            if connID is None or recConnID == connID:
+                yield i, ts, recConnID, 'c' if direction == b'c' else 's', code, offset, length
+
+    def Connections(self):
+        '''returns a list of (connID, code, offset) for each connection in the capture, sorted by ID, where code and
+        offset are those of the connection's first frame from the client (offset is None if there isn't one)'''
+        ret = []
+        pos = indexHeaderStruct.size + self.count * indexStruct.size
+        for i in range(self.numConns):
+            connID, code, offset = indexConnStruct.unpack_from(self.index, pos)
+            ret.append((connID, code, offset or None))
+            pos += indexConnStruct.size
+        return ret
+
+    def ConnectionIDs(self):
+        '''returns a sorted list of the IDs of the connections in the capture'''
+        return [connID for connID, code, offset in self.Connections()]
+
+    def Close(self):
+        self.index.close()
+        self.indexFile.close()
+        self.data.close()
+        self.dataFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
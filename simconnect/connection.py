@@ -2,30 +2,35 @@
 low level SimConnect connection interface - bridges between higher level messages and
 actual data transmission over the wire
 
-TODO: instead of constantly hammering the socket, use select() to determine if it's
-time to do a read or write.
+A Connection can either be pumped by calling Recv/RecvAll in a loop, or be registered with a
+reactor.Reactor, which waits until the socket is actually readable or writable.
 '''
 
 from . utils import *
 log, logTB = Logger()
 
 from . import message
+import collections, threading
 
 class Closed(Exception): pass
 
-def ClientConnection(sock): return Connection(Connection.CT_Client, sock)
-def ServerConnection(sock): return Connection(Connection.CT_Server, sock)
+def ClientConnection(sock, **kwargs): return Connection(Connection.CT_Client, sock, **kwargs)
+def ServerConnection(sock, **kwargs): return Connection(Connection.CT_Server, sock, **kwargs)
 
 # Server and client message handling is largely identical - but not quite - so use a common
 # class for both types
 class Connection:
     CT_Client, CT_Server = range(2) # type of agent on the other end of this connection
-    def __init__(self, type, sock, maxPacketSize=4096):
+    VM_Off, VM_Sampled, VM_Always = range(3) # how often received messages get re-encoded to verify the codec
+    def __init__(self, type, sock, maxPacketSize=4096, verifyMode=VM_Sampled, verifyEvery=100, compactAt=65536, rawFrames=False):
         self.type = type # one of CT_*
         if type == self.CT_Client:
             self.FromBufferFunc = message.ClientMessageFromBuffer
+            self.FrameFunc = message.ClientFrameFromBuffer
         else:
             self.FromBufferFunc = message.ServerMessageFromBuffer
+            self.FrameFunc = message.ServerFrameFromBuffer
+        self.rawFrames = rawFrames # if True, received data is split into (msgCode, frameBytes) instead of decoded into messages
         sock.setblocking(False)
         self.sock = sock
         self.maxPacketSize = maxPacketSize
@@ -33,56 +38,210 @@ class Connection:
         self.readBuffer = bytearray(maxPacketSize) # slab of mem to read data into to avoid reallocs
         self.readView = memoryview(self.readBuffer) # for sock.recv_into support
         self.outBytes = bytearray() # raw bytes from messages that we are waiting to send
+        self.outPos = 0 # send cursor into outBytes - everything before it has already been sent
+        self.outLock = threading.Lock() # Send and Flush may get called from different threads
         self.inBytes = bytearray() # raw packet data waiting to be converted into messages
-        self.inMessages = [] # full-formed messages waiting to be returned to the caller
+        self.inPos = 0 # read cursor into inBytes - everything before it has already been converted
+        self.compactAt = compactAt # once inPos/outPos get this far, already-processed data is dropped from inBytes/outBytes
+        self.maxReadsPerPump = 16 # upper limit on recv calls per pump, so one busy connection can't starve others
+        self.inMessages = collections.deque() # full-formed messages waiting to be returned to the caller
+        self.numDecoded = 0 # number of messages decoded so far
+        self.numVerified = 0 # number of decoded messages that were also checked by re-encoding them
+        self.numVerifyFailures = 0 # number of checked messages whose encoding didn't match the raw bytes
+        self.lastVerifyFailure = None # (msg, raw, enc) for the most recent failure
+        self.SetVerifyMode(verifyMode, verifyEvery)
+        self.capWriter = None # capture.CaptureWriter that gets a copy of every frame, if any
+        self.capConnID = 0
+        self.recvDir, self.sendDir = ('c', 's') if type == self.CT_Client else ('s', 'c') # capture directions
 
-    def Send(self, msg):
-        '''Enqueues a message to be sent. Doesn't actually send the data though - you have to
-        call Recv to actually run the message pump.'''
-        self.outBytes.extend(message.MessageToBytes(msg))
+    def SetCapture(self, writer, connID):
+        '''records every frame sent or received on this connection (as connection connID) to a capture.CaptureWriter,
+        or stops recording if writer is None'''
+        self.capWriter = writer
+        self.capConnID = connID
 
-    def Recv(self):
-        '''pumps data in both directions as needed, and then returns the next available message
-        that has been read. It is assumed that the owner of the connection calls this often in a
-        loop of some sort.'''
+    def SetVerifyMode(self, mode, every=None):
+        '''Controls how received messages get verified: VM_Off, VM_Sampled (verifies 1 in every N messages), or
+        VM_Always. Verifying means re-encoding the decoded message and comparing it to the raw bytes we received,
+        which roughly doubles the cost of receiving, so it's best kept for tests and debugging.'''
+        assert mode in (self.VM_Off, self.VM_Sampled, self.VM_Always), mode
+        self.verifyMode = mode
+        if every is not None:
+            assert every > 0, every
+            self.verifyEvery = every
+
+    def _ShouldVerify(self):
+        if self.verifyMode == self.VM_Off:
+            return False
+        if self.verifyMode == self.VM_Always:
+            return True
+        return self.numDecoded % self.verifyEvery == 0
+
+    def _Verify(self, msg, raw):
+        '''re-encodes msg and compares it to the raw bytes it was decoded from. Mismatches are counted and logged,
+        but are not fatal.'''
+        self.numVerified += 1
+        enc = message.MessageToBytes(msg)
+        if raw != enc:
+            self.numVerifyFailures += 1
+            self.lastVerifyFailure = (msg, bytes(raw), bytes(enc))
+            log('ENCODING FAILURE (%d of %d verified)' % (self.numVerifyFailures, self.numVerified))
+            log('MSG:', msg)
+            log('RAW:', bytes(raw).hex())
+            log('ENC:', bytes(enc).hex())
+
+    def SendBytes(self, data, flush=False):
+        '''Like Send, but for data that is already encoded (e.g. a frame from another raw connection). When capturing,
+        data must be exactly one frame.'''
+        if self.capWriter is not None:
+            self.capWriter.Write(self.capConnID, self.sendDir, data)
+        with self.outLock:
+            self.outBytes.extend(data)
+        if flush:
+            self.Flush()
+
+    def Send(self, msg, flush=False):
+        '''Enqueues a message to be sent. Normally doesn't actually send the data though - you have to
+        call Recv (or Flush) to actually run the message pump. If flush is True, tries to send it (along
+        with anything else that is pending) right away.'''
+        data = message.MessageToBytes(msg)
+        if self.capWriter is not None:
+            self.capWriter.Write(self.capConnID, self.sendDir, data)
+        with self.outLock:
+            self.outBytes.extend(data)
+        if flush:
+            self.Flush()
+
+    def WantsWrite(self):
+        '''returns True if there is data waiting to be sent'''
+        return self.outPos < len(self.outBytes)
+
+    def NumPending(self):
+        '''returns the number of bytes waiting to be sent'''
+        return len(self.outBytes) - self.outPos
+
+    def fileno(self):
+        '''lets a Connection be used directly with select/selectors'''
+        return self.sock.fileno()
+
+    def Flush(self):
+        '''Sends as much pending data as the socket will accept without blocking. Returns the number of
+        bytes sent.'''
+        totalSent = 0
+        with self.outLock:
+            out = self.outBytes
+            while self.alive and self.outPos < len(out):
+                try:
+                    with memoryview(out) as view:
+                        numSent = self.sock.send(view[self.outPos:])
+                except BlockingIOError:
+                    break # no more data can be written right now
+                except (ConnectionResetError, BrokenPipeError):
+                    self.alive = False
+                    break
+                self.outPos += numSent
+                totalSent += numSent
+
+            # Drop data that has been sent, but only once in a while unless it's free to do so
+            if self.outPos == len(out):
+                out.clear()
+                self.outPos = 0
+            elif self.outPos >= self.compactAt:
+                del out[:self.outPos]
+                self.outPos = 0
+        return totalSent
+
+    def PumpRecv(self):
+        '''Reads whatever data is available on the socket (without blocking) and converts as much of it as possible
+        into messages, which are queued up for Recv/RecvAll. Returns the number of bytes read.'''
+        totalRead = 0
         if self.alive:
-            # Try to send some pending data if needed
-            if len(self.outBytes) > 0:
+            for i in range(self.maxReadsPerPump):
                 try:
-                    numSent = self.sock.send(self.outBytes[:self.maxPacketSize])
-                    self.outBytes = self.outBytes[numSent:]
+                    numRead = self.sock.recv_into(self.readView, self.maxPacketSize)
                 except BlockingIOError:
-                    pass # no data can be written right now
-
-            # See if we can read any additional data
-            try:
-                numRead = self.sock.recv_into(self.readView, self.maxPacketSize)
-                if numRead > 0:
-                    self.inBytes.extend(self.readView[:numRead])
-            except BlockingIOError:
-                pass # no data to be read right now
-            except ConnectionResetError:
-                self.alive = False
-
-        # See if we can assemble any read data into whole messages
-        msg, numConsumed = self.FromBufferFunc(self.inBytes)
-        if msg is not None:
-            self.inMessages.append(msg)
-            raw = self.inBytes[:numConsumed]
-            enc = message.MessageToBytes(msg)
-            if raw != enc:
-                log('MSG:', msg)
-                log('RAW:', raw)
-                log('ENC:', enc)
-                assert 0, 'ENCODING FAILURE'
-            self.inBytes = self.inBytes[numConsumed:]
+                    break # no data to be read right now
+                except ConnectionResetError:
+                    self.alive = False
+                    break
+                if numRead == 0:
+                    self.alive = False # orderly shutdown by the other side
+                    break
+                self.inBytes.extend(self.readView[:numRead])
+                totalRead += numRead
+                if numRead < self.maxPacketSize:
+                    break # socket has been drained
+
+        # Assemble as many whole messages as we can, parsing in place
+        buf = self.inBytes
+        pos = self.inPos
+        capWriter = self.capWriter
+        try:
+            if self.rawFrames:
+                while 1:
+                    code, numConsumed = self.FrameFunc(buf, pos)
+                    if code is None:
+                        break
+                    frame = buf[pos:pos+numConsumed]
+                    self.inMessages.append((code, frame))
+                    if capWriter is not None:
+                        capWriter.Write(self.capConnID, self.recvDir, frame)
+                    pos += numConsumed
+            else:
+                while 1:
+                    msg, numConsumed = self.FromBufferFunc(buf, pos)
+                    if msg is None:
+                        break
+                    if capWriter is not None:
+                        capWriter.Write(self.capConnID, self.recvDir, buf[pos:pos+numConsumed])
+                    self.inMessages.append(msg)
+                    self.numDecoded += 1
+                    if self._ShouldVerify():
+                        self._Verify(msg, buf[pos:pos+numConsumed])
+                    pos += numConsumed
+        except message.FramingError as e:
+            # There's no way to find the next message, so give up on the connection (keeping what came before)
+            log('ERROR: dropping connection:', e)
+            self.alive = False
+            pos = len(buf)
+
+        # Drop data that has already been converted, but only once in a while since it means moving what's left
+        if pos == len(buf):
+            buf.clear() # (cheap: nothing left to move)
+            pos = 0
+        elif pos >= self.compactAt:
+            del buf[:pos]
+            pos = 0
+        self.inPos = pos
+        return totalRead
+
+    def Recv(self):
+        '''pumps data in both directions as needed, and then returns the next available message
+        that has been read (or, if rawFrames is set, the next (msgCode, frameBytes) tuple). It is
+        assumed that the owner of the connection calls this often in a loop of some sort.'''
+        self.Flush()
+        if not self.inMessages:
+            self.PumpRecv()
 
         # Finally, return a message if we have one ready
         try:
-            return self.inMessages.pop(0)
+            return self.inMessages.popleft()
         except IndexError:
             # No pending messages
             if not self.alive:
                 raise Closed(self)
             return None
 
+    def RecvAll(self):
+        '''Like Recv, but returns a list of all messages that are available (an empty list if there are none)'''
+        self.Flush()
+        self.PumpRecv()
+        if not self.inMessages and not self.alive:
+            raise Closed(self)
+        ret = list(self.inMessages)
+        self.inMessages.clear()
+        return ret
+
+    def __iter__(self):
+        '''allows "for msg in conn" to process all messages that are available right now'''
+        return iter(self.RecvAll())
@@ -15,6 +15,13 @@ class DATA_REQUEST_FLAG:
     TAGGED  = 0x00000002 # send requested data in tagged format
     BLOCK   = 0x00000004 # Block server when data is sent
 
+def ParseDataRequestFlags(text):
+    '''converts e.g. "tagged,changed" to DATA_REQUEST_FLAG bits'''
+    flags = 0
+    for name in filter(None, text.split(',')):
+        flags |= getattr(DATA_REQUEST_FLAG, name.strip().upper())
+    return flags
+
 class DATATYPE:
     (
     INVALID,                 # invalid data type
@@ -52,3 +59,45 @@ class DATATYPE:
 
 
 
+class EXCEPTION:
+    '''SIMCONNECT_EXCEPTION values, sent in SException messages'''
+    (
+    NONE,
+    ERROR,
+    SIZE_MISMATCH,
+    UNRECOGNIZED_ID,
+    UNOPENED,
+    VERSION_MISMATCH,
+    TOO_MANY_GROUPS,
+    NAME_UNRECOGNIZED,
+    TOO_MANY_EVENT_NAMES,
+    EVENT_ID_DUPLICATE,
+    TOO_MANY_MAPS,
+    TOO_MANY_OBJECTS,
+    TOO_MANY_REQUESTS,
+    WEATHER_INVALID_PORT,
+    WEATHER_INVALID_METAR,
+    WEATHER_UNABLE_TO_GET_OBSERVATION,
+    WEATHER_UNABLE_TO_CREATE_STATION,
+    WEATHER_UNABLE_TO_REMOVE_STATION,
+    INVALID_DATA_TYPE,
+    INVALID_DATA_SIZE,
+    DATA_ERROR,
+    INVALID_ARRAY,
+    CREATE_OBJECT_FAILED,
+    LOAD_FLIGHTPLAN_FAILED,
+    OPERATION_INVALID_FOR_OBJECT_TYPE,
+    ILLEGAL_OPERATION,
+    ALREADY_SUBSCRIBED,
+    INVALID_ENUM,
+    DEFINITION_ERROR,
+    DUPLICATE_ID,
+    DATUM_ID,
+    OUT_OF_BOUNDS,
+    ALREADY_CREATED,
+    OBJECT_OUTSIDE_REALITY_BUBBLE,
+    OBJECT_CONTAINER,
+    OBJECT_AI,
+    OBJECT_ATC,
+    OBJECT_SCHEDULE) = range(38)
+
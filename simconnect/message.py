@@ -4,39 +4,38 @@ with functions for converting from raw data to messages. Messages are defined by
 e.g. a client message is not a message *to* a client but a message *from* a client.
 '''
 
-import struct
+import struct, operator
 
 classMap = {} # (fromAgent ('s' or 'c'), msgCode) --> class for this message
 
+class FramingError(ValueError):
+    '''raised when a message header claims a size too small to even hold the header, i.e. the stream is garbage
+    (and, since the size is all there is to go on, can't be resynced)'''
+
 class BaseStruct:
     '''base class for app-specific struct subclasses'''
     members = [] # list of (name, StructValue), populated by MakeStruct
+    runs = [] # list of _FixedRun/_MemberRun objects covering members, populated by MakeStruct
+    countFields = [] # list of (arrayMemberName, countFieldName) for variable length arrays, populated by MakeStruct
     @classmethod
     def FromBytes(cls, buffer, offset=0):
         '''creates an object from a buffer. Returns (newObj, bytesConsumedFromBuffer)'''
         obj = cls()
-        totalConsumed = 0
-        for name, sv in cls.members:
-            v, consumed = sv.FromBytes(buffer, offset, obj)
-            offset += consumed
-            totalConsumed += consumed
-            setattr(obj, name, v)
-        return obj, totalConsumed
+        start = offset
+        for run in cls.runs:
+            offset += run.Unpack(buffer, offset, obj)
+        return obj, offset - start
 
     def ToBytes(self):
-        '''converts the object instance into a bytearray and returns it'''
+        '''converts the object instance into a bytearray (or bytes) and returns it'''
         # In order to support structs that have variable length array members, we first
         # have to update any array fields
-        for name, sv in self.members:
-            if isinstance(sv, Array) and sv.countField is not None:
-                theArray = getattr(self, name)
-                setattr(self, sv.countField, len(theArray))
+        for name, countField in self.countFields:
+            setattr(self, countField, len(getattr(self, name)))
 
         ret = bytearray()
-        for name, sv in self.members:
-            v = getattr(self, name)
-            more = sv.ToBytes(v)
-            ret.extend(more)
+        for run in self.runs:
+            ret.extend(run.Pack(self))
         return ret
 
     def __repr__(self):
@@ -101,7 +100,7 @@ class StructValue:
             self.structClass = formatOrStructClass
         else:
             self.format = formatOrStructClass
-            self.size = struct.calcsize(self.format)
+            self.size = struct.calcsize('<' + self.format) # for now we always assume little endian
 
     def FromBytes(self, buffer, offset, intoObj=None):
         if self.structClass is not None:
@@ -134,33 +133,255 @@ class StructValue:
             return value
         assert 0, 'No idea what to do with ' + repr(value)
 
+K_VALUE, K_STRING, K_ARRAY = range(3) # kinds of members that can be part of a _FixedRun
+
+class _FixedRun:
+    '''Used internally, a run of consecutive fixed-size struct members (plain values, strings, and
+    fixed-length arrays of plain values) that get decoded/encoded with a single precompiled struct.Struct'''
+    def __init__(self):
+        self.fields = [] # list of (name, K_*, numStructValues)
+        self.formats = []
+
+    @staticmethod
+    def CanHold(sv):
+        '''returns True if the given StructValue can be added to a run'''
+        if sv.format is not None:
+            return True
+        arr = sv.structClass
+        return isinstance(arr, Array) and arr.count is not None and arr.structValue.format is not None \
+               and not arr.structValue.format.endswith('s')
+
+    def Add(self, name, sv):
+        if sv.format is not None:
+            kind = K_STRING if sv.format.endswith('s') else K_VALUE
+            self.fields.append((name, kind, 1))
+            self.formats.append(sv.format)
+        else:
+            arr = sv.structClass
+            self.fields.append((name, K_ARRAY, arr.count))
+            self.formats.append(arr.structValue.format * arr.count)
+
+    def Compile(self):
+        self.codec = struct.Struct('<' + ''.join(self.formats))
+        self.size = self.codec.size
+        self.names = tuple(name for name, kind, count in self.fields)
+        self.plain = all(kind == K_VALUE for name, kind, count in self.fields) # True if no post-processing is needed
+        self.getter = operator.attrgetter(*self.names)
+        return self
+
+    def Unpack(self, buffer, offset, intoObj):
+        '''decodes the run from the buffer and sets the values on intoObj. Returns the number of bytes consumed.'''
+        vals = self.codec.unpack_from(buffer, offset)
+        if self.plain:
+            intoObj.__dict__.update(zip(self.names, vals))
+        else:
+            i = 0
+            for name, kind, count in self.fields:
+                if kind == K_VALUE:
+                    v = vals[i]
+                elif kind == K_STRING:
+                    v = vals[i].split(b'\x00', 1)[0].decode('latin-1') # auto decode and null-strip strings
+                else:
+                    v = list(vals[i:i+count])
+                i += count
+                setattr(intoObj, name, v)
+        return self.size
+
+    def Pack(self, obj):
+        vals = self.getter(obj)
+        if len(self.names) == 1:
+            vals = (vals,)
+        if self.plain:
+            return self.codec.pack(*vals)
+        args = []
+        for (name, kind, count), v in zip(self.fields, vals):
+            if kind == K_VALUE:
+                args.append(v)
+            elif kind == K_STRING:
+                args.append(v.encode('latin-1')) # struct null-pads (or truncates) to the field size
+            else:
+                assert len(v) == count, (name, v)
+                args.extend(v)
+        return self.codec.pack(*args)
+
+class _MemberRun:
+    '''Used internally, wraps a single variable-size member (e.g. a counted Array or Remaining) so it can
+    be processed alongside _FixedRuns'''
+    def __init__(self, name, sv):
+        self.name = name
+        self.sv = sv
+
+    def Unpack(self, buffer, offset, intoObj):
+        v, consumed = self.sv.FromBytes(buffer, offset, intoObj)
+        setattr(intoObj, self.name, v)
+        return consumed
+
+    def Pack(self, obj):
+        return self.sv.ToBytes(getattr(obj, self.name))
+
+def CompileRuns(members):
+    '''groups a list of (name, StructValue) into a list of _FixedRun and _MemberRun objects'''
+    runs = []
+    cur = None
+    for name, sv in members:
+        if _FixedRun.CanHold(sv):
+            if cur is None:
+                cur = _FixedRun()
+                runs.append(cur)
+            cur.Add(name, sv)
+        else:
+            cur = None
+            runs.append(_MemberRun(name, sv))
+    return [r.Compile() if isinstance(r, _FixedRun) else r for r in runs]
+
+def _GenerateCodec(klass):
+    '''builds specialized FromBytes and ToBytes functions for the given struct class from source (similar to
+    what collections.namedtuple does), with the field names, string handling, and array counts all inlined.
+    Returns (fromBytesFunc, toBytesFunc, source)'''
+    ns = dict(_new=object.__new__, _pack=struct.pack, _unpack_from=struct.unpack_from)
+    dec = ['def FromBytes(cls, buffer, offset=0):', '    obj = _new(cls)']
+    enc = ['def ToBytes(self):']
+    encParts = [] # expressions that produce the bytes for each run
+    fixedSize = True # stays True if every member is a fixed size
+    for name, countField in klass.countFields:
+        enc.append('    self.%s = len(self.%s)' % (countField, name))
+    for i, run in enumerate(klass.runs):
+        if isinstance(run, _FixedRun):
+            s = '_s%d' % i
+            ns[s] = run.codec
+            if run.plain:
+                targets = ''.join('obj.%s, ' % name for name in run.names)
+                dec.append('    %s= %s.unpack_from(buffer, offset)' % (targets, s))
+                args = ', '.join('self.%s' % name for name in run.names)
+            else:
+                targets = ''.join('v%d, ' % j for j in range(sum(count for name, kind, count in run.fields)))
+                dec.append('    %s= %s.unpack_from(buffer, offset)' % (targets, s))
+                args = []
+                j = 0
+                for name, kind, count in run.fields:
+                    if kind == K_VALUE:
+                        dec.append('    obj.%s = v%d' % (name, j))
+                        args.append('self.%s' % name)
+                    elif kind == K_STRING:
+                        dec.append("    obj.%s = v%d.split(b'\\x00', 1)[0].decode('latin-1')" % (name, j))
+                        args.append("self.%s.encode('latin-1')" % name)
+                    else:
+                        dec.append('    obj.%s = [%s]' % (name, ', '.join('v%d' % k for k in range(j, j+count))))
+                        args.append('*self.%s' % name)
+                    j += count
+                args = ', '.join(args)
+            dec.append('    offset += %d' % run.size)
+            encParts.append('%s.pack(%s)' % (s, args))
+            continue
+
+        fixedSize = False
+        name, sc = run.name, run.sv.structClass
+        if isinstance(sc, Remaining):
+            dec.append("    obj.%s = b''" % name) # the lower level code will set it
+            encParts.append('self.%s' % name)
+        elif isinstance(sc, Array) and (sc.structValue.format is None or not sc.structValue.format.endswith('s')):
+            count = 'obj.%s' % sc.countField if sc.count is None else str(sc.count)
+            itemSV = sc.structValue
+            if itemSV.format is not None:
+                dec.append("    n = %s" % count)
+                dec.append("    obj.%s = list(_unpack_from('<%%d%s' %% n, buffer, offset))" % (name, itemSV.format))
+                dec.append('    offset += n * %d' % itemSV.size)
+                encParts.append("_pack('<%%d%s' %% len(self.%s), *self.%s)" % (itemSV.format, name, name))
+            else:
+                c = '_c%d' % i
+                ns[c] = itemSV.structClass
+                dec.extend(['    items = []',
+                            '    for _ in range(%s):' % count,
+                            '        item, consumed = %s.FromBytes(buffer, offset)' % c,
+                            '        offset += consumed',
+                            '        items.append(item)',
+                            '    obj.%s = items' % name])
+                encParts.append("b''.join([item.ToBytes() for item in self.%s])" % name)
+        elif isinstance(sc, type) and issubclass(sc, BaseStruct):
+            c = '_c%d' % i
+            ns[c] = sc
+            dec.extend(['    obj.%s, consumed = %s.FromBytes(buffer, offset)' % (name, c),
+                        '    offset += consumed'])
+            encParts.append('self.%s.ToBytes()' % name)
+        else:
+            # Something unusual - just let the run handle it
+            m = '_m%d' % i
+            ns[m] = run
+            dec.append('    offset += %s.Unpack(buffer, offset, obj)' % m)
+            encParts.append('%s.Pack(self)' % m)
+
+    if fixedSize:
+        # Consecutive fixed-size members all end up in a single run, so there's no need to track the offset
+        dec = [x for x in dec if not x.startswith('    offset += ')]
+        dec.append('    return obj, %d' % sum(run.size for run in klass.runs))
+    else:
+        dec.insert(1, '    start = offset')
+        dec.append('    return obj, offset - start')
+
+    if not encParts:
+        enc.append("    return b''")
+    elif len(encParts) == 1:
+        enc.append('    return %s' % encParts[0])
+    else:
+        enc.append('    ret = bytearray(%s)' % encParts[0])
+        for part in encParts[1:]:
+            enc.append('    ret += %s' % part)
+        enc.append('    return ret')
+
+    source = '\n'.join(dec) + '\n\n' + '\n'.join(enc) + '\n'
+    exec(source, ns)
+    return ns['FromBytes'], ns['ToBytes'], source
+
+structClasses = [] # every class created by MakeStruct, in creation order
+
+def UseGeneratedCodecs(enable=True):
+    '''if enable is True (the default, and the initial state), struct classes use their generated FromBytes/ToBytes
+    functions; otherwise they fall back to the generic BaseStruct versions (useful for benchmarking and debugging)'''
+    for klass in structClasses:
+        if enable:
+            klass.FromBytes = classmethod(klass._genFromBytes)
+            klass.ToBytes = klass._genToBytes
+        else:
+            klass.FromBytes = BaseStruct.__dict__['FromBytes'] # i.e. the classmethod itself, not bound to BaseStruct
+            klass.ToBytes = BaseStruct.ToBytes
+
 def MakeStruct(klassName, **kwargs):
     '''creates and returns a new BaseStruct subclass (also adds it to globals()) with the given members'''
     members = []
     for k,v in kwargs.items(): # as of py3.6, kwargs preserves ordering
         members.append((k, StructValue(v)))
-    klass = type(klassName, (BaseStruct,), dict(members=members))
+    countFields = [(k, sv.structClass.countField) for k, sv in members
+                   if isinstance(sv.structClass, Array) and sv.structClass.countField is not None]
+    klass = type(klassName, (BaseStruct,), dict(members=members, runs=CompileRuns(members), countFields=countFields))
+    klass._genFromBytes, klass._genToBytes, klass._source = _GenerateCodec(klass)
+    klass.FromBytes = classmethod(klass._genFromBytes)
+    klass.ToBytes = klass._genToBytes
+    structClasses.append(klass)
     globals()[klassName] = klass
     return klass
 
 clientHeaderFormat = '<LLLL'
-clientHeaderSize = struct.calcsize(clientHeaderFormat)
-def ClientMessageFromBuffer(buffer):
-    '''Given some raw data (in e.g. a bytearray), extracts one message from it if possible, returning
-    (thatMessage, numberOfBytesConsumed). If there isn't enough data for a message, returns
-    (None, 0). Used by the Connection class.'''
-    if len(buffer) < clientHeaderSize:
+clientHeaderStruct = struct.Struct(clientHeaderFormat)
+clientHeaderSize = clientHeaderStruct.size
+def ClientMessageFromBuffer(buffer, offset=0):
+    '''Given some raw data (in e.g. a bytearray), extracts one message from it (starting at offset) if possible,
+    returning (thatMessage, numberOfBytesConsumed). If there isn't enough data for a message, returns
+    (None, 0). Raises FramingError if the header's size is too small to be real. Used by the Connection class.'''
+    if len(buffer) - offset < clientHeaderSize:
         # Don't even have enough to read a header yet
         return None, 0
 
-    messageSize, protocol, code, counter = struct.unpack(clientHeaderFormat, buffer[:clientHeaderSize])
-    if len(buffer) < messageSize:
+    messageSize, protocol, code, counter = clientHeaderStruct.unpack_from(buffer, offset)
+    if messageSize < clientHeaderSize:
+        raise FramingError('message size %d is smaller than the header' % messageSize)
+    end = offset + messageSize
+    if len(buffer) < end:
         # We have some data, but not a full message
         return None, 0
 
     code = code & 0x0FFFFFFF # some high bits set for some reason
     klass = classMap[('c', code)]
-    msg, consumed = klass.FromBytes(buffer, clientHeaderSize)
+    msg, consumed = klass.FromBytes(buffer, offset + clientHeaderSize)
     msg._protocol = protocol
     msg._counter = counter
     remaining = messageSize - clientHeaderSize - consumed
@@ -168,25 +389,29 @@ def ClientMessageFromBuffer(buffer):
     if remaining > 0:
         # look for a Remaining member parameter and use its name to set the data on the object
         name, sv = klass.members[-1]
-        assert isinstance(sv, Remaining), '%d bytes remain for %s, expected a Remaining parameter' % (remaining, msg)
-        setattr(msg, name, buffer[clientHeaderSize+consumed:messageSize])
+        assert isinstance(sv.structClass, Remaining), '%d bytes remain for %s, expected a Remaining parameter' % (remaining, msg)
+        setattr(msg, name, buffer[end-remaining:end])
     return msg, messageSize
 
 serverHeaderFormat = '<LLL'
-serverHeaderSize = struct.calcsize(serverHeaderFormat)
-def ServerMessageFromBuffer(buffer):
-    if len(buffer) < serverHeaderSize:
+serverHeaderStruct = struct.Struct(serverHeaderFormat)
+serverHeaderSize = serverHeaderStruct.size
+def ServerMessageFromBuffer(buffer, offset=0):
+    if len(buffer) - offset < serverHeaderSize:
         # Don't even have enough to read a header yet
         return None, 0
 
-    messageSize, protocol, code = struct.unpack(serverHeaderFormat, buffer[:serverHeaderSize])
-    if len(buffer) < messageSize:
+    messageSize, protocol, code = serverHeaderStruct.unpack_from(buffer, offset)
+    if messageSize < serverHeaderSize:
+        raise FramingError('message size %d is smaller than the header' % messageSize)
+    end = offset + messageSize
+    if len(buffer) < end:
         # We have some data, but not a full message
         return None, 0
 
     code = code & 0x0FFFFFFF # some high bits set for some reason
     klass = classMap[('s', code)]
-    msg, consumed = klass.FromBytes(buffer, serverHeaderSize)
+    msg, consumed = klass.FromBytes(buffer, offset + serverHeaderSize)
     msg._protocol = protocol
     remaining = messageSize - serverHeaderSize - consumed
     assert remaining >= 0, (remaining, msg, messageSize, serverHeaderSize, consumed)
@@ -194,9 +419,33 @@ def ServerMessageFromBuffer(buffer):
         # look for a Remaining member parameter and use its name to set the data on the object
         name, sv = klass.members[-1]
         assert isinstance(sv.structClass, Remaining), '%d bytes remain for %s, expected a Remaining parameter' % (remaining, msg)
-        setattr(msg, name, buffer[serverHeaderSize+consumed:messageSize])
+        setattr(msg, name, buffer[end-remaining:end])
     return msg, messageSize
 
+def ClientFrameFromBuffer(buffer, offset=0):
+    '''Like ClientMessageFromBuffer, but only looks at the header instead of decoding the message. Returns
+    (msgCode, frameSize) for the next complete message in the buffer (starting at offset), or (None, 0). Like it,
+    raises FramingError if the header is bogus.'''
+    if len(buffer) - offset < clientHeaderSize:
+        return None, 0
+    messageSize, protocol, code, counter = clientHeaderStruct.unpack_from(buffer, offset)
+    if messageSize < clientHeaderSize:
+        raise FramingError('message size %d is smaller than the header' % messageSize)
+    if len(buffer) - offset < messageSize:
+        return None, 0
+    return code & 0x0FFFFFFF, messageSize
+
+def ServerFrameFromBuffer(buffer, offset=0):
+    '''the server message version of ClientFrameFromBuffer'''
+    if len(buffer) - offset < serverHeaderSize:
+        return None, 0
+    messageSize, protocol, code = serverHeaderStruct.unpack_from(buffer, offset)
+    if messageSize < serverHeaderSize:
+        raise FramingError('message size %d is smaller than the header' % messageSize)
+    if len(buffer) - offset < messageSize:
+        return None, 0
+    return code & 0x0FFFFFFF, messageSize
+
 def ClientMessage(code, klassName, **kwargs):
     klass = MakeStruct(klassName, **kwargs)
     klass.code = code
@@ -216,10 +465,10 @@ def MessageToBytes(msg):
     if msg.fromAgent == 'c':
         size = clientHeaderSize + len(b)
         code = msg.code | 0xF0000000 # not sure why we have to set these bits but ...
-        return struct.pack(clientHeaderFormat, size, msg._protocol, code, msg._counter) + b
+        return clientHeaderStruct.pack(size, msg._protocol, code, msg._counter) + b
     else:
         size = serverHeaderSize + len(b)
-        return struct.pack(serverHeaderFormat, size, msg._protocol, msg.code) + b
+        return serverHeaderStruct.pack(size, msg._protocol, msg.code) + b
 
 # ----------------------------------------------------------------------------------------------
 # Client messages
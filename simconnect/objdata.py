@@ -0,0 +1,122 @@
+'''
+Tracks the data definitions a client sets up (via CAddToDataDefinition) and the requests that use them (via
+CRequestDataOnSimObject[Type]), so that the payloads of SSimObjectData[ByType] messages can be turned back
+into named values. Used by the tools that look at recorded sessions.
+
+Example:
+    defs = objdata.DataDefinitions()
+    for msg in msgs: # all the messages on one connection, in order
+        defs.Track(msg)
+        if isinstance(msg, message.SSimObjectData):
+            for datum, value in defs.Decode(msg):
+                print(datum.name, value)
+'''
+
+from . utils import *
+log, logTB = Logger()
+
+import struct
+from . import message, defs as SC
+
+UNUSED = 0xFFFFFFFF # SIMCONNECT_UNUSED, what clients pass as the datumID when they don't care
+
+# SC.DATATYPE -> struct format for the data types we know how to decode
+DT = SC.DATATYPE
+DATATYPE_FORMATS = {
+    DT.INT32: 'i', DT.INT64: 'q', DT.FLOAT32: 'f', DT.FLOAT64: 'd',
+    DT.STRING8: '8s', DT.STRING32: '32s', DT.STRING64: '64s', DT.STRING128: '128s', DT.STRING256: '256s', DT.STRING260: '260s',
+    DT.WSTRING8: '16s', DT.WSTRING32: '64s', DT.WSTRING64: '128s', DT.WSTRING128: '256s', DT.WSTRING256: '512s', DT.WSTRING260: '520s',
+    DT.LATLONALT: 'ddd', DT.XYZ: 'ddd', DT.PBH: 'fff',
+}
+WIDE_STRING_TYPES = {DT.WSTRING8, DT.WSTRING32, DT.WSTRING64, DT.WSTRING128, DT.WSTRING256, DT.WSTRING260}
+del DT
+
+class Datum:
+    '''one item in a data definition'''
+    def __init__(self, msg, index):
+        self.datumID = msg.datumID if msg.datumID != UNUSED else index
+        self.index = index # position within the data definition
+        self.name = msg.datumName
+        self.units = msg.unitsName
+        self.dataType = msg.dataType
+        self.epsilon = msg.epsilon
+        fmt = DATATYPE_FORMATS.get(self.dataType)
+        self.struct = None if fmt is None else struct.Struct('<' + fmt) # None if we can't decode this type
+        self.size = 0 if fmt is None else self.struct.size
+
+    def Unpack(self, buffer, offset):
+        '''returns the value stored at the given offset'''
+        vals = self.struct.unpack_from(buffer, offset)
+        if len(vals) > 1:
+            return vals # (LATLONALT, XYZ, PBH)
+        v = vals[0]
+        if type(v) is bytes:
+            if self.dataType in WIDE_STRING_TYPES:
+                return v.decode('utf-16-le', 'replace').split('\x00', 1)[0]
+            return v.split(b'\x00', 1)[0].decode('utf-8', 'replace')
+        return v
+
+    def __repr__(self):
+        return '<Datum %d %r (%s)>' % (self.datumID, self.name, self.units)
+
+class DataDefinitions:
+    '''the data definitions and data requests made on one connection'''
+    def __init__(self):
+        self.defs = {} # definition ID -> [Datum] in the order they were added
+        self.byID = {} # (definition ID, datum ID) -> Datum
+        self.requests = {} # request ID -> definition ID
+        self.numericLayouts = {} # definition ID -> (Struct, datums) for untagged data, if every datum is a plain number
+
+    def Track(self, msg):
+        '''updates our state from a client message, returning True if it was one that we care about'''
+        if isinstance(msg, message.CAddToDataDefinition):
+            datums = self.defs.setdefault(msg.dataDefinitionID, [])
+            datum = Datum(msg, len(datums))
+            datums.append(datum)
+            self.byID[(msg.dataDefinitionID, datum.datumID)] = datum
+            self.numericLayouts.pop(msg.dataDefinitionID, None)
+            if all(d.struct is not None and len(d.struct.format) == 2 and d.struct.format[1] in 'iqfd' for d in datums):
+                self.numericLayouts[msg.dataDefinitionID] = (struct.Struct('<' + ''.join(d.struct.format[1] for d in datums)), datums)
+            return True
+        if isinstance(msg, (message.CRequestDataOnSimObject, message.CRequestDataOnSimObjectType)):
+            self.requests[msg.requestID] = msg.definitionID
+            return True
+        return False
+
+    def Datums(self, definitionID):
+        '''returns the list of Datums in a data definition'''
+        return self.defs.get(definitionID, [])
+
+    def Decode(self, msg):
+        '''decodes the data in an SSimObjectData[ByType] message, returning a list of (Datum, value). Stops early
+        (without raising) if the data refers to a datum we never saw defined or one we can't decode.'''
+        data = msg.data
+        if not data:
+            return []
+        ret = []
+        offset = 0
+        end = len(data)
+        if msg.flags & SC.DATA_REQUEST_FLAG.TAGGED:
+            # Each value is prefixed with the ID of the datum it's for
+            byID = self.byID
+            defID = msg.definitionID
+            for i in range(msg.defineCount):
+                if offset + 4 > end:
+                    break
+                datumID = struct.unpack_from('<L', data, offset)[0]
+                datum = byID.get((defID, datumID))
+                if datum is None or datum.struct is None or offset + 4 + datum.size > end:
+                    break
+                ret.append((datum, datum.Unpack(data, offset + 4)))
+                offset += 4 + datum.size
+        else:
+            # Values for every datum in the definition, in order
+            layout = self.numericLayouts.get(msg.definitionID)
+            if layout is not None and layout[0].size <= end:
+                return list(zip(layout[1], layout[0].unpack_from(data))) # (all at once)
+            for datum in self.Datums(msg.definitionID):
+                if datum.struct is None or offset + datum.size > end:
+                    break
+                ret.append((datum, datum.Unpack(data, offset)))
+                offset += datum.size
+        return ret
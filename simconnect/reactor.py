@@ -0,0 +1,237 @@
+'''
+selectors-based event loop: instead of hammering non-blocking sockets and sleeping in between, the
+owner registers listening sockets, Connections, and timers with a Reactor, which sleeps until one of
+them is ready and then calls back into the owner.
+
+Typical use:
+    r = reactor.Reactor()
+    r.AddListener(listenSock, OnAccept)              # OnAccept(sock, addr)
+    r.AddConnection(conn, OnMessage, OnClosed)       # OnMessage(msg), OnClosed(conn)
+    r.CallEvery(0.25, Tick)
+    r.Run()                                          # until r.Stop() is called
+
+All callbacks run on the thread that called Run. The only methods that are safe to call from other
+threads are CallSoon and Stop.
+'''
+
+from . utils import *
+log, logTB = Logger()
+
+import selectors, socket, heapq, time, itertools, collections
+
+class Timer:
+    '''a pending call created by Reactor.CallLater/CallEvery'''
+    def __init__(self, when, interval, func, args):
+        self.when = when # time.monotonic() value at which to make the call
+        self.interval = interval # None for one-shot timers, else the number of seconds between calls
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def Cancel(self):
+        self.cancelled = True
+
+class _Registration:
+    '''Used internally, the info the Reactor keeps about each registered file object'''
+    def __init__(self, fileObj, onRead, onWrite, wantsWrite):
+        self.fileObj = fileObj
+        self.onRead = onRead # called when fileObj is readable
+        self.onWrite = onWrite # called when fileObj is writable (and wantsWrite() returned True)
+        self.wantsWrite = wantsWrite # None or a callable that returns True if we should wait for writability
+        self.events = selectors.EVENT_READ
+
+class Reactor:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.registrations = {} # file object -> _Registration
+        self.writeWatchers = [] # registrations that have a wantsWrite callable
+        self.timers = [] # heap of (when, seq, Timer)
+        self.timerSeq = itertools.count() # tie breaker for timers that are due at the same time
+        self.soon = collections.deque() # (func, args) from CallSoon
+        self.keepRunning = True # (set back to True each time Run returns, so a Stop from before Run still counts)
+
+        # A socket pair used to wake up the selector from other threads
+        self.wakeRecv, self.wakeSend = socket.socketpair()
+        self.wakeRecv.setblocking(False)
+        self.wakeSend.setblocking(False)
+        self.AddReader(self.wakeRecv, self._OnWake)
+
+    def _OnWake(self):
+        try:
+            while self.wakeRecv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _Wake(self):
+        try:
+            self.wakeSend.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass # already plenty of wakeup data pending, or we're shutting down
+
+    def AddReader(self, fileObj, onRead, onWrite=None, wantsWrite=None):
+        '''registers a socket (or anything with a fileno method). onRead() gets called whenever it is readable. If
+        wantsWrite is given, it is checked before each wait and, if it returns True, onWrite() gets called once the
+        object is writable.'''
+        reg = _Registration(fileObj, onRead, onWrite, wantsWrite)
+        self.selector.register(fileObj, reg.events, reg)
+        self.registrations[fileObj] = reg
+        if wantsWrite is not None:
+            self.writeWatchers.append(reg)
+        return reg
+
+    def AddListener(self, sock, onAccept):
+        '''registers a listening socket. onAccept(newSock, addr) gets called for each incoming connection.'''
+        sock.setblocking(False)
+        def OnRead():
+            while 1:
+                try:
+                    q, addr = sock.accept()
+                except BlockingIOError:
+                    break
+                try:
+                    onAccept(q, addr)
+                except:
+                    logTB()
+        return self.AddReader(sock, OnRead)
+
+    def AddConnection(self, conn, onMessage, onClosed=None, onDrained=None):
+        '''registers a connection.Connection. onMessage(msg) gets called for each message received, and
+        onClosed(conn) gets called (after the connection has been removed from the reactor) once it closes. If
+        given, onDrained(conn) gets called whenever the reactor finishes sending everything that was queued up,
+        which lets a producer send only as fast as the other side can receive.'''
+        def OnRead():
+            conn.PumpRecv()
+            while conn.inMessages:
+                msg = conn.inMessages.popleft()
+                try:
+                    onMessage(msg)
+                except:
+                    logTB()
+                if conn not in self.registrations:
+                    return # the callback removed the connection
+            if not conn.alive:
+                self.Remove(conn)
+                if onClosed is not None:
+                    onClosed(conn)
+        if onDrained is None:
+            return self.AddReader(conn, OnRead, conn.Flush, conn.WantsWrite)
+        def OnWrite():
+            conn.Flush()
+            if not conn.WantsWrite() and conn.alive:
+                onDrained(conn)
+        return self.AddReader(conn, OnRead, OnWrite, conn.WantsWrite)
+
+    def Remove(self, fileObj):
+        '''unregisters something previously registered with one of the Add* methods (doesn't close it though)'''
+        reg = self.registrations.pop(fileObj, None)
+        if reg is None:
+            return
+        self.selector.unregister(fileObj)
+        if reg.wantsWrite is not None:
+            self.writeWatchers.remove(reg)
+
+    def CallLater(self, delay, func, *args):
+        '''arranges for func(*args) to be called after delay seconds. Returns a Timer.'''
+        t = Timer(time.monotonic() + delay, None, func, args)
+        heapq.heappush(self.timers, (t.when, next(self.timerSeq), t))
+        return t
+
+    def CallEvery(self, interval, func, *args):
+        '''arranges for func(*args) to be called every interval seconds (the first call is interval seconds from
+        now). Returns a Timer.'''
+        t = Timer(time.monotonic() + interval, interval, func, args)
+        heapq.heappush(self.timers, (t.when, next(self.timerSeq), t))
+        return t
+
+    def CallSoon(self, func, *args):
+        '''arranges for func(*args) to be called on the reactor's thread as soon as possible. Safe to call from
+        any thread.'''
+        self.soon.append((func, args))
+        self._Wake()
+
+    def Stop(self):
+        '''causes Run to return. Safe to call from any thread.'''
+        self.keepRunning = False
+        self._Wake()
+
+    def _RunTimers(self):
+        '''calls any timers that are due, returning the number of seconds until the next one is due (or None
+        if there are no timers)'''
+        now = time.monotonic()
+        timers = self.timers
+        due = []
+        while timers and timers[0][0] <= now:
+            when, seq, t = heapq.heappop(timers)
+            if not t.cancelled:
+                due.append(t)
+
+        for t in due:
+            if t.cancelled:
+                continue # cancelled by an earlier timer in this batch
+            if t.interval is not None:
+                # Schedule based on when it was supposed to run so that the rate doesn't drift, but don't try
+                # to catch up if we've fallen way behind
+                t.when = max(t.when + t.interval, now)
+                heapq.heappush(timers, (t.when, next(self.timerSeq), t))
+            try:
+                t.func(*t.args)
+            except:
+                logTB()
+
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(0, timers[0][0] - time.monotonic())
+
+    def RunOnce(self, timeout=None):
+        '''waits (up to timeout seconds, or until the next timer is due) for something to happen, and dispatches
+        it'''
+        while self.soon:
+            func, args = self.soon.popleft()
+            try:
+                func(*args)
+            except:
+                logTB()
+
+        untilNextTimer = self._RunTimers()
+        if untilNextTimer is not None and (timeout is None or untilNextTimer < timeout):
+            timeout = untilNextTimer
+        if self.soon:
+            timeout = 0
+
+        # Only wait for writability on things that actually have something to write
+        for reg in self.writeWatchers:
+            events = selectors.EVENT_READ
+            if reg.wantsWrite():
+                events |= selectors.EVENT_WRITE
+            if events != reg.events:
+                reg.events = events
+                self.selector.modify(reg.fileObj, events, reg)
+
+        for key, events in self.selector.select(timeout):
+            reg = key.data
+            registrations = self.registrations
+            if registrations.get(reg.fileObj) is not reg:
+                continue # removed (and maybe re-added) by an earlier callback in this batch
+            try:
+                if events & selectors.EVENT_WRITE:
+                    reg.onWrite()
+                if events & selectors.EVENT_READ and registrations.get(reg.fileObj) is reg:
+                    reg.onRead()
+            except:
+                logTB()
+
+    def Run(self):
+        '''dispatches events until Stop is called (which may happen before Run even starts)'''
+        try:
+            while self.keepRunning:
+                self.RunOnce()
+        finally:
+            self.keepRunning = True # (ready for the next Run)
+
+    def Close(self):
+        self.selector.close()
+        self.wakeRecv.close()
+        self.wakeSend.close()
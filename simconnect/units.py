@@ -0,0 +1,275 @@
+'''
+SimConnect units of measure: looks up unit names (as clients pass them to CAddToDataDefinition) and compiles a
+converter function for a pair of units once, so that converting values on every tick is just a call.
+
+Names are case insensitive and can be any of the aliases SimConnect accepts ('feet', 'foot', 'ft'), composites
+built from them ('feet per minute', 'pounds per square foot', 'radians/second', 'feet per second squared'), and
+the special units:
+- bool: anything numeric converts to it (as value > 0), and it converts to any dimensionless unit
+- enum, mask, flags, string: can only be "converted" to themselves (or, for enums, to number)
+- percent over 100 (0..1) and percent (0..100), which convert to each other and to the other dimensionless units
+
+Example:
+    toFPM = units.Converter('meters per second', 'Feet Per Minute')
+    fpm = toFPM(2.5)
+
+Scaling() returns the same conversion as a (scale, shift) pair instead, for converting whole arrays at once.
+'''
+
+from . utils import *
+log, logTB = Logger()
+
+import math, re
+
+class UnitsError(ValueError):
+    '''a conversion between two units that can't be done'''
+
+class UnknownUnitsError(UnitsError):
+    '''a unit name that isn't in the registry'''
+
+# Kinds of units
+UK_Linear, UK_Bool, UK_Enum, UK_String = range(4)
+
+# Dimensions are tuples of exponents of these base quantities
+DIMENSIONS = ('length', 'time', 'angle', 'mass', 'temperature')
+NONE      = (0, 0, 0, 0, 0)
+LENGTH    = (1, 0, 0, 0, 0)
+TIME      = (0, 1, 0, 0, 0)
+ANGLE     = (0, 0, 1, 0, 0)
+MASS      = (0, 0, 0, 1, 0)
+TEMP      = (0, 0, 0, 0, 1)
+AREA      = (2, 0, 0, 0, 0)
+VOLUME    = (3, 0, 0, 0, 0)
+SPEED     = (1, -1, 0, 0, 0)
+FREQUENCY = (0, -1, 0, 0, 0)
+PRESSURE  = (-1, -2, 0, 1, 0)
+FORCE     = (1, -2, 0, 1, 0)
+
+class Unit:
+    '''a unit of measure: value_in_SI = value * factor + offset'''
+    def __init__(self, name, kind=UK_Linear, dims=NONE, factor=1.0, offset=0.0):
+        self.name = name
+        self.kind = kind # one of UK_*
+        self.dims = dims # for UK_Linear units
+        self.factor = factor
+        self.offset = offset # only non-zero for temperatures
+
+    def Power(self, n):
+        if self.kind != UK_Linear or self.offset:
+            raise UnitsError('%r cannot be part of a composite unit' % self.name)
+        return Unit('%s^%d' % (self.name, n), dims=tuple(d * n for d in self.dims), factor=self.factor ** n)
+
+    def Times(self, other):
+        if self.kind != UK_Linear or other.kind != UK_Linear or self.offset or other.offset:
+            raise UnitsError('%r and %r cannot be combined' % (self.name, other.name))
+        return Unit('%s*%s' % (self.name, other.name), dims=tuple(a + b for a, b in zip(self.dims, other.dims)), factor=self.factor * other.factor)
+
+    def __repr__(self):
+        return '<Unit %s>' % self.name
+
+_units = {} # normalized name -> Unit, for every name and alias
+
+def Register(names, kind=UK_Linear, dims=NONE, factor=1.0, offset=0.0):
+    '''adds a unit to the registry under each of the given names (the first is its canonical name)'''
+    names = names.split(',')
+    unit = Unit(names[0].strip(), kind, dims, factor, offset)
+    for name in names:
+        _units[Normalize(name)] = unit
+    return unit
+
+def Normalize(name):
+    '''returns a unit name in the form we look it up by'''
+    return ' '.join((name or '').lower().replace('/', ' per ').split())
+
+FT = 0.3048
+NMILE = 1852.0
+MILE = 1609.344
+LB = 0.45359237
+G = 9.80665
+
+# Length
+Register('meter,meters,metre,metres,m', dims=LENGTH)
+Register('centimeter,centimeters,cm', dims=LENGTH, factor=0.01)
+Register('millimeter,millimeters,mm', dims=LENGTH, factor=0.001)
+Register('kilometer,kilometers,km', dims=LENGTH, factor=1000.0)
+Register('foot,feet,ft', dims=LENGTH, factor=FT)
+Register('inch,inches,in', dims=LENGTH, factor=0.0254)
+Register('yard,yards,yd', dims=LENGTH, factor=0.9144)
+Register('mile,miles', dims=LENGTH, factor=MILE)
+Register('decimile,decimiles', dims=LENGTH, factor=MILE / 10)
+Register('nautical mile,nautical miles,nmile,nmiles', dims=LENGTH, factor=NMILE)
+Register('decinmile,decinmiles', dims=LENGTH, factor=NMILE / 10)
+
+# Time
+Register('second,seconds,sec,secs,s', dims=TIME)
+Register('minute,minutes,min,mins', dims=TIME, factor=60.0)
+Register('hour,hours,hr,hrs,h', dims=TIME, factor=3600.0)
+Register('day,days', dims=TIME, factor=86400.0)
+Register('hours over 10', dims=TIME, factor=360.0)
+
+# Angles
+Register('radian,radians,rad', dims=ANGLE)
+Register('degree,degrees,deg,degree latitude,degrees latitude,degree longitude,degrees longitude', dims=ANGLE, factor=math.pi / 180)
+Register('grad,grads', dims=ANGLE, factor=math.pi / 200)
+Register('revolution,revolutions,rev,revs,cycle,cycles', dims=ANGLE, factor=2 * math.pi)
+
+# Speeds and rates (the ones that aren't spelled as composites)
+Register('knot,knots,kt,kts', dims=SPEED, factor=NMILE / 3600)
+Register('kph,kmh', dims=SPEED, factor=1000.0 / 3600)
+Register('mph', dims=SPEED, factor=MILE / 3600)
+Register('fps', dims=SPEED, factor=FT)
+Register('fpm', dims=SPEED, factor=FT / 60)
+Register('rpm', dims=(0, -1, 1, 0, 0), factor=2 * math.pi / 60)
+Register('hertz,hz,per second,per sec', dims=FREQUENCY)
+Register('per minute', dims=FREQUENCY, factor=1 / 60)
+Register('per hour', dims=FREQUENCY, factor=1 / 3600)
+Register('per radian', dims=(0, 0, -1, 0, 0))
+Register('per degree', dims=(0, 0, -1, 0, 0), factor=180 / math.pi)
+Register('g force,gforce,gs', dims=(1, -2, 0, 0, 0), factor=G)
+
+# Mass and force
+Register('kilogram,kilograms,kg', dims=MASS)
+Register('gram,grams', dims=MASS, factor=0.001)
+Register('pound,pounds,lb,lbs', dims=MASS, factor=LB)
+Register('slug,slugs', dims=MASS, factor=14.59390294)
+Register('newton,newtons', dims=FORCE)
+Register('pound force,pounds force,lbf', dims=FORCE, factor=LB * G)
+
+# Area and volume (the ones that aren't spelled as composites)
+Register('acre,acres', dims=AREA, factor=4046.8564224)
+Register('liter,liters,litre,litres', dims=VOLUME, factor=0.001)
+Register('gallon,gallons,gal', dims=VOLUME, factor=0.003785411784)
+Register('quart,quarts', dims=VOLUME, factor=0.000946352946)
+
+# Pressure
+Register('pascal,pascals,pa', dims=PRESSURE)
+Register('kilopascal,kilopascals,kpa', dims=PRESSURE, factor=1000.0)
+Register('millibar,millibars,mbar,mbars,hectopascal,hectopascals,hpa', dims=PRESSURE, factor=100.0)
+Register('bar,bars', dims=PRESSURE, factor=100000.0)
+Register('psi,pound per square inch,pounds per square inch', dims=PRESSURE, factor=LB * G / 0.0254 ** 2)
+Register('psf,pound per square foot,pounds per square foot', dims=PRESSURE, factor=LB * G / FT ** 2)
+Register('inch of mercury,inches of mercury,inhg', dims=PRESSURE, factor=3386.389)
+Register('millimeter of mercury,millimeters of mercury,mmhg', dims=PRESSURE, factor=133.322387415)
+Register('atmosphere,atmospheres,atm', dims=PRESSURE, factor=101325.0)
+
+# Temperature
+Register('kelvin', dims=TEMP)
+Register('celsius,degree celsius,degrees celsius', dims=TEMP, offset=273.15)
+Register('rankine,degree rankine,degrees rankine', dims=TEMP, factor=5 / 9)
+Register('fahrenheit,degree fahrenheit,degrees fahrenheit', dims=TEMP, factor=5 / 9, offset=459.67 * 5 / 9)
+
+# Dimensionless
+Register('number,numbers,scalar,ratio,part,times')
+Register('percent over 100,percentage over 100')
+Register('percent,percentage', factor=0.01)
+Register('position')
+Register('position 16k', factor=1 / 16384)
+Register('position 32k', factor=1 / 32768)
+Register('position 128', factor=1 / 128)
+
+# Special units
+Register('bool,boolean', kind=UK_Bool)
+Register('enum,enumeration', kind=UK_Enum)
+Register('mask,flags', kind=UK_Enum)
+Register('string', kind=UK_String)
+
+_SQUARE = re.compile(r'^(?:square|sq)\s+(.+)$|^(.+)\s+squared$')
+_CUBIC = re.compile(r'^(?:cubic|cu)\s+(.+)$|^(.+)\s+cubed$')
+
+def _LookupPart(part):
+    '''returns the Unit for one side of a composite unit (which may be squared or cubed)'''
+    unit = _units.get(part)
+    if unit is not None:
+        return unit
+    for regex, power in ((_SQUARE, 2), (_CUBIC, 3)):
+        m = regex.match(part)
+        if m:
+            return _LookupPart(m.group(1) or m.group(2)).Power(power)
+    raise UnknownUnitsError('unknown units %r' % part)
+
+def Lookup(name):
+    '''returns the Unit for a unit name or composite unit, raising UnknownUnitsError if it's not one we know'''
+    norm = Normalize(name)
+    unit = _units.get(norm)
+    if unit is None:
+        parts = norm.split(' per ')
+        unit = _LookupPart(parts[0])
+        for part in parts[1:]:
+            unit = unit.Times(_LookupPart(part).Power(-1))
+        _units[norm] = unit
+    return unit
+
+def Identity(value):
+    return value
+
+def _ToBool(value):
+    return value > 0 # should this be != 0 instead? right now just using it for gear lever down, mapping 100.0 --> true
+
+def _Compile(fromName, toName):
+    '''builds the converter for a pair of (normalized) unit names'''
+    if fromName == toName:
+        return Identity # (even if we don't know what they are)
+    src = Lookup(fromName)
+    dest = Lookup(toName)
+    if src is dest:
+        return Identity
+
+    if dest.kind == UK_Bool:
+        if src.kind == UK_Linear:
+            return _ToBool
+    elif src.kind == UK_Bool:
+        if dest.kind == UK_Linear and dest.dims == NONE:
+            return Identity # (FlyInside sends bools as 0.0/1.0 already)
+    elif UK_Enum in (src.kind, dest.kind):
+        if {src.kind, dest.kind} == {UK_Enum} or (dest.kind == UK_Linear and dest.factor == 1.0 and dest.dims == NONE) \
+                or (src.kind == UK_Linear and src.factor == 1.0 and src.dims == NONE):
+            return Identity # (enum <-> number)
+    elif src.kind == UK_Linear and dest.kind == UK_Linear:
+        if src.dims != dest.dims:
+            raise UnitsError('cannot convert %r to %r: %s vs %s' % (fromName, toName, DimensionsText(src.dims), DimensionsText(dest.dims)))
+        scale = src.factor / dest.factor
+        shift = (src.offset - dest.offset) / dest.factor
+        if shift:
+            func = lambda value: value * scale + shift
+        elif scale == 1.0:
+            return Identity
+        else:
+            func = lambda value: value * scale
+        func.scaling = (scale, shift) # (for Scaling)
+        return func
+    raise UnitsError('cannot convert %r to %r' % (fromName, toName))
+
+def DimensionsText(dims):
+    '''returns e.g. "length/time" for SPEED'''
+    num = []
+    den = []
+    for name, power in zip(DIMENSIONS, dims):
+        if power:
+            text = name if abs(power) == 1 else '%s^%d' % (name, abs(power))
+            (num if power > 0 else den).append(text)
+    return ('*'.join(num) or '1') + ''.join('/' + x for x in den) if (num or den) else 'dimensionless'
+
+_converters = {} # (normalized from, normalized to) -> converter function
+
+def Converter(fromUnits, toUnits):
+    '''returns a function that converts a value in fromUnits to toUnits, raising UnitsError (or UnknownUnitsError)
+    if that's not possible. fromUnits may be None, meaning the values are already in whatever units are wanted.'''
+    if fromUnits is None:
+        return Identity
+    key = (Normalize(fromUnits), Normalize(toUnits))
+    func = _converters.get(key)
+    if func is None:
+        func = _converters[key] = _Compile(*key)
+    return func
+
+def Scaling(fromUnits, toUnits):
+    '''returns (scale, shift) such that converting a value from fromUnits to toUnits is value * scale + shift, or None
+    if the conversion isn't linear (e.g. number to bool). Raises the same errors as Converter.'''
+    func = Converter(fromUnits, toUnits)
+    if func is Identity:
+        return 1.0, 0.0
+    return getattr(func, 'scaling', None)
+
+def Convert(value, fromUnits, toUnits):
+    '''converts a single value (better to hang on to a Converter when converting lots of values)'''
+    return Converter(fromUnits, toUnits)(value)
@@ -36,6 +36,13 @@ def Logger(context=None):
     return logger, logger.tb
 log, logTB = Logger() # global defaults
 
+def Percentile(values, pct):
+    '''returns the value at the given percentile (0-100) of a list of numbers, or 0.0 if it's empty'''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
 def InitLogging(logFilename, level=logging.INFO):
     logging.config.dictConfig(dict(
         version=1,